@@ -0,0 +1,183 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2016 Canonical Ltd.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Reports on the boot timing records written by the timing handler.
+
+Each record is a json object (one per line) with the event's full name
+(nested events are named <parent>/<child>), its description and result,
+the wall clock time it started at and its duration in seconds.
+"""
+
+import json
+
+from cloudinit import log as logging
+from cloudinit import util
+
+LOG = logging.getLogger(__name__)
+
+# Finishing this close to (or after) another event starting still counts
+# as having had to happen before it.
+_SLACK = 0.001
+
+
+def load_timings(path):
+    records = []
+    for (lineno, line) in enumerate(util.load_file(path).splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            record['start'] = float(record['start'])
+            record['duration'] = float(record['duration'])
+            record['name'] = str(record['name'])
+        except (ValueError, TypeError, KeyError):
+            LOG.warn("Skipping bad timing record on line %s of %s",
+                     lineno, path)
+            continue
+        records.append(record)
+    return records
+
+
+def _by_name(records):
+    # When an event ran more than once the last run is the one used
+    by_name = {}
+    for record in records:
+        by_name[record['name']] = record
+    return by_name
+
+
+def _end(record):
+    return record['start'] + record['duration']
+
+
+def blame(records, count=None):
+    """The (count) slowest events, slowest first."""
+    ordered = sorted(records, key=lambda r: r['duration'], reverse=True)
+    if count is not None:
+        ordered = ordered[:count]
+    return ordered
+
+
+def _children(by_name):
+    children = {}
+    roots = []
+    for (name, record) in by_name.items():
+        parent = name.rsplit('/', 1)[0] if '/' in name else None
+        if parent in by_name:
+            children.setdefault(parent, []).append(record)
+        else:
+            roots.append(record)
+    return (roots, children)
+
+
+def _chain(records):
+    # Working back from whatever finished last, each step is the event
+    # that finished last before the previous one started (the others
+    # overlapped with it, so did not hold anything up).
+    chain = []
+    candidates = sorted(records, key=_end)
+    while candidates:
+        record = candidates.pop()
+        chain.append(record)
+        candidates = [r for r in candidates
+                      if _end(r) <= record['start'] + _SLACK]
+    chain.reverse()
+    return chain
+
+
+def critical_path(records):
+    """The events that the boot as a whole had to wait for.
+
+    Returns a list of (depth, record) tuples in the order they ran, the
+    stages (which always run one after another) are at depth zero.
+    """
+    (roots, children) = _children(_by_name(records))
+    path = []
+
+    def walk(record, depth):
+        path.append((depth, record))
+        for child in _chain(children.get(record['name'], [])):
+            walk(child, depth + 1)
+
+    for root in sorted(roots, key=lambda r: r['start']):
+        walk(root, 0)
+    return path
+
+
+def compare(old_records, new_records, count=None):
+    """How the duration of each event changed between two boots.
+
+    Returns a list of (name, old duration, new duration) tuples, those
+    that changed the most first. Events that only ran in one of the boots
+    have None as their other duration.
+    """
+    old = _by_name(old_records)
+    new = _by_name(new_records)
+    diffs = []
+    for name in set(old) | set(new):
+        old_duration = old[name]['duration'] if name in old else None
+        new_duration = new[name]['duration'] if name in new else None
+        diffs.append((name, old_duration, new_duration))
+
+    def change(diff):
+        return abs((diff[2] or 0.0) - (diff[1] or 0.0))
+
+    diffs.sort(key=lambda d: (-change(d), d[0]))
+    if count is not None:
+        diffs = diffs[:count]
+    return diffs
+
+
+def total_time(records):
+    """How long all the stages took (not counting time in between)."""
+    (roots, _children_of) = _children(_by_name(records))
+    return sum(r['duration'] for r in roots)
+
+
+def format_blame(records):
+    lines = []
+    for record in records:
+        lines.append("%10.3fs %s" % (record['duration'], record['name']))
+    return "\n".join(lines)
+
+
+def format_critical_path(path):
+    lines = []
+    for (depth, record) in path:
+        lines.append("%10.3fs %s%s (%s)" % (
+            record['duration'], "  " * depth,
+            record['name'].rsplit('/', 1)[-1], record.get('result', '?')))
+    return "\n".join(lines)
+
+
+def format_compare(diffs, old_total=None, new_total=None):
+    def fmt(duration):
+        if duration is None:
+            return "%11s" % '-'
+        return "%10.3fs" % duration
+
+    lines = ["%11s %11s %11s %s" % ('old', 'new', 'change', 'event')]
+    if old_total is not None and new_total is not None:
+        diffs = [('(all stages)', old_total, new_total)] + list(diffs)
+    for (name, old_duration, new_duration) in diffs:
+        if old_duration is None or new_duration is None:
+            delta = "%11s" % '-'
+        else:
+            delta = "%+10.3fs" % (new_duration - old_duration)
+        lines.append("%s %s %s %s" % (fmt(old_duration), fmt(new_duration),
+                                      delta, name))
+    return "\n".join(lines)
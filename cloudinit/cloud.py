@@ -20,9 +20,9 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import copy
 import os
 
+from cloudinit import helpers
 from cloudinit import log as logging
 from cloudinit.reporting import events
 
@@ -64,11 +64,17 @@ class Cloud(object):
     @property
     def cfg(self):
         # Ensure that not indirectly modified
-        return copy.deepcopy(self._cfg)
+        return helpers.ConfigView(self._cfg)
 
     def run(self, name, functor, args, freq=None, clear_on_fail=False):
         return self._runners.run(name, functor, args, freq, clear_on_fail)
 
+    def which_have_run(self, items):
+        return self._runners.which_have_run(items)
+
+    def sync_semaphores(self):
+        return self._runners.sync()
+
     def get_template_filename(self, name):
         fn = self.paths.template_tpl % (name)
         if not os.path.isfile(fn):
@@ -19,8 +19,15 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from cloudinit.settings import (PER_INSTANCE, FREQUENCIES)
+import ast
+import json
+import os
+import sys
 
+from cloudinit.settings import (PER_INSTANCE, PER_ALWAYS, PER_ONCE,
+                                FREQUENCIES)
+
+from cloudinit import importer
 from cloudinit import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -31,6 +38,26 @@ LOG = logging.getLogger(__name__)
 # name in the lookup path...
 MOD_PREFIX = "cc_"
 
+# The (optional) index of the modules in this package, written when it is
+# installed (see tools/build-module-index) so that finding a module does not
+# need it (or anything else) to be imported.
+INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "index.json")
+INDEX_VERSION = 1
+
+# What a module declares about itself that the index keeps
+INDEXED_ATTRS = ('frequency', 'distros', 'osfamilies', 'resources')
+
+# Names modules may use for their frequency (instead of the string itself)
+_FREQUENCY_NAMES = {
+    'PER_INSTANCE': PER_INSTANCE,
+    'PER_ALWAYS': PER_ALWAYS,
+    'PER_ONCE': PER_ONCE,
+}
+
+_MODULE_INDEX = None
+_INDEXED_MODULES = {}
+
 
 def form_module_name(name):
     canon_name = name.replace("-", "_")
@@ -55,4 +82,192 @@ def fixup_module(mod, def_freq=PER_INSTANCE):
         setattr(mod, 'distros', [])
     if not hasattr(mod, 'osfamilies'):
         setattr(mod, 'osfamilies', [])
+    # Modules that do not say which (shared) resources they use are assumed
+    # to use all of them, and so never run alongside any other module.
+    if not hasattr(mod, 'resources'):
+        setattr(mod, 'resources', None)
+    return mod
+
+
+class IndexedModule(importer.LazyModule):
+    """A module found through the module index.
+
+    What the index knows about it (its frequency, distros, osfamilies and
+    resources) is answered without importing it, anything else imports it
+    first. So modules that end up not running (because they already ran)
+    are never imported at all.
+    """
+
+    def __init__(self, module_name, info):
+        super(IndexedModule, self).__init__(module_name)
+        for attr in INDEXED_ATTRS:
+            self.__dict__[attr] = info[attr]
+
+
+def _static_value(node):
+    if isinstance(node, ast.Name) and node.id in _FREQUENCY_NAMES:
+        return _FREQUENCY_NAMES[node.id]
+    if isinstance(node, ast.Attribute) and node.attr in _FREQUENCY_NAMES:
+        return _FREQUENCY_NAMES[node.attr]
+    return ast.literal_eval(node)
+
+
+def _assigned_names(node):
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, (ast.Assign, ast.AugAssign)):
+            targets = getattr(child, 'targets', None) or [child.target]
+            for target in targets:
+                for name in ast.walk(target):
+                    if isinstance(name, ast.Name):
+                        names.add(name.id)
+        elif isinstance(child, ast.Global):
+            names.update(child.names)
+    return names
+
+
+def scan_module(path):
+    """What the module at path declares about itself (as fixup_module
+    would fill it in), without importing it.
+
+    Returns None when that can not be told from its source alone, for
+    example when it computes its frequency or has no handle function.
+    """
+    with open(path, 'rb') as fh:
+        tree = ast.parse(fh.read(), path)
+    info = {'frequency': PER_INSTANCE, 'distros': [], 'osfamilies': [],
+            'resources': None}
+    has_handle = False
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == 'handle':
+            has_handle = True
+            continue
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1 and
+                isinstance(node.targets[0], ast.Name) and
+                node.targets[0].id in info):
+            try:
+                info[node.targets[0].id] = _static_value(node.value)
+            except (ValueError, TypeError):
+                return None
+            continue
+        if _assigned_names(node) & set(INDEXED_ATTRS + ('handle',)):
+            # Assigned conditionally, or in some other way that only
+            # importing it can tell the outcome of.
+            return None
+    if not has_handle or info['frequency'] not in FREQUENCIES:
+        return None
+    return info
+
+
+def build_module_index(path=None):
+    """Indexes the modules in the given directory (this package's by
+    default)."""
+    if path is None:
+        path = os.path.dirname(INDEX_FILE)
+    package = __name__
+    modules = {}
+    for fname in sorted(os.listdir(path)):
+        if not fname.startswith(MOD_PREFIX) or not fname.endswith(".py"):
+            continue
+        mod_name = fname[0:-3]
+        full_path = os.path.join(path, fname)
+        try:
+            info = scan_module(full_path)
+        except (IOError, OSError, SyntaxError) as e:
+            LOG.warn("Not indexing module %s: %s", full_path, e)
+            continue
+        if info is None:
+            LOG.debug("Not indexing module %s, it has to be imported to"
+                      " find out what it does", full_path)
+            continue
+        st = os.stat(full_path)
+        info.update({
+            'module': "%s.%s" % (package, mod_name),
+            'file': fname,
+            'mtime': int(st.st_mtime),
+            'size': st.st_size,
+        })
+        modules[mod_name] = info
+    return {'version': INDEX_VERSION, 'modules': modules}
+
+
+def write_module_index(path=None, index_file=None):
+    if path is None:
+        path = os.path.dirname(INDEX_FILE)
+    if index_file is None:
+        index_file = os.path.join(path, os.path.basename(INDEX_FILE))
+    index = build_module_index(path)
+    with open(index_file, 'w') as fh:
+        json.dump(index, fh, indent=1, sort_keys=True)
+        fh.write("\n")
+    return index
+
+
+def load_module_index(index_file=None):
+    """The installed module index (or an empty one when there is none)."""
+    if index_file is None:
+        index_file = INDEX_FILE
+    try:
+        with open(index_file, 'r') as fh:
+            index = json.load(fh)
+    except (IOError, OSError):
+        return {}
+    except ValueError as e:
+        LOG.warn("Ignoring bad module index %s: %s", index_file, e)
+        return {}
+    if not isinstance(index, dict) or index.get('version') != INDEX_VERSION:
+        LOG.debug("Ignoring module index %s of an unknown version",
+                  index_file)
+        return {}
+    modules = index.get('modules')
+    if not isinstance(modules, dict):
+        return {}
+    return modules
+
+
+def _module_index():
+    global _MODULE_INDEX
+    if _MODULE_INDEX is None:
+        _MODULE_INDEX = load_module_index()
+    return _MODULE_INDEX
+
+
+def _index_is_current(info, path):
+    # The index is only trusted for modules that were not changed after it
+    # was written (the import path is used for the others).
+    try:
+        st = os.stat(os.path.join(path, info['file']))
+    except (OSError, KeyError):
+        return False
+    return (int(st.st_mtime) == info.get('mtime') and
+            st.st_size == info.get('size'))
+
+
+def indexed_module(mod_name, index=None, path=None):
+    """Finds the module named mod_name (like form_module_name returns) in
+    the module index, without importing it.
+
+    Returns None when it is not in there (or the index is out of date), it
+    then has to be searched for with importer.find_module.
+    """
+    if index is None:
+        index = _module_index()
+    if path is None:
+        path = os.path.dirname(INDEX_FILE)
+    info = index.get(mod_name)
+    if not info or not info.get('module'):
+        return None
+    full_name = info['module']
+    if full_name in _INDEXED_MODULES:
+        return _INDEXED_MODULES[full_name]
+    if full_name in sys.modules:
+        return fixup_module(sys.modules[full_name])
+    if not _index_is_current(info, path):
+        LOG.debug("Module index entry for %s is out of date", mod_name)
+        return None
+    try:
+        mod = IndexedModule(full_name, info)
+    except KeyError:
+        return None
+    _INDEXED_MODULES[full_name] = mod
     return mod
@@ -33,6 +33,8 @@ APT_PIPE_TPL = ("//Written by cloud-init per 'apt_pipelining'\n"
 # A value of zero MUST be specified if the remote host does not properly linger
 # on TCP connections - otherwise data corruption will occur.
 
+resources = ['package-manager']
+
 
 def handle(_name, cfg, _cloud, log, _args):
 
@@ -27,6 +27,8 @@ from cloudinit import util
 
 distros = ['ubuntu', 'debian']
 
+resources = ['byobu']
+
 
 def handle(name, cfg, cloud, log, args):
     if len(args) != 0:
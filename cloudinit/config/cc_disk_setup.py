@@ -57,6 +57,9 @@ def handle(_name, cfg, cloud, log, _args):
                               func=mkpart, args=(disk, definition))
             except Exception as e:
                 util.logexc(LOG, "Failed partitioning operation\n%s" % e)
+            finally:
+                # Partitions (and their filesystems) may have changed
+                util.invalidate_blkid_inventory()
 
     fs_setup = cfg.get("fs_setup")
     if isinstance(fs_setup, list):
@@ -75,6 +78,8 @@ def handle(_name, cfg, cloud, log, _args):
                               func=mkfs, args=(definition,))
             except Exception as e:
                 util.logexc(LOG, "Failed during filesystem operation\n%s" % e)
+            finally:
+                util.invalidate_blkid_inventory()
 
 
 def update_disk_setup_devices(disk_setup, tformer):
@@ -20,6 +20,8 @@
 
 from cloudinit import util
 
+resources = ['locale']
+
 
 def handle(name, cfg, cloud, log, args):
     if len(args) != 0:
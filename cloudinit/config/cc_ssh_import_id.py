@@ -29,6 +29,8 @@ import pwd
 # https://launchpad.net/ssh-import-id
 distros = ['ubuntu', 'debian']
 
+resources = ['ssh-authorized-keys']
+
 
 def handle(_name, cfg, cloud, log, args):
 
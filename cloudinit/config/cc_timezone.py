@@ -24,6 +24,8 @@ from cloudinit.settings import PER_INSTANCE
 
 frequency = PER_INSTANCE
 
+resources = ['timezone']
+
 
 def handle(name, cfg, cloud, log, args):
     if len(args) != 0:
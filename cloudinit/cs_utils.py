@@ -33,7 +33,10 @@ API Docs: http://cloudsigma-docs.readthedocs.org/en/latest/server_context.html
 import json
 import platform
 
-import serial
+from cloudinit import importer
+
+# Only needed once the serial port is actually read from
+serial = importer.lazy_import('serial')
 
 # these high timeouts are necessary as read may read a lot of data.
 READ_TIMEOUT = 60
@@ -0,0 +1,319 @@
+# vi: ts=4 expandtab
+#
+#    Copyright (C) 2016 Canonical Ltd.
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A (optional) long lived process that runs the later boot stages.
+
+When enabled, the process that ran 'init --local' forks off a daemon that
+keeps listening on a unix socket. The later stages (started as usual from
+the init system) then only act as thin clients: they pass their arguments
+and their stdout/stderr to the daemon, which runs the stage and replies
+with its exit code. Imported modules and anything cached in memory by an
+earlier stage (the Init object with its datasource, pooled url sessions,
+dmi and blkid data) stay around for the later ones. The daemon (and so
+every later stage) runs in the control group of the local stage's unit.
+
+The protocol is one newline terminated json request per connection
+({"argv": [...]}, with the client's stdout and stderr passed along as
+SCM_RIGHTS ancillary data), answered by one newline terminated json
+reply ({"exit": <code>}).
+"""
+
+import array
+import errno
+import json
+import os
+import socket
+import sys
+
+import six
+
+from cloudinit import log as logging
+from cloudinit import util
+
+LOG = logging.getLogger(__name__)
+
+DEF_SOCKET_PATH = "/run/cloud-init/daemon.sock"
+
+# How long the daemon waits for the next stage before giving up on it
+DEF_IDLE_TIMEOUT = 3600
+
+# Largest request (or reply) that will be accepted
+MAX_MESSAGE_SIZE = 64 * 1024
+
+# At most stdout and stderr are passed along with a request
+MAX_FDS = 2
+
+
+class DaemonError(Exception):
+    pass
+
+
+def is_supported():
+    # Passing file descriptors needs sendmsg/recvmsg (python 3.3+)
+    return (hasattr(socket, 'AF_UNIX') and
+            hasattr(socket.socket, 'sendmsg') and
+            hasattr(socket, 'SCM_RIGHTS'))
+
+
+def _read_message(conn, buf=b''):
+    while not buf.endswith(b"\n"):
+        if len(buf) > MAX_MESSAGE_SIZE:
+            raise DaemonError("Message larger than %s bytes"
+                              % (MAX_MESSAGE_SIZE))
+        chunk = conn.recv(4096)
+        if not chunk:
+            if buf:
+                raise DaemonError("Connection closed mid-message")
+            return None
+        buf += chunk
+    return json.loads(buf.decode('utf-8'))
+
+
+def _write_message(conn, message, fds=None):
+    payload = (json.dumps(message) + "\n").encode('utf-8')
+    if fds:
+        conn.sendmsg([payload], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                  array.array('i', fds))])
+    else:
+        conn.sendall(payload)
+
+
+def _std_fds():
+    fds = []
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+            fds.append(stream.fileno())
+        except (AttributeError, ValueError, IOError):
+            # Not backed by a real file (for example when under test), the
+            # daemon keeps writing to its own then.
+            return []
+    return fds
+
+
+def call(argv, socket_path=DEF_SOCKET_PATH):
+    """Asks a running daemon to run the stage given by argv.
+
+    Returns the exit code of that stage, or None when there is no daemon
+    to ask (in which case the caller should run the stage itself).
+    """
+    if not is_supported() or not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error as e:
+            LOG.debug("Not using boot daemon at %s: %s", socket_path, e)
+            return None
+        LOG.debug("Handing %s over to boot daemon at %s",
+                  argv, socket_path)
+        _write_message(sock, {'argv': list(argv)}, fds=_std_fds())
+        reply = _read_message(sock)
+    finally:
+        sock.close()
+    if not reply or 'exit' not in reply:
+        # The stage may have (partially) run, so it is not safe to just
+        # run it again here.
+        raise DaemonError("Boot daemon at %s went away while running %s"
+                          % (socket_path, argv))
+    try:
+        return int(reply['exit'])
+    except (TypeError, ValueError):
+        raise DaemonError("Boot daemon at %s replied with exit code %r"
+                          " for %s" % (socket_path, reply['exit'], argv))
+
+
+def is_running(socket_path=DEF_SOCKET_PATH):
+    if not is_supported() or not os.path.exists(socket_path):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def listen(socket_path=DEF_SOCKET_PATH):
+    """Binds (and listens on) the daemon socket.
+
+    This is done before forking so that a later stage can never start
+    before the daemon is ready to take its request.
+    """
+    util.del_file(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        old_umask = os.umask(0o077)
+        try:
+            sock.bind(socket_path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(1)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def _recv_request(conn):
+    fds = array.array('i')
+    (buf, ancdata, _flags, _addr) = conn.recvmsg(
+        MAX_MESSAGE_SIZE, socket.CMSG_LEN(MAX_FDS * fds.itemsize))
+    for (level, kind, data) in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            data = data[:len(data) - (len(data) % fds.itemsize)]
+            fds.frombytes(data)
+    if not buf:
+        return (None, list(fds))
+    return (_read_message(conn, buf), list(fds))
+
+
+class _Redirected(object):
+    """Points this process' stdout/stderr at the given descriptors."""
+
+    def __init__(self, fds):
+        self.fds = fds
+        self.saved = []
+
+    def __enter__(self):
+        if len(self.fds) != MAX_FDS:
+            return self
+        self._flush()
+        for (target, fd) in zip((1, 2), self.fds):
+            self.saved.append((target, os.dup(target)))
+            os.dup2(fd, target)
+        return self
+
+    def __exit__(self, *exc):
+        self._flush()
+        for (target, saved) in self.saved:
+            os.dup2(saved, target)
+            os.close(saved)
+        self.saved = []
+
+    def _flush(self):
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except (AttributeError, ValueError, IOError):
+                pass
+
+
+def _exit_code(code):
+    # What the process would have exited with after sys.exit(code)
+    if code is None:
+        return 0
+    if isinstance(code, six.integer_types):
+        return int(code)
+    LOG.warn("Boot daemon request exited with %r", code)
+    try:
+        sys.stderr.write("%s\n" % (code,))
+        sys.stderr.flush()
+    except (IOError, ValueError):
+        pass
+    return 1
+
+
+def _handle(conn, handler):
+    (request, fds) = _recv_request(conn)
+    try:
+        if request is None:
+            # Nothing sent, somebody just checking if we are alive.
+            return True
+        if (not isinstance(request, dict) or
+                not isinstance(request.get('argv'), list)):
+            LOG.warn("Boot daemon received a malformed request: %s",
+                     request)
+            return True
+        argv = [str(a) for a in request['argv']]
+        LOG.debug("Boot daemon running %s", argv)
+        with _Redirected(fds):
+            try:
+                (exit_code, keep_serving) = handler(argv)
+            except SystemExit as e:
+                (exit_code, keep_serving) = (e.code, True)
+            except Exception:
+                util.logexc(LOG, "Boot daemon failed running %s", argv)
+                (exit_code, keep_serving) = (1, True)
+            exit_code = _exit_code(exit_code)
+        try:
+            _write_message(conn, {'exit': exit_code})
+        except socket.error as e:
+            LOG.warn("Boot daemon could not reply to %s: %s", argv, e)
+        return keep_serving
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def serve(sock, handler, idle_timeout=DEF_IDLE_TIMEOUT):
+    """Runs requests (one at a time) until told to stop or idle too long.
+
+    The handler is called with the argv of each request and returns
+    a tuple of (exit code, whether to keep serving).
+    """
+    socket_path = sock.getsockname()
+    if idle_timeout and idle_timeout > 0:
+        sock.settimeout(idle_timeout)
+    try:
+        while True:
+            try:
+                (conn, _addr) = sock.accept()
+            except socket.timeout:
+                LOG.warn("Boot daemon idle for %s seconds, exiting",
+                         idle_timeout)
+                return
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                conn.settimeout(None)
+                if not _handle(conn, handler):
+                    return
+            except (DaemonError, ValueError, socket.error):
+                util.logexc(LOG, "Boot daemon failed handling a request")
+            finally:
+                conn.close()
+    finally:
+        sock.close()
+        if socket_path:
+            util.del_file(socket_path)
+
+
+def spawn(sock, handler, idle_timeout=DEF_IDLE_TIMEOUT):
+    """Forks a daemon serving (the already listening) sock.
+
+    Returns the pid of the daemon in the calling process, the daemon itself
+    never returns from this.
+    """
+    pid = os.fork()
+    if pid:
+        sock.close()
+        LOG.debug("Started boot daemon %s on %s", pid, sock)
+        return pid
+    exit_code = 0
+    try:
+        os.setsid()
+        serve(sock, handler, idle_timeout=idle_timeout)
+    except Exception:
+        util.logexc(LOG, "Boot daemon failed")
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
@@ -19,6 +19,11 @@
 import functools
 import json
 
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
 from cloudinit import log as logging
 from cloudinit import url_helper
 from cloudinit import util
@@ -60,7 +65,8 @@ class MetadataLeafDecoder(object):
 # See: http://bit.ly/TyoUQs
 #
 class MetadataMaterializer(object):
-    def __init__(self, blob, base_url, caller, leaf_decoder=None):
+    def __init__(self, blob, base_url, caller, leaf_decoder=None,
+                 max_workers=1):
         self._blob = blob
         self._md = None
         self._base_url = base_url
@@ -69,6 +75,8 @@ class MetadataMaterializer(object):
             self._leaf_decoder = MetadataLeafDecoder()
         else:
             self._leaf_decoder = leaf_decoder
+        self._max_workers = max_workers
+        self._executor = None
 
     def _parse(self, blob):
         leaves = {}
@@ -113,22 +121,46 @@ class MetadataMaterializer(object):
     def materialize(self):
         if self._md is not None:
             return self._md
-        self._md = self._materialize(self._blob, self._base_url)
+        if self._max_workers > 1 and futures is None:
+            LOG.debug("Concurrent metadata crawl requested with %s workers,"
+                      " but concurrent.futures is not available; crawling"
+                      " serially", self._max_workers)
+        elif self._max_workers > 1:
+            self._executor = futures.ThreadPoolExecutor(self._max_workers)
+        try:
+            self._md = self._materialize(self._blob, self._base_url)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
         return self._md
 
+    def _fetch_all(self, urls):
+        # Siblings are fetched concurrently (when a pool exists), but the
+        # results (and the first raised exception) come back in the same
+        # order as a serial crawl would produce them.
+        if self._executor is None or len(urls) <= 1:
+            return [self._caller(url) for url in urls]
+        return list(self._executor.map(self._caller, urls))
+
     def _materialize(self, blob, base_url):
         (leaves, children) = self._parse(blob)
-        child_contents = {}
+        child_urls = []
         for c in children:
             child_url = url_helper.combine_url(base_url, c)
             if not child_url.endswith("/"):
                 child_url += "/"
-            child_blob = self._caller(child_url)
+            child_urls.append(child_url)
+        leaf_items = list(leaves.items())
+        leaf_urls = [url_helper.combine_url(base_url, resource)
+                     for (_field, resource) in leaf_items]
+        blobs = self._fetch_all(child_urls + leaf_urls)
+        child_contents = {}
+        for (c, child_url, child_blob) in zip(children, child_urls, blobs):
             child_contents[c] = self._materialize(child_blob, child_url)
         leaf_contents = {}
-        for (field, resource) in leaves.items():
-            leaf_url = url_helper.combine_url(base_url, resource)
-            leaf_blob = self._caller(leaf_url)
+        leaf_blobs = blobs[len(child_urls):]
+        for ((field, _resource), leaf_blob) in zip(leaf_items, leaf_blobs):
             leaf_contents[field] = self._leaf_decoder(field, leaf_blob)
         joined = {}
         joined.update(child_contents)
@@ -175,7 +207,7 @@ def get_instance_userdata(api_version='latest',
 def get_instance_metadata(api_version='latest',
                           metadata_address='http://169.254.169.254',
                           ssl_details=None, timeout=5, retries=5,
-                          leaf_decoder=None):
+                          leaf_decoder=None, max_workers=1):
     md_url = url_helper.combine_url(metadata_address, api_version)
     # Note, 'meta-data' explicitly has trailing /.
     # this is required for CloudStack (LP: #1356855)
@@ -191,7 +223,8 @@ def get_instance_metadata(api_version='latest',
         response = caller(md_url)
         materializer = MetadataMaterializer(response.contents,
                                             md_url, mcaller,
-                                            leaf_decoder=leaf_decoder)
+                                            leaf_decoder=leaf_decoder,
+                                            max_workers=max_workers)
         md = materializer.materialize()
         if not isinstance(md, (dict)):
             md = {}
@@ -20,9 +20,8 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import jsonpatch
-
 from cloudinit import handlers
+from cloudinit import importer
 from cloudinit import log as logging
 from cloudinit import mergers
 from cloudinit import util
@@ -31,6 +30,9 @@ from cloudinit.settings import (PER_ALWAYS)
 
 LOG = logging.getLogger(__name__)
 
+# Only needed for (the rarely used) cloud-config-jsonp parts
+jsonpatch = importer.lazy_import('jsonpatch')
+
 MERGE_HEADER = 'Merge-Type'
 
 # Due to the way the loading of yaml configuration was done previously,
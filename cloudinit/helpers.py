@@ -23,9 +23,15 @@
 from time import time
 
 import contextlib
+import copy
+import errno
+import fcntl
+import json
 import os
+import threading
 
 import six
+import yaml
 from six.moves.configparser import (
     NoSectionError, NoOptionError, RawConfigParser)
 
@@ -38,6 +44,12 @@ from cloudinit import util
 
 LOG = logging.getLogger(__name__)
 
+# The name (within a sem directory) of the index IndexedSemaphores keeps
+SEM_INDEX_NAME = '.index.json'
+
+# Bumped whenever the layout of that index changes
+SEM_INDEX_VERSION = 1
+
 
 class LockFailure(Exception):
     pass
@@ -58,6 +70,12 @@ class DummySemaphores(object):
     def has_run(self, _name, _freq):
         return False
 
+    def which_have_run(self, _items):
+        return set()
+
+    def sync(self):
+        pass
+
     def clear(self, _name, _freq):
         return True
 
@@ -77,6 +95,22 @@ def canon_sem_name(name):
     return name.replace("-", "_")
 
 
+def sem_marker_name(name, freq):
+    # What a semaphore is called (within its sem directory)
+    if not freq or freq == PER_INSTANCE:
+        return name
+    else:
+        return "%s.%s" % (name, freq)
+
+
+def _warn_uncanonicalized(name, cname):
+    LOG.warn("%s has run without canonicalized name [%s].\n"
+             "likely the migrator has not yet run. "
+             "It will run next boot.\n"
+             "run manually with: cloud-init single --name=migrator"
+             % (name, cname))
+
+
 class FileSemaphores(object):
     def __init__(self, sem_path):
         self.sem_path = sem_path
@@ -138,27 +172,224 @@ class FileSemaphores(object):
         # this case could happen if the migrator module hadn't run yet
         # but the item had run before we did canon_sem_name.
         if cname != name and os.path.exists(self._get_path(name, freq)):
-            LOG.warn("%s has run without canonicalized name [%s].\n"
-                     "likely the migrator has not yet run. "
-                     "It will run next boot.\n"
-                     "run manually with: cloud-init single --name=migrator"
-                     % (name, cname))
+            _warn_uncanonicalized(name, cname)
             return True
 
         return False
 
+    def which_have_run(self, items):
+        """The names of those (name, frequency) items that have run."""
+        return set(name for (name, freq) in items
+                   if self.has_run(name, freq))
+
+    def sync(self):
+        pass
+
     def _get_path(self, name, freq):
-        sem_path = self.sem_path
-        if not freq or freq == PER_INSTANCE:
-            return os.path.join(sem_path, name)
-        else:
-            return os.path.join(sem_path, "%s.%s" % (name, freq))
+        return os.path.join(self.sem_path, sem_marker_name(name, freq))
+
+
+class IndexLock(object):
+    def __init__(self, index_path, marker):
+        self.index_path = index_path
+        self.marker = marker
+
+    def __str__(self):
+        return "<%s using marker %r in %r>" % (
+            type_utils.obj_name(self), self.marker, self.index_path)
+
+
+class IndexedSemaphores(object):
+    """Keeps all the run markers of a sem directory in one index file.
+
+    Lookups are answered from memory. Changes are made under an flock of
+    the sem directory (so concurrent runs can not lose each other's
+    markers) and written out by atomically replacing the index, which
+    only gets fsynced by sync(). Any markers FileSemaphores left there
+    (as one file each) are taken into a newly created index.
+    """
+
+    def __init__(self, sem_path):
+        self.sem_path = sem_path
+        self.index_path = os.path.join(sem_path, SEM_INDEX_NAME)
+        self._markers = None
+        self._unsynced = False
+        self._lock = threading.RLock()
+
+    def _read(self):
+        try:
+            data = json.loads(util.load_file(self.index_path))
+            if data.get('version') != SEM_INDEX_VERSION:
+                raise ValueError("unknown version %s" % data.get('version'))
+            return dict(data['markers'])
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                util.logexc(LOG, "Failed reading semaphore index %s",
+                            self.index_path)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            LOG.warn("Rebuilding bad semaphore index %s: %s",
+                     self.index_path, e)
+        return self._migrate()
+
+    def _migrate(self):
+        markers = {}
+        if not os.path.isdir(self.sem_path):
+            return markers
+        for fname in os.listdir(self.sem_path):
+            path = os.path.join(self.sem_path, fname)
+            if fname.startswith(SEM_INDEX_NAME) or not os.path.isfile(path):
+                continue
+            markers[fname] = {'pid': None, 'time': os.path.getmtime(path)}
+        if markers:
+            LOG.debug("Took %s semaphore files in %s into its index",
+                      len(markers), self.sem_path)
+        return markers
+
+    def _write(self, markers):
+        content = json.dumps({'version': SEM_INDEX_VERSION,
+                              'markers': markers}, sort_keys=True)
+        tmp_path = "%s.%s" % (self.index_path, os.getpid())
+        util.write_file(tmp_path, content, mode=0o644)
+        os.rename(tmp_path, self.index_path)
+        self._unsynced = True
+
+    def _get_markers(self):
+        with self._lock:
+            if self._markers is None:
+                self._markers = self._read()
+            return self._markers
+
+    @contextlib.contextmanager
+    def _update(self):
+        # Re-read (and write back) the index while holding the lock, so
+        # that changes made by others in the meantime are kept.
+        with self._lock:
+            util.ensure_dir(self.sem_path)
+            dir_fd = os.open(self.sem_path, os.O_RDONLY)
+            try:
+                fcntl.flock(dir_fd, fcntl.LOCK_EX)
+                markers = self._read()
+                yield markers
+                self._write(markers)
+                self._markers = markers
+            finally:
+                os.close(dir_fd)
+
+    def has_run(self, name, freq):
+        if not freq or freq == PER_ALWAYS:
+            return False
+
+        cname = canon_sem_name(name)
+        markers = self._get_markers()
+        if sem_marker_name(cname, freq) in markers:
+            return True
+
+        if cname != name and sem_marker_name(name, freq) in markers:
+            _warn_uncanonicalized(name, cname)
+            return True
+
+        return False
+
+    def which_have_run(self, items):
+        """The names of those (name, frequency) items that have run."""
+        return set(name for (name, freq) in items
+                   if self.has_run(name, freq))
+
+    @contextlib.contextmanager
+    def lock(self, name, freq, clear_on_fail=False):
+        name = canon_sem_name(name)
+        try:
+            yield self._acquire(name, freq)
+        except Exception:
+            if clear_on_fail:
+                self.clear(name, freq)
+            raise
+
+    def _acquire(self, name, freq):
+        marker = sem_marker_name(name, freq)
+        try:
+            with self._update() as markers:
+                if marker in markers:
+                    return None
+                markers[marker] = {'pid': os.getpid(), 'time': time()}
+        except (IOError, OSError):
+            util.logexc(LOG, "Failed writing semaphore index %s",
+                        self.index_path)
+            return None
+        return IndexLock(self.index_path, marker)
+
+    def clear(self, name, freq):
+        name = canon_sem_name(name)
+        marker = sem_marker_name(name, freq)
+        try:
+            with self._update() as markers:
+                markers.pop(marker, None)
+            # Also any marker file from before the index was used
+            util.del_file(os.path.join(self.sem_path, marker))
+        except (IOError, OSError):
+            util.logexc(LOG, "Failed clearing semaphore %s in %s",
+                        marker, self.index_path)
+            return False
+        return True
+
+    def canonicalize(self):
+        """Renames markers to their canon_sem_name, returns how many."""
+        renamed = 0
+        if not os.path.isfile(self.index_path):
+            return renamed
+        with self._update() as markers:
+            for marker in list(markers):
+                (name, ext) = os.path.splitext(marker)
+                canon_name = canon_sem_name(name)
+                if canon_name != name:
+                    markers[canon_name + ext] = markers.pop(marker)
+                    renamed += 1
+        return renamed
+
+    def clear_all(self):
+        with self._lock:
+            self._markers = None
+            try:
+                util.del_dir(self.sem_path)
+            except (IOError, OSError):
+                util.logexc(LOG, "Failed deleting semaphore directory %s",
+                            self.sem_path)
+
+    def sync(self):
+        """Makes sure all changes made so far are on disk."""
+        with self._lock:
+            if not self._unsynced:
+                return
+            for path in (self.index_path, self.sem_path):
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            self._unsynced = False
+
+
+# How the semaphores (of which modules/handlers have run) are kept
+SEMAPHORE_BACKENDS = {
+    'file': FileSemaphores,
+    'index': IndexedSemaphores,
+}
 
 
 class Runners(object):
     def __init__(self, paths):
         self.paths = paths
         self.sems = {}
+        # Modules may be ran from multiple threads at once
+        self._sems_lock = threading.Lock()
+        backend = 'file'
+        if paths is not None:
+            backend = paths.cfgs.get('semaphore_backend', backend)
+        if backend not in SEMAPHORE_BACKENDS:
+            LOG.warn("Unknown semaphore backend '%s', using 'file'",
+                     backend)
+            backend = 'file'
+        self.sem_cls = SEMAPHORE_BACKENDS[backend]
 
     def _get_sem(self, freq):
         if freq == PER_ALWAYS or not freq:
@@ -175,9 +406,31 @@ class Runners(object):
             sem_path = self.paths.get_cpath("sem")
         if not sem_path:
             return None
-        if sem_path not in self.sems:
-            self.sems[sem_path] = FileSemaphores(sem_path)
-        return self.sems[sem_path]
+        with self._sems_lock:
+            if sem_path not in self.sems:
+                self.sems[sem_path] = self.sem_cls(sem_path)
+            return self.sems[sem_path]
+
+    def which_have_run(self, items):
+        """The names of those (name, frequency) items that have run."""
+        by_freq = {}
+        for (name, freq) in items:
+            by_freq.setdefault(freq, []).append((name, freq))
+        ran = set()
+        for (freq, freq_items) in by_freq.items():
+            sem = self._get_sem(freq)
+            if sem:
+                ran.update(sem.which_have_run(freq_items))
+        return ran
+
+    def sync(self):
+        with self._sems_lock:
+            sems = list(self.sems.values())
+        for sem in sems:
+            try:
+                sem.sync()
+            except (IOError, OSError):
+                util.logexc(LOG, "Failed syncing semaphores %s", sem)
 
     def run(self, name, functor, args, freq=None, clear_on_fail=False):
         sem = self._get_sem(freq)
@@ -287,6 +540,105 @@ class ConfigMerger(object):
         return self._cfg
 
 
+class ConfigView(dict):
+    """A private copy of a configuration that is cheap to hand out.
+
+    The top level dictionary belongs to whoever was given the view, but a
+    nested value is only deep copied from the source configuration the
+    first time it is looked up through the view. Sections that are never
+    looked at are never copied, while changes made through the view (at
+    any depth) never reach the source configuration or other views.
+
+    On python 2 dict(view) and {}.update(view) read the dictionary storage
+    directly (bypassing __iter__ and __getitem__), so there the whole
+    configuration is copied up front instead.
+    """
+
+    def __init__(self, source):
+        if six.PY2:
+            source = copy.deepcopy(source)
+        dict.__init__(self, source)
+        if six.PY2:
+            self._private_keys = set(dict.keys(self))
+        else:
+            self._private_keys = set()
+
+    def _lookup(self, key):
+        value = dict.__getitem__(self, key)
+        if key not in self._private_keys:
+            value = copy.deepcopy(value)
+            dict.__setitem__(self, key, value)
+            self._private_keys.add(key)
+        return value
+
+    def __getitem__(self, key):
+        return self._lookup(key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._private_keys.add(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._private_keys.discard(key)
+
+    def __iter__(self):
+        return iter(list(dict.keys(self)))
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self.items()), memo)
+
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self._lookup(key)
+        return default
+
+    def items(self):
+        return [(k, self._lookup(k)) for k in list(dict.keys(self))]
+
+    def values(self):
+        return [self._lookup(k) for k in list(dict.keys(self))]
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self._lookup(key)
+            dict.__delitem__(self, key)
+            self._private_keys.discard(key)
+            return value
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        for key in dict.keys(self):
+            return (key, self.pop(key))
+        raise KeyError('popitem(): dictionary is empty')
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self._lookup(key)
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        return dict(self.items())
+
+    if six.PY2:
+        def iteritems(self):
+            return iter(self.items())
+
+        def itervalues(self):
+            return iter(self.values())
+
+
+yaml.add_representer(ConfigView, yaml.SafeDumper.represent_dict,
+                     Dumper=yaml.SafeDumper)
+
+
 class ContentHandlers(object):
 
     def __init__(self):
@@ -344,6 +696,7 @@ class Paths(object):
             "userdata_raw": "user-data.txt",
             "userdata": "user-data.txt.i",
             "obj_pkl": "obj.pkl",
+            "obj_cache": "obj.json",
             "cloud_config": "cloud-config.txt",
             "vendor_cloud_config": "vendor-cloud-config.txt",
             "data": "data",
@@ -28,6 +28,53 @@ def import_module(module_name):
     return sys.modules[module_name]
 
 
+class LazyModule(object):
+    """Stands in for a module that is only imported on first use.
+
+    Any attribute access (or assignment) is passed through to the real
+    module, importing it first if that has not happened yet. This keeps
+    rarely needed (and slow to import) modules off of the startup path of
+    each stage.
+    """
+
+    def __init__(self, module_name):
+        self.__dict__['_lazy_name'] = module_name
+        self.__dict__['_lazy_module'] = None
+
+    def _lazy_load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = import_module(self.__dict__['_lazy_name'])
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._lazy_load(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._lazy_load(), name)
+
+    def __dir__(self):
+        return dir(self._lazy_load())
+
+    def __repr__(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            return "<lazy module %r>" % (self.__dict__['_lazy_name'])
+        return repr(module)
+
+
+def lazy_import(module_name):
+    """Returns the named module if it was already imported, otherwise a
+    LazyModule that will import it when it is first used."""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    return LazyModule(module_name)
+
+
 def find_module(base_name, search_paths, required_attrs=None):
     if not required_attrs:
         required_attrs = []
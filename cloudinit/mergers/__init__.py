@@ -31,6 +31,11 @@ DEF_MERGE_TYPE = "list()+dict()+str()"
 MERGER_PREFIX = 'm_'
 MERGER_ATTR = 'Merger'
 
+# Parsed merge strings and constructed mergers, keyed by their spec; the
+# mergers themselves keep no state between merges so they can be shared.
+_PARSED_MERGERS = {}
+_CONSTRUCTED_MERGERS = {}
+
 
 class UnknownMerger(object):
     # Named differently so auto-method finding
@@ -116,6 +121,15 @@ def dict_extract_mergers(config):
 
 
 def string_extract_mergers(merge_how):
+    parsed = _PARSED_MERGERS.get(merge_how)
+    if parsed is None:
+        parsed = tuple((m_name, tuple(m_ops)) for (m_name, m_ops)
+                       in _string_extract_mergers(merge_how))
+        _PARSED_MERGERS[merge_how] = parsed
+    return [(m_name, list(m_ops)) for (m_name, m_ops) in parsed]
+
+
+def _string_extract_mergers(merge_how):
     parsed_mergers = []
     for m_name in merge_how.split("+"):
         # Canonicalize the name (so that it can be found
@@ -141,6 +155,20 @@ def default_mergers():
 
 
 def construct(parsed_mergers):
+    try:
+        key = tuple((m_name, tuple(m_ops))
+                    for (m_name, m_ops) in parsed_mergers)
+        root = _CONSTRUCTED_MERGERS.get(key)
+    except TypeError:
+        # Unhashable options (from a merge_how dictionary), skip the cache.
+        return _construct(parsed_mergers)
+    if root is None:
+        root = _construct(parsed_mergers)
+        _CONSTRUCTED_MERGERS[key] = root
+    return root
+
+
+def _construct(parsed_mergers):
     mergers_to_be = []
     for (m_name, m_ops) in parsed_mergers:
         if not m_name.startswith(MERGER_PREFIX):
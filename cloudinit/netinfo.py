@@ -20,17 +20,151 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
+import os
 import re
+import socket
+import struct
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from cloudinit import importer
 from cloudinit import log as logging
 from cloudinit import util
 
-from prettytable import PrettyTable
+# Only needed when the tables are actually rendered
+prettytable = importer.lazy_import('prettytable')
 
 LOG = logging.getLogger()
 
+# Where the kernel tells what ifconfig/netstat would (on linux)
+SYS_CLASS_NET = "/sys/class/net"
+PROC_NET_ROUTE = "/proc/net/route"
+PROC_NET_IF_INET6 = "/proc/net/if_inet6"
+PROC_NET_INET6_SOCKETS = (("tcp6", "/proc/net/tcp6"),
+                          ("udp6", "/proc/net/udp6"))
+
+# From linux/sockios.h
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+SIOCGIFNETMASK = 0x891b
+
+IFF_UP = 0x1
+
+# Route flags (linux/route.h) in the order netstat shows them
+ROUTE_FLAGS = ((0x0001, 'U'), (0x0002, 'G'), (0x0200, '!'), (0x0004, 'H'),
+               (0x0008, 'R'), (0x0010, 'D'), (0x0020, 'M'))
+
+# How ifconfig names the scope of ipv6 addresses (include/net/ipv6.h)
+IPV6_SCOPES = {0x00: 'global', 0x10: 'host', 0x20: 'link', 0x40: 'site',
+               0x80: 'compat'}
+
+# Socket states as netstat names them (include/net/tcp_states.h)
+TCP_STATES = {
+    0x01: 'ESTABLISHED', 0x02: 'SYN_SENT', 0x03: 'SYN_RECV',
+    0x04: 'FIN_WAIT1', 0x05: 'FIN_WAIT2', 0x06: 'TIME_WAIT', 0x07: 'CLOSE',
+    0x08: 'CLOSE_WAIT', 0x09: 'LAST_ACK', 0x0A: 'LISTEN', 0x0B: 'CLOSING',
+}
+
+
+def _kernel_info_available():
+    return (fcntl is not None and os.path.isdir(SYS_CLASS_NET) and
+            os.path.isfile(PROC_NET_ROUTE))
+
+
+def _fill_empty(devs, empty):
+    if empty != "":
+        for (_devname, dev) in devs.items():
+            for field in dev:
+                if dev[field] == "":
+                    dev[field] = empty
+    return devs
+
 
 def netdev_info(empty=""):
+    devs = None
+    if _kernel_info_available():
+        try:
+            devs = _netdev_info_kernel()
+        except (IOError, OSError, ValueError):
+            util.logexc(LOG, "Reading net device info from %s failed,"
+                        " using ifconfig", SYS_CLASS_NET)
+    if devs is None:
+        devs = _netdev_info_ifconfig()
+    return _fill_empty(devs, empty)
+
+
+def _ipv4_ioctl(sock, devname, request):
+    ifreq = struct.pack('256s', devname[:15].encode('utf-8'))
+    try:
+        result = fcntl.ioctl(sock.fileno(), request, ifreq)
+    except IOError as e:
+        # No (ipv4) address assigned to it
+        if e.errno in (errno.EADDRNOTAVAIL, errno.ENODEV, errno.EINVAL):
+            return ""
+        raise
+    # Skip the name (16 bytes) and the family and port of the sockaddr_in
+    return socket.inet_ntoa(result[20:24])
+
+
+def _read_sys_net(devname, name):
+    return util.load_file(
+        os.path.join(SYS_CLASS_NET, devname, name)).strip()
+
+
+def _ipv6_addresses():
+    # The first address of each device, like ifconfig shows first
+    addresses = {}
+    if not os.path.isfile(PROC_NET_IF_INET6):
+        return addresses
+    for line in util.load_file(PROC_NET_IF_INET6).splitlines():
+        toks = line.split()
+        if len(toks) < 6 or toks[5] in addresses:
+            continue
+        addr = socket.inet_ntop(socket.AF_INET6,
+                                bytes(bytearray.fromhex(toks[0])))
+        scope = int(toks[3], 16)
+        addresses[toks[5]] = {
+            'addr6': "%s/%s" % (addr, int(toks[2], 16)),
+            'scope6': IPV6_SCOPES.get(scope & 0xf0, 'unknown'),
+        }
+    return addresses
+
+
+def _netdev_info_kernel():
+    devs = {}
+    ipv6 = _ipv6_addresses()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for devname in sorted(os.listdir(SYS_CLASS_NET)):
+            flags = int(_read_sys_net(devname, "flags"), 16)
+            hwaddr = _read_sys_net(devname, "address").lower()
+            if not hwaddr.replace("0", "").replace(":", ""):
+                # ifconfig does not show one for loopback (and the like)
+                hwaddr = ""
+            dev = {
+                'up': bool(flags & IFF_UP),
+                'hwaddr': hwaddr,
+                'addr': _ipv4_ioctl(sock, devname, SIOCGIFADDR),
+                'bcast': "",
+                'mask': "",
+            }
+            if dev['addr']:
+                dev['bcast'] = _ipv4_ioctl(sock, devname, SIOCGIFBRDADDR)
+                dev['mask'] = _ipv4_ioctl(sock, devname, SIOCGIFNETMASK)
+                if dev['bcast'] == "0.0.0.0":
+                    dev['bcast'] = ""
+            dev.update(ipv6.get(devname, {}))
+            devs[devname] = dev
+    finally:
+        sock.close()
+    return devs
+
+
+def _netdev_info_ifconfig():
     fields = ("hwaddr", "addr", "bcast", "mask")
     (ifcfg_out, _err) = util.subp(["ifconfig", "-a"])
     devs = {}
@@ -87,16 +221,102 @@ def netdev_info(empty=""):
                 elif toks[i].startswith("%s" % origfield):
                     devs[curdev][target] = toks[i][len(field) + 1:]
 
-    if empty != "":
-        for (_devname, dev) in devs.items():
-            for field in dev:
-                if dev[field] == "":
-                    dev[field] = empty
-
     return devs
 
 
 def route_info():
+    if _kernel_info_available():
+        try:
+            return _route_info_kernel()
+        except (IOError, OSError, ValueError):
+            util.logexc(LOG, "Reading route info from %s failed, using"
+                        " netstat", PROC_NET_ROUTE)
+    return _route_info_netstat()
+
+
+def _hex_ipv4(value):
+    # Written out in host byte order
+    return socket.inet_ntoa(struct.pack('=I', int(value, 16)))
+
+
+def _hex_ipv6(value):
+    # Four 32 bit words, each in host byte order
+    packed = b''.join(struct.pack('=I', int(value[i:i + 8], 16))
+                      for i in range(0, 32, 8))
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def _route_flags(flags):
+    return "".join(c for (bit, c) in ROUTE_FLAGS if flags & bit)
+
+
+def _ipv4_routes():
+    routes = []
+    lines = util.load_file(PROC_NET_ROUTE).splitlines()
+    header = lines[0].split() if lines else []
+    for line in lines[1:]:
+        toks = dict(zip(header, line.split()))
+        if not toks:
+            continue
+        flags = int(toks['Flags'], 16)
+        if not flags & 0x0001:
+            # Like netstat, only routes that are up
+            continue
+        routes.append({
+            'destination': _hex_ipv4(toks['Destination']),
+            'gateway': _hex_ipv4(toks['Gateway']),
+            'genmask': _hex_ipv4(toks['Mask']),
+            'flags': _route_flags(flags),
+            'metric': toks['Metric'],
+            'ref': toks['RefCnt'],
+            'use': toks['Use'],
+            'iface': toks['Iface'],
+        })
+    return routes
+
+
+def _ipv6_endpoint(value):
+    (addr, port) = value.split(":")
+    port = int(port, 16)
+    return "%s:%s" % (_hex_ipv6(addr), port if port else "*")
+
+
+def _ipv6_sockets():
+    # What 'netstat -A inet6 -n' lists: the tcp sockets that are not
+    # listening and the udp ones that are connected.
+    sockets = []
+    for (proto, path) in PROC_NET_INET6_SOCKETS:
+        if not os.path.isfile(path):
+            continue
+        for line in util.load_file(path).splitlines()[1:]:
+            toks = line.split()
+            if len(toks) < 5:
+                continue
+            state = TCP_STATES.get(int(toks[3], 16), 'UNKNOWN')
+            if proto == "tcp6" and state == 'LISTEN':
+                continue
+            if proto == "udp6" and state != 'ESTABLISHED':
+                continue
+            (send_q, recv_q) = toks[4].split(":")
+            sockets.append({
+                'proto': proto,
+                'recv-q': str(int(recv_q, 16)),
+                'send-q': str(int(send_q, 16)),
+                'local address': _ipv6_endpoint(toks[1]),
+                'foreign address': _ipv6_endpoint(toks[2]),
+                'state': state,
+            })
+    return sockets
+
+
+def _route_info_kernel():
+    return {
+        'ipv4': _ipv4_routes(),
+        'ipv6': _ipv6_sockets(),
+    }
+
+
+def _route_info_netstat():
     (route_out, _err) = util.subp(["netstat", "-rn"])
 
     routes = {}
@@ -181,7 +401,7 @@ def netdev_pformat():
         lines.append(util.center("Net device info failed", '!', 80))
     else:
         fields = ['Device', 'Up', 'Address', 'Mask', 'Scope', 'Hw-Address']
-        tbl = PrettyTable(fields)
+        tbl = prettytable.PrettyTable(fields)
         for (dev, d) in netdev.items():
             tbl.add_row([dev, d["up"], d["addr"], d["mask"], ".", d["hwaddr"]])
             if d.get('addr6'):
@@ -205,7 +425,7 @@ def route_pformat():
         if routes.get('ipv4'):
             fields_v4 = ['Route', 'Destination', 'Gateway',
                          'Genmask', 'Interface', 'Flags']
-            tbl_v4 = PrettyTable(fields_v4)
+            tbl_v4 = prettytable.PrettyTable(fields_v4)
             for (n, r) in enumerate(routes.get('ipv4')):
                 route_id = str(n)
                 tbl_v4.add_row([route_id, r['destination'],
@@ -218,7 +438,7 @@ def route_pformat():
         if routes.get('ipv6'):
             fields_v6 = ['Route', 'Proto', 'Recv-Q', 'Send-Q',
                          'Local Address', 'Foreign Address', 'State']
-            tbl_v6 = PrettyTable(fields_v6)
+            tbl_v6 = prettytable.PrettyTable(fields_v6)
             for (n, r) in enumerate(routes.get('ipv6')):
                 route_id = str(n)
                 tbl_v6.add_row([route_id, r['proto'],
@@ -13,6 +13,7 @@ from .handlers import available_handlers
 
 DEFAULT_CONFIG = {
     'logging': {'type': 'log'},
+    'timing': {'type': 'timing'},
 }
 
 
@@ -25,6 +26,11 @@ def update_configuration(config):
         will be unregistered.
     """
     for handler_name, handler_config in config.items():
+        # Whatever the replaced handler still had queued up is sent first
+        replaced = instantiated_handler_registry.registered_items.get(
+            handler_name)
+        if replaced is not None:
+            replaced.flush()
         if not handler_config:
             instantiated_handler_registry.unregister_item(
                 handler_name, force=True)
@@ -36,6 +42,16 @@ def update_configuration(config):
         instantiated_handler_registry.register_item(handler_name, instance)
 
 
+def flush_events():
+    """Wait for all handlers to finish publishing events.
+
+    Handlers that publish in the background only get to finish doing so
+    if this is called before cloud-init exits.
+    """
+    for handler in instantiated_handler_registry.registered_items.values():
+        handler.flush()
+
+
 instantiated_handler_registry = DictRegistry()
 update_configuration(DEFAULT_CONFIG)
 
@@ -18,6 +18,13 @@ START_EVENT_TYPE = 'start'
 
 DEFAULT_EVENT_ORIGIN = 'cloudinit'
 
+# Durations are measured with a clock that is not affected by the wall
+# clock being stepped (which is common early in boot, once ntp runs)
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# When each started (but not yet finished) event started, by event name
+_started = {}
+
 
 class _nameset(set):
     def __getattr__(self, name):
@@ -41,6 +48,7 @@ class ReportingEvent(object):
         if timestamp is None:
             timestamp = time.time()
         self.timestamp = timestamp
+        self.monotonic = _monotonic()
 
     def as_string(self):
         """The event represented as a string."""
@@ -57,10 +65,11 @@ class ReportingEvent(object):
 class FinishReportingEvent(ReportingEvent):
 
     def __init__(self, name, description, result=status.SUCCESS,
-                 post_files=None):
+                 post_files=None, duration=None):
         super(FinishReportingEvent, self).__init__(
             FINISH_EVENT_TYPE, name, description)
         self.result = result
+        self.duration = duration
         if post_files is None:
             post_files = []
         self.post_files = post_files
@@ -75,6 +84,8 @@ class FinishReportingEvent(ReportingEvent):
         """The event represented as json friendly."""
         data = super(FinishReportingEvent, self).as_dict()
         data['result'] = self.result
+        if self.duration is not None:
+            data['duration'] = self.duration
         if self.post_files:
             data['files'] = _collect_file_info(self.post_files)
         return data
@@ -102,6 +113,9 @@ def report_finish_event(event_name, event_description,
     """
     event = FinishReportingEvent(event_name, event_description, result,
                                  post_files=post_files)
+    started = _started.pop(event_name, None)
+    if started is not None:
+        event.duration = round(event.monotonic - started, 6)
     return report_event(event)
 
 
@@ -116,6 +130,7 @@ def report_start_event(event_name, event_description):
         A human-readable description of the event that has occurred.
     """
     event = ReportingEvent(START_EVENT_TYPE, event_name, event_description)
+    _started[event_name] = event.monotonic
     return report_event(event)
 
 
@@ -1,16 +1,50 @@
 # vi: ts=4 expandtab
 
 import abc
+import collections
 import json
+import os
 import six
+import threading
+import time
 
 from cloudinit import log as logging
 from cloudinit.registry import DictRegistry
 from cloudinit import (url_helper, util)
+from cloudinit.settings import BOOT_TIMING_FILE
 
 
 LOG = logging.getLogger(__name__)
 
+# How many events a webhook handler keeps around waiting to be sent
+DEF_WEBHOOK_QUEUE_SIZE = 1000
+
+# How long publishing an event waits for room in a full webhook queue
+# (when the full_policy is 'block')
+DEF_WEBHOOK_BLOCK_TIMEOUT = 5
+
+# How long flushing (at the end of each stage) waits for the queued up
+# webhook events to be sent
+DEF_WEBHOOK_FLUSH_TIMEOUT = 10
+
+WEBHOOK_FULL_POLICIES = ('drop', 'block')
+
+
+def _wait_for(cond, predicate, timeout=None):
+    # Like Condition.wait_for (which python 2 does not have), cond must
+    # already be held.
+    if timeout is not None:
+        deadline = time.time() + timeout
+    while not predicate():
+        if timeout is None:
+            cond.wait()
+            continue
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        cond.wait(remaining)
+    return True
+
 
 @six.add_metaclass(abc.ABCMeta)
 class ReportingHandler(object):
@@ -24,6 +58,13 @@ class ReportingHandler(object):
     def publish_event(self, event):
         """Publish an event."""
 
+    def flush(self, timeout=None):
+        """Finish publishing any events that are still pending.
+
+        Returns False when that did not happen within timeout seconds.
+        """
+        return True
+
 
 class LogHandler(ReportingHandler):
     """Publishes events to the cloud-init log at the ``DEBUG`` log level."""
@@ -55,9 +96,23 @@ class PrintHandler(ReportingHandler):
 
 
 class WebHookHandler(ReportingHandler):
+    """Posts events (as json) to an http endpoint.
+
+    Unless asynchronous is false, events are queued up and posted by
+    a background thread so that the boot does not wait on the endpoint.
+    Up to batch_size queued events are sent per post (as a json list of
+    events, a single event is posted on its own when batch_size is 1).
+    Once queue_size events are waiting, new events are dropped (or, with
+    a full_policy of 'block', wait up to block_timeout seconds for room).
+    Flushing waits up to flush_timeout seconds for the queue to empty.
+    """
+
     def __init__(self, endpoint, consumer_key=None, token_key=None,
                  token_secret=None, consumer_secret=None, timeout=None,
-                 retries=None):
+                 retries=None, asynchronous=True, batch_size=1,
+                 queue_size=DEF_WEBHOOK_QUEUE_SIZE, full_policy='drop',
+                 block_timeout=DEF_WEBHOOK_BLOCK_TIMEOUT,
+                 flush_timeout=DEF_WEBHOOK_FLUSH_TIMEOUT):
         super(WebHookHandler, self).__init__()
 
         if any([consumer_key, token_key, token_secret, consumer_secret]):
@@ -70,22 +125,164 @@ class WebHookHandler(ReportingHandler):
         self.timeout = timeout
         self.retries = retries
         self.ssl_details = util.fetch_ssl_details()
+        self.asynchronous = asynchronous
+        self.batch_size = max(1, int(batch_size))
+        self.queue_size = max(1, int(queue_size))
+        if full_policy not in WEBHOOK_FULL_POLICIES:
+            LOG.warn("invalid full_policy '%s', using 'drop'", full_policy)
+            full_policy = 'drop'
+        self.full_policy = full_policy
+        self.block_timeout = block_timeout
+        self.flush_timeout = flush_timeout
+        # Counters (of events) for how the sending went
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._reset_sender()
 
-    def publish_event(self, event):
+    def _reset_sender(self):
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._in_flight = 0
+        self._sender = None
+        self._sender_pid = None
+
+    def _post(self, data):
         if self.oauth_helper:
             readurl = self.oauth_helper.readurl
         else:
             readurl = url_helper.readurl
+        return readurl(
+            self.endpoint, data=json.dumps(data),
+            timeout=self.timeout,
+            retries=self.retries, ssl_details=self.ssl_details)
+
+    def _post_batch(self, batch):
+        if self.batch_size == 1:
+            data = batch[0].as_dict()
+        else:
+            data = [event.as_dict() for event in batch]
         try:
-            return readurl(
-                self.endpoint, data=json.dumps(event.as_dict()),
-                timeout=self.timeout,
-                retries=self.retries, ssl_details=self.ssl_details)
+            self._post(data)
+            return True
         except Exception:
-            LOG.warn("failed posting event: %s" % event.as_string())
+            for event in batch:
+                LOG.warn("failed posting event: %s" % event.as_string())
+            return False
+
+    def publish_event(self, event):
+        if not self.asynchronous:
+            if self._post_batch([event]):
+                self.sent += 1
+            else:
+                self.failed += 1
+            return
+        with self._lock_sender():
+            if len(self._queue) >= self.queue_size:
+                if self.full_policy == 'block':
+                    _wait_for(
+                        self._cond,
+                        lambda: len(self._queue) < self.queue_size,
+                        self.block_timeout)
+                if len(self._queue) >= self.queue_size:
+                    self.dropped += 1
+                    LOG.debug("webhook queue full, dropped event: %s",
+                              event.as_string())
+                    return
+            self._queue.append(event)
+            self._cond.notify_all()
+
+    def _lock_sender(self):
+        # The sender thread does not survive a fork (the boot daemon is
+        # forked off after the local stage), so start a new one.
+        if self._sender_pid != os.getpid():
+            self._reset_sender()
+        if self._sender is None:
+            self._sender_pid = os.getpid()
+            self._sender = threading.Thread(target=self._send_events,
+                                            name='webhook-sender')
+            # Anything not sent by the time cloud-init exits (without
+            # flushing) is lost rather than holding the boot up.
+            self._sender.daemon = True
+            self._sender.start()
+        return self._cond
+
+    def _send_events(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                batch = []
+                while self._queue and len(batch) < self.batch_size:
+                    batch.append(self._queue.popleft())
+                self._in_flight = len(batch)
+                self._cond.notify_all()
+            ok = self._post_batch(batch)
+            with self._cond:
+                if ok:
+                    self.sent += len(batch)
+                else:
+                    self.failed += len(batch)
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Waits for all queued events to be sent (or fail to be).
+
+        Returns False if they were not all sent in timeout (by default
+        flush_timeout) seconds.
+        """
+        if not self.asynchronous or self._sender is None:
+            return True
+        if timeout is None:
+            timeout = self.flush_timeout
+        with self._lock_sender():
+            done = _wait_for(
+                self._cond, lambda: not self._queue and not self._in_flight,
+                timeout)
+            LOG.debug("webhook events sent: %s, failed: %s, dropped: %s,"
+                      " still queued: %s", self.sent, self.failed,
+                      self.dropped, len(self._queue) + self._in_flight)
+        return done
+
+
+class TimingHandler(ReportingHandler):
+    """Records how long each finished event took.
+
+    One json object per line is appended to the given file (which is
+    only written to when its directory already exists).
+    """
+
+    def __init__(self, path=BOOT_TIMING_FILE):
+        super(TimingHandler, self).__init__()
+        self.path = path
+
+    def publish_event(self, event):
+        duration = getattr(event, 'duration', None)
+        if duration is None:
+            # Start events (or a finish without a matching start)
+            return
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return
+        record = {
+            'name': event.name,
+            'description': event.description,
+            'result': event.result,
+            'start': event.timestamp - duration,
+            'duration': duration,
+        }
+        try:
+            # Each record is written in one go (in append mode) so that
+            # records from concurrent writers do not get interleaved.
+            with open(self.path, 'a') as fh:
+                fh.write(json.dumps(record, sort_keys=True) + "\n")
+        except (IOError, OSError) as e:
+            LOG.debug("Failed recording timing of %s in %s: %s",
+                      event.name, self.path, e)
 
 
 available_handlers = DictRegistry()
 available_handlers.register_item('log', LogHandler)
 available_handlers.register_item('print', PrintHandler)
 available_handlers.register_item('webhook', WebHookHandler)
+available_handlers.register_item('timing', TimingHandler)
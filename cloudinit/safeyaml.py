@@ -19,14 +19,40 @@
 import yaml
 
 
-class _CustomSafeLoader(yaml.SafeLoader):
+class _PythonUnicodeMixin(object):
     def construct_python_unicode(self, node):
         return self.construct_scalar(node)
 
+
+class _CustomSafeLoader(_PythonUnicodeMixin, yaml.SafeLoader):
+    pass
+
 _CustomSafeLoader.add_constructor(
     u'tag:yaml.org,2002:python/unicode',
     _CustomSafeLoader.construct_python_unicode)
 
 
+# The libyaml backed loader only replaces the (pure python) reader, scanner
+# and parser; construction of python objects is shared with the above, so
+# both produce the same objects for the same document.
+if getattr(yaml, '__with_libyaml__', False):
+    class _CustomCSafeLoader(_PythonUnicodeMixin, yaml.CSafeLoader):
+        pass
+
+    _CustomCSafeLoader.add_constructor(
+        u'tag:yaml.org,2002:python/unicode',
+        _CustomCSafeLoader.construct_python_unicode)
+else:
+    _CustomCSafeLoader = None
+
+
 def load(blob):
+    if _CustomCSafeLoader is not None:
+        try:
+            return yaml.load(blob, Loader=_CustomCSafeLoader)
+        except yaml.YAMLError:
+            # libyaml is stricter about a few corner cases than the python
+            # parser; let the python parser have the final say so that
+            # what is accepted (and the error raised) does not change.
+            pass
     return(yaml.load(blob, Loader=_CustomSafeLoader))
@@ -26,6 +26,17 @@ CFG_ENV_NAME = "CLOUD_CFG"
 # This is expected to be a yaml formatted file
 CLOUD_CONFIG = '/etc/cloud/cloud.cfg'
 
+# Where the parsed (and merged) form of the above (and its conf.d files)
+# is cached between boot stages
+CLOUD_CONFIG_CACHE = '/run/cloud-init/cloud.cfg.json'
+
+# Where how long each reported event took is recorded (one json
+# object per line), this is what 'cloud-init analyze' reads
+BOOT_TIMING_FILE = '/run/cloud-init/boot-timing.json'
+
+# Where the DMI data read by the first boot stage is kept for later ones
+DMI_CACHE = '/run/cloud-init/dmi.json'
+
 # What u get if no config is provided
 CFG_BUILTIN = {
     'datasource_list': [
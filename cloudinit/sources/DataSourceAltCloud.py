@@ -130,6 +130,13 @@ class DataSourceAltCloud(sources.DataSource):
 
         return 'UNKNOWN'
 
+    def detect(self):
+        if os.path.exists(CLOUD_INFO_FILE):
+            return sources.DETECT_MAYBE
+        if self.get_cloud_type() == 'UNKNOWN':
+            return sources.DETECT_NO
+        return sources.DETECT_YES
+
     def get_data(self):
         '''
         Description:
@@ -196,6 +203,7 @@ class DataSourceAltCloud(sources.DataSource):
         return_str = None
 
         # modprobe floppy
+        self.check_cancelled()
         try:
             cmd = CMD_PROBE_FLOPPY
             (cmd_out, _err) = util.subp(cmd)
@@ -226,6 +234,7 @@ class DataSourceAltCloud(sources.DataSource):
                         _err.message)
             return False
 
+        self.check_cancelled()
         try:
             return_str = util.mount_cb(floppy_dev, read_user_data_callback)
         except OSError as err:
@@ -260,6 +269,7 @@ class DataSourceAltCloud(sources.DataSource):
         return_str = None
         cdrom_list = util.find_devs_with('LABEL=CDROM')
         for cdrom_dev in cdrom_list:
+            self.check_cancelled()
             try:
                 return_str = util.mount_cb(cdrom_dev, read_user_data_callback)
                 if return_str:
@@ -279,6 +289,11 @@ class DataSourceAltCloud(sources.DataSource):
         else:
             return False
 
+    def cleanup_probe(self):
+        self.seed = None
+        self.metadata = {}
+        self.userdata_raw = None
+
 # Used to match classes to dependencies
 # Source DataSourceAltCloud does not really depend on networking.
 # In the future 'dsmode' like behavior can be added to offer user
@@ -18,6 +18,7 @@
 
 import base64
 import contextlib
+import copy
 import crypt
 import fnmatch
 import os
@@ -114,9 +115,10 @@ class DataSourceAzureNet(sources.DataSource):
         self.seed_dir = os.path.join(paths.seed_dir, 'azure')
         self.cfg = {}
         self.seed = None
+        # (a copy, as get_data changes the disk aliases in it)
         self.ds_cfg = util.mergemanydict([
             util.get_cfg_by_path(sys_cfg, DS_CFG_PATH, {}),
-            BUILTIN_DS_CONFIG])
+            copy.deepcopy(BUILTIN_DS_CONFIG)])
         self.cloud_data_dir = paths.get_cpath('data')
 
     def __str__(self):
@@ -224,6 +226,10 @@ class DataSourceAzureNet(sources.DataSource):
         user_ds_cfg = util.get_cfg_by_path(self.cfg, DS_CFG_PATH, {})
         self.ds_cfg = util.mergemanydict([user_ds_cfg, self.ds_cfg])
 
+        # Everything from here on changes the system (files, hostname
+        # bounce, the agent) so is not done by a probe that lost a race.
+        self.check_cancelled()
+
         # walinux agent writes files world readable, but expects
         # the directory to be protected.
         write_files(ddir, files, dirmode=0o700)
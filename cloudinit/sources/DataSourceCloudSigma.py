@@ -66,6 +66,11 @@ class DataSourceCloudSigma(sources.DataSource):
         LOG.warn("failed to query dmi data for system product name")
         return False
 
+    def detect(self):
+        if self.is_running_in_cloudsigma():
+            return sources.DETECT_YES
+        return sources.DETECT_NO
+
     def get_data(self):
         """
         Metadata is the whole server context and /meta/cloud-config is used
@@ -75,6 +80,7 @@ class DataSourceCloudSigma(sources.DataSource):
         if not self.is_running_in_cloudsigma():
             return False
 
+        self.check_cancelled()
         try:
             server_context = self.cepko.all().result
             server_meta = server_context['meta']
@@ -103,6 +109,12 @@ class DataSourceCloudSigma(sources.DataSource):
 
         return True
 
+    def cleanup_probe(self):
+        self.metadata = {}
+        self.userdata_raw = None
+        self.vendordata_raw = None
+        self.ssh_public_key = ''
+
     def get_hostname(self, fqdn=False, resolve_ip=False):
         """
         Cleans up and uses the server's name if the latter is set. Otherwise
@@ -61,6 +61,13 @@ class DataSourceConfigDrive(openstack.SourceMixin, sources.DataSource):
         mstr += "[source=%s]" % (self.source)
         return mstr
 
+    def detect(self):
+        if os.path.isdir(self.seed_dir):
+            return sources.DETECT_YES
+        if not find_candidate_devs():
+            return sources.DETECT_NO
+        return sources.DETECT_MAYBE
+
     def get_data(self):
         found = None
         md = {}
@@ -82,6 +89,7 @@ class DataSourceConfigDrive(openstack.SourceMixin, sources.DataSource):
                     else:
                         mtype = None
                         sync = True
+                    self.check_cancelled()
                     results = util.mount_cb(dev, read_config_drive,
                                             mtype=mtype, sync=sync)
                     found = dev
@@ -120,6 +128,7 @@ class DataSourceConfigDrive(openstack.SourceMixin, sources.DataSource):
         prev_iid = get_previous_iid(self.paths)
         cur_iid = md['instance-id']
         if prev_iid != cur_iid and self.dsmode == "local":
+            self.check_cancelled()
             on_first_boot(results, distro=self.distro)
 
         # dsmode != self.dsmode here if:
@@ -155,6 +164,17 @@ class DataSourceConfigDrive(openstack.SourceMixin, sources.DataSource):
 
         return True
 
+    def cleanup_probe(self):
+        # Forget what was read (the injected files may be large)
+        self.source = None
+        self.metadata = {}
+        self.ec2_metadata = None
+        self.userdata_raw = None
+        self.vendordata_pure = None
+        self.vendordata_raw = None
+        self.network_json = None
+        self.files = {}
+
     def check_instance_id(self, sys_cfg):
         # quickly (local check only) if self.instance_id is still valid
         return sources.instance_id_matches_system_uuid(self.get_instance_id())
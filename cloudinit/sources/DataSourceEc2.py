@@ -41,6 +41,10 @@ DEF_MD_VERSION = '2009-04-04'
 # following may be discarded if they do not resolve
 DEF_MD_URLS = [DEF_MD_URL, "http://instance-data.:8773"]
 
+# How many metadata requests may be in flight at once while crawling
+# the meta-data tree (1 means a serial crawl)
+DEF_CRAWL_WORKERS = 1
+
 
 class DataSourceEc2(sources.DataSource):
     def __init__(self, sys_cfg, distro, paths):
@@ -63,8 +67,9 @@ class DataSourceEc2(sources.DataSource):
             start_time = time.time()
             self.userdata_raw = \
                 ec2.get_instance_userdata(self.api_ver, self.metadata_address)
-            self.metadata = ec2.get_instance_metadata(self.api_ver,
-                                                      self.metadata_address)
+            self.metadata = ec2.get_instance_metadata(
+                self.api_ver, self.metadata_address,
+                max_workers=self._get_crawl_workers())
             LOG.debug("Crawl of metadata service took %s seconds",
                       int(time.time() - start_time))
             return True
@@ -98,6 +103,16 @@ class DataSourceEc2(sources.DataSource):
 
         return (max_wait, timeout)
 
+    def _get_crawl_workers(self):
+        crawl_workers = DEF_CRAWL_WORKERS
+        try:
+            crawl_workers = max(1, int(self.ds_cfg.get("crawl_workers",
+                                                       crawl_workers)))
+        except Exception:
+            util.logexc(LOG, "Failed to get crawl workers, using %s",
+                        crawl_workers)
+        return crawl_workers
+
     def wait_for_metadata_service(self):
         mcfg = self.ds_cfg
 
@@ -127,8 +142,11 @@ class DataSourceEc2(sources.DataSource):
             url2base[cur] = url
 
         start_time = time.time()
+        concurrent = util.get_cfg_option_bool(mcfg, "race_metadata_urls",
+                                              False)
         url = uhelp.wait_for_url(urls=urls, max_wait=max_wait,
-                                 timeout=timeout, status_cb=LOG.warn)
+                                 timeout=timeout, status_cb=LOG.warn,
+                                 concurrent=concurrent)
 
         if url:
             LOG.debug("Using metadata source: '%s'", url2base[url])
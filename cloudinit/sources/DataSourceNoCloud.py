@@ -112,6 +112,7 @@ class DataSourceNoCloud(sources.DataSource):
                 try:
                     LOG.debug("Attempting to use data from %s", dev)
 
+                    self.check_cancelled()
                     try:
                         seeded = util.mount_cb(dev, _pp2d_callback,
                                                pp2d_kwargs)
@@ -166,6 +167,7 @@ class DataSourceNoCloud(sources.DataSource):
 
             # This could throw errors, but the user told us to do it
             # so if errors are raised, let them raise
+            self.check_cancelled()
             (md_seed, ud) = util.read_seeded(seedfrom, timeout=None)
             LOG.debug("Using seeded cache data from %s", seedfrom)
 
@@ -194,6 +196,7 @@ class DataSourceNoCloud(sources.DataSource):
         if self.dsmode in ("local", seeded_network):
             if mydata['meta-data'].get('network-interfaces'):
                 LOG.debug("Updating network interfaces from %s", self)
+                self.check_cancelled()
                 self.distro.apply_network(
                     mydata['meta-data']['network-interfaces'])
 
@@ -209,6 +212,13 @@ class DataSourceNoCloud(sources.DataSource):
                   mydata['meta-data']['dsmode'])
         return False
 
+    def cleanup_probe(self):
+        self.seed = None
+        self.metadata = {}
+        self.userdata_raw = None
+        self.vendordata_raw = None
+        self._network_config = None
+
     def check_instance_id(self, sys_cfg):
         # quickly (local check only) if self.instance_id is still valid
         # we check kernel command line or files.
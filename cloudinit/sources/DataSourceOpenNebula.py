@@ -71,6 +71,7 @@ class DataSourceOpenNebula(sources.DataSource):
                 if os.path.isdir(self.seed_dir):
                     results = read_context_disk_dir(cdev, asuser=parseuser)
                 elif cdev.startswith("/dev"):
+                    self.check_cancelled()
                     results = util.mount_cb(cdev, read_context_disk_dir,
                                             data=parseuser)
             except NonContextDiskDir:
@@ -113,6 +114,7 @@ class DataSourceOpenNebula(sources.DataSource):
         # apply static network configuration only in 'local' dsmode
         if ('network-interfaces' in results and self.dsmode == "local"):
             LOG.debug("Updating network interfaces from %s", self)
+            self.check_cancelled()
             self.distro.apply_network(results['network-interfaces'])
 
         if dsmode != self.dsmode:
@@ -124,6 +126,11 @@ class DataSourceOpenNebula(sources.DataSource):
         self.userdata_raw = results.get('userdata')
         return True
 
+    def cleanup_probe(self):
+        self.seed = None
+        self.metadata = {}
+        self.userdata_raw = None
+
     def get_hostname(self, fqdn=False, resolve_ip=None):
         if resolve_ip is None:
             if self.dsmode == 'net':
@@ -92,8 +92,11 @@ class DataSourceOpenStack(openstack.SourceMixin, sources.DataSource):
 
         (max_wait, timeout) = self._get_url_settings()
         start_time = time.time()
+        concurrent = util.get_cfg_option_bool(self.ds_cfg,
+                                              "race_metadata_urls", False)
         avail_url = url_helper.wait_for_url(urls=md_urls, max_wait=max_wait,
-                                            timeout=timeout)
+                                            timeout=timeout,
+                                            concurrent=concurrent)
         if avail_url:
             LOG.debug("Using metadata source: '%s'", url2base[avail_url])
         else:
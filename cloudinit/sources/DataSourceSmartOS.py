@@ -40,12 +40,14 @@ import re
 import socket
 import stat
 
-import serial
-
+from cloudinit import importer
 from cloudinit import log as logging
 from cloudinit import sources
 from cloudinit import util
 
+# Only needed once the serial console is actually read from
+serial = importer.lazy_import('serial')
+
 
 LOG = logging.getLogger(__name__)
 
@@ -182,6 +184,8 @@ class DataSourceSmartOS(sources.DataSource):
         self.b64_keys = self.ds_cfg.get('base64_keys')
         self.b64_all = self.ds_cfg.get('base64_all')
         self.script_base_d = os.path.join(self.paths.get_cpath("scripts"))
+        # files (and links) get_data() wrote
+        self._written = []
 
     def __str__(self):
         root = sources.DataSource.__str__(self)
@@ -224,6 +228,18 @@ class DataSourceSmartOS(sources.DataSource):
             os.rename('/'.join([svc_path, 'provisioning']),
                       '/'.join([svc_path, 'provision_success']))
 
+    def detect(self):
+        if not device_exists(self.seed):
+            return sources.DETECT_NO
+        uname_arch = os.uname()[4]
+        if uname_arch.startswith("arm") or uname_arch == "aarch64":
+            return sources.DETECT_NO
+        if self.smartos_type == 'kvm':
+            system_type = dmi_data()
+            if not system_type or 'smartdc' not in system_type.lower():
+                return sources.DETECT_NO
+        return sources.DETECT_YES
+
     def get_data(self):
         md = {}
         ud = ""
@@ -253,6 +269,7 @@ class DataSourceSmartOS(sources.DataSource):
                 return False
             LOG.debug("Host is SmartOS, guest in KVM")
 
+        self.check_cancelled()
         seed_obj = self._get_seed_file_object()
         if seed_obj is None:
             LOG.debug('Seed file object not found.')
@@ -278,17 +295,22 @@ class DataSourceSmartOS(sources.DataSource):
         # We write 'user-script' and 'operator-script' into the
         # instance/data directory. The default vendor-data then handles
         # executing them later.
+        self.check_cancelled()
         data_d = os.path.join(self.paths.get_cpath(), 'instances',
                               md['instance-id'], 'data')
         user_script = os.path.join(data_d, 'user-script')
         u_script_l = "%s/user-script" % LEGACY_USER_D
         write_boot_content(md.get('user-script'), content_f=user_script,
                            link=u_script_l, shebang=True, mode=0o700)
+        if md.get('user-script'):
+            self._written.extend([user_script, u_script_l])
 
         operator_script = os.path.join(data_d, 'operator-script')
         write_boot_content(md.get('operator-script'),
                            content_f=operator_script, shebang=False,
                            mode=0o700)
+        if md.get('operator-script'):
+            self._written.append(operator_script)
 
         # @datadictionary:  This key has no defined format, but its value
         # is written to the file /var/db/mdata-user-data on each boot prior
@@ -298,6 +320,8 @@ class DataSourceSmartOS(sources.DataSource):
         u_data = md.get('legacy-user-data')
         u_data_f = "%s/mdata-user-data" % LEGACY_USER_D
         write_boot_content(u_data, u_data_f)
+        if u_data:
+            self._written.append(u_data_f)
 
         # Handle the cloud-init regular meta
         if not md['local-hostname']:
@@ -319,9 +343,23 @@ class DataSourceSmartOS(sources.DataSource):
         self.userdata_raw = ud
         self.vendordata_raw = md['vendor-data']
 
+        self.check_cancelled()
         self._set_provisioned()
         return True
 
+    def cleanup_probe(self):
+        # Lost the race, the boot content written is not for this boot
+        for path in self._written:
+            try:
+                if os.path.lexists(path):
+                    os.unlink(path)
+            except OSError:
+                util.logexc(LOG, "Failed removing %s", path)
+        self._written = []
+        self.metadata = {}
+        self.userdata_raw = None
+        self.vendordata_raw = None
+
     def device_name_to_device(self, name):
         return self.ds_cfg['disk_aliases'].get(name)
 
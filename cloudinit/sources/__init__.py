@@ -21,13 +21,25 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import abc
+import base64
+import copy
+import functools
+import hashlib
+import json
 import os
+import threading
 
 import six
 
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
 from cloudinit import importer
 from cloudinit import log as logging
 from cloudinit import type_utils
+from cloudinit import url_helper
 from cloudinit import user_data as ud
 from cloudinit import util
 
@@ -38,6 +50,14 @@ DEP_FILESYSTEM = "FILESYSTEM"
 DEP_NETWORK = "NETWORK"
 DS_PREFIX = 'DataSource'
 
+# Version of the format written by dump_cache()
+CACHE_VERSION = 1
+
+# Possible results of DataSource.detect()
+DETECT_YES = "yes"
+DETECT_NO = "no"
+DETECT_MAYBE = "maybe"
+
 LOG = logging.getLogger(__name__)
 
 
@@ -45,8 +65,26 @@ class DataSourceNotFoundException(Exception):
     pass
 
 
+class CacheError(Exception):
+    pass
+
+
+class ProbeCancelled(Exception):
+    pass
+
+
 @six.add_metaclass(abc.ABCMeta)
 class DataSource(object):
+    # Attributes that are rebuilt from the running system (or, for the
+    # processed user/vendor data, reprocessed on demand) when a datasource
+    # is restored from the cache, so they are never written to it. The
+    # ds_cfg is cached, as datasources update it with what they found
+    # (disk aliases and the like) in get_data.
+    cache_skip_attrs = frozenset([
+        'sys_cfg', 'distro', 'paths', 'ud_proc',
+        'userdata', 'vendordata', '_cancel_event',
+    ])
+    _cancel_event = None
 
     def __init__(self, sys_cfg, distro, paths, ud_proc=None):
         self.sys_cfg = sys_cfg
@@ -73,23 +111,108 @@ class DataSource(object):
             self.ds_cfg = {}
 
         if not ud_proc:
-            self.ud_proc = ud.UserDataProcessor(self.paths)
+            limits = util.get_cfg_by_path(self.sys_cfg, ("userdata_limits",),
+                                          {})
+            include_workers = util.get_cfg_by_path(
+                self.sys_cfg, ("userdata_include_workers",))
+            self.ud_proc = ud.UserDataProcessor(
+                self.paths, limits=limits, include_workers=include_workers)
         else:
             self.ud_proc = ud_proc
 
     def __str__(self):
         return type_utils.obj_name(self)
 
+    def get_cache_state(self):
+        """Return the state of this datasource that is worth caching.
+
+        This is every instance attribute (other than cache_skip_attrs) whose
+        value is made of plain data (dicts, lists, strings, bytes, numbers);
+        anything else is left to be recreated by __init__ on restore.
+        """
+        state = {}
+        for (name, value) in vars(self).items():
+            if name in self.cache_skip_attrs:
+                continue
+            try:
+                state[name] = _encode_cache_value(value)
+            except TypeError as e:
+                LOG.warn("Not caching attribute %s of %s, it will not be"
+                         " restored: %s", name, self, e)
+        return state
+
+    def restore_cache_state(self, state):
+        for (name, value) in state.items():
+            setattr(self, name, _decode_cache_value(value))
+
+    def detect(self):
+        """Cheaply decide if this datasource could be in use.
+
+        Only local evidence (dmi data, /sys, the kernel command line,
+        filesystem labels...) should be consulted here, never the network
+        or anything else that may block. Returns DETECT_YES when the
+        platform is positively identified, DETECT_NO when get_data() is
+        certain to fail (so it is skipped) and DETECT_MAYBE otherwise.
+        """
+        return DETECT_MAYBE
+
+    @property
+    def cancel_event(self):
+        """Set once the result of get_data() is no longer wanted."""
+        if self._cancel_event is None:
+            self._cancel_event = threading.Event()
+        return self._cancel_event
+
+    def cancel(self):
+        """Ask a get_data() running in another thread (a probe that lost
+        the datasource race) to give up as soon as it can."""
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event is not None and self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        """Raises ProbeCancelled when get_data() should give up.
+
+        Called by get_data() implementations before they change anything
+        outside of the datasource (hostname, network, files...).
+        """
+        if self.cancelled:
+            raise ProbeCancelled("Probing %s was cancelled" % (self))
+
+    def cleanup_probe(self):
+        """Undo what get_data() left behind (mounts, temporary files...)
+        when this datasource lost the race; called once it returned."""
+        pass
+
+    def _spool_dir(self, name):
+        # Where the large parts of the processed (user or vendor) data are
+        # kept, in the instance's data directory.
+        if self.paths is None or self.get_instance_id() is None:
+            return None
+        # (the paths given to datasources do not know of one yet)
+        paths = copy.copy(self.paths)
+        paths.datasource = self
+        ipath = paths.get_ipath('data')
+        if not ipath:
+            return None
+        return os.path.join(ipath, "%s-parts" % (name))
+
     def get_userdata(self, apply_filter=False):
         if self.userdata is None:
-            self.userdata = self.ud_proc.process(self.get_userdata_raw())
+            self.userdata = self.ud_proc.process(
+                self.get_userdata_raw(),
+                spool_dir=self._spool_dir('user-data'))
         if apply_filter:
             return self._filter_xdata(self.userdata)
         return self.userdata
 
     def get_vendordata(self):
         if self.vendordata is None:
-            self.vendordata = self.ud_proc.process(self.get_vendordata_raw())
+            self.vendordata = self.ud_proc.process(
+                self.get_vendordata_raw(),
+                spool_dir=self._spool_dir('vendor-data'))
         return self.vendordata
 
     @property
@@ -257,33 +380,239 @@ def normalize_pubkey_data(pubkey_data):
     return keys
 
 
+def _encode_cache_value(value):
+    if isinstance(value, six.binary_type):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    if value is None or isinstance(value, (bool, float) + six.integer_types +
+                                   (six.text_type,)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_encode_cache_value(v) for v in value]
+    if isinstance(value, dict):
+        encoded = {}
+        for (k, v) in value.items():
+            if not isinstance(k, six.string_types):
+                raise TypeError("Can not cache non-string key %r" % (k,))
+            if isinstance(k, six.binary_type):
+                k = k.decode('utf-8')
+            encoded[k] = _encode_cache_value(v)
+        return encoded
+    raise TypeError("Can not cache value of type %s" % type(value))
+
+
+def _decode_cache_value(value):
+    if isinstance(value, list):
+        return [_decode_cache_value(v) for v in value]
+    if isinstance(value, dict):
+        if list(value.keys()) == ['__bytes__']:
+            return base64.b64decode(value['__bytes__'])
+        return dict((k, _decode_cache_value(v)) for (k, v) in value.items())
+    return value
+
+
+def _cache_checksum(state):
+    blob = json.dumps(state, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def dump_cache(ds):
+    """Serialize a datasource (see DataSource.get_cache_state) to a string."""
+    cls = type(ds)
+    state = {
+        'class': "%s.%s" % (cls.__module__, cls.__name__),
+        'instance-id': _get_cached_instance_id(ds),
+        'attributes': ds.get_cache_state(),
+    }
+    return json.dumps({
+        'version': CACHE_VERSION,
+        'checksum': _cache_checksum(state),
+        'state': state,
+    }, separators=(',', ':'))
+
+
+def load_cache(blob, sys_cfg, distro, paths):
+    """Recreate the datasource written by dump_cache().
+
+    The datasource class is instantiated with the given (current) sys_cfg,
+    distro and paths, and the cached state applied on top. CacheError is
+    raised when the cache is of an unknown version, fails its checksum or
+    names a class that no longer exists.
+    """
+    try:
+        contents = json.loads(util.decode_binary(blob))
+        version = contents['version']
+        checksum = contents['checksum']
+        state = contents['state']
+    except (ValueError, TypeError, KeyError) as e:
+        raise CacheError("Unreadable datasource cache: %s" % e)
+    if version != CACHE_VERSION:
+        raise CacheError("Unsupported datasource cache version %s" % version)
+    if checksum != _cache_checksum(state):
+        raise CacheError("Datasource cache checksum mismatch")
+    (mod_name, _sep, cls_name) = state['class'].rpartition(".")
+    try:
+        cls = getattr(importer.import_module(mod_name), cls_name)
+    except (ImportError, AttributeError) as e:
+        raise CacheError("Cached datasource class %s is not available: %s"
+                         % (state['class'], e))
+    ds = cls(sys_cfg, distro, paths)
+    ds.restore_cache_state(state['attributes'])
+    instance_id = _get_cached_instance_id(ds)
+    if instance_id != state['instance-id']:
+        raise CacheError("Restored datasource instance id %s does not match"
+                         " cached %s" % (instance_id, state['instance-id']))
+    return ds
+
+
+def _get_cached_instance_id(ds):
+    try:
+        return ds.get_instance_id()
+    except Exception:
+        return None
+
+
 def find_source(sys_cfg, distro, paths, ds_deps, cfg_list, pkg_list, reporter):
     ds_list = list_sources(cfg_list, ds_deps, pkg_list)
     ds_names = [type_utils.obj_name(f) for f in ds_list]
     mode = "network" if DEP_NETWORK in ds_deps else "local"
     LOG.debug("Searching for %s data source in: %s", mode, ds_names)
 
-    for name, cls in zip(ds_names, ds_list):
-        myrep = events.ReportEventStack(
-            name="search-%s" % name.replace("DataSource", ""),
-            description="searching for %s data from %s" % (mode, name),
-            message="no %s data found from %s" % (mode, name),
-            parent=reporter)
-        try:
-            with myrep:
-                LOG.debug("Seeing if we can get any data from %s", cls)
-                s = cls(sys_cfg, distro, paths)
-                if s.get_data():
-                    myrep.message = "found %s data from %s" % (mode, name)
-                    return (s, type_utils.obj_name(cls))
-        except Exception:
-            util.logexc(LOG, "Getting data from %s failed", cls)
+    if util.get_cfg_option_bool(sys_cfg, 'datasource_detect', True):
+        detected = _detect_sources(ds_names, ds_list, sys_cfg, distro, paths)
+    else:
+        detected = [(name, cls, None) for name, cls in zip(ds_names, ds_list)]
+
+    race = util.get_cfg_option_bool(sys_cfg, 'datasource_race', False)
+    if race and futures is None:
+        LOG.warn("Datasource racing requested, but concurrent.futures is"
+                 " not available; searching data sources in order")
+        race = False
+
+    probes = []
+    for name, cls, s in detected:
+        probes.append(functools.partial(_probe_source, name, cls, s, sys_cfg,
+                                        distro, paths, mode, reporter))
+    classes = [cls for _name, cls, _s in detected]
+    # Devices that several datasources look at (iso9660/vfat seeds) are
+    # only mounted once, and unmounted when the search is over.
+    with util.mount_session():
+        if race and len(probes) > 1:
+            found = _race_probes(detected, sys_cfg, distro, paths, mode,
+                                 reporter)
+        else:
+            found = _search_probes(classes, probes)
+    if found:
+        return found
 
     msg = ("Did not find any data source,"
            " searched classes: (%s)") % (", ".join(ds_names))
     raise DataSourceNotFoundException(msg)
 
 
+def _detect_sources(ds_names, ds_list, sys_cfg, distro, paths):
+    # Run the cheap detect() hook of every candidate and drop those that
+    # are certain not to be in use before any expensive get_data() happens.
+    detected = []
+    results = {}
+    for name, cls in zip(ds_names, ds_list):
+        try:
+            s = cls(sys_cfg, distro, paths)
+            result = s.detect()
+        except Exception:
+            util.logexc(LOG, "Detecting %s failed", cls)
+            (s, result) = (None, DETECT_MAYBE)
+        results[name] = result
+        if result != DETECT_NO:
+            detected.append((name, cls, s))
+    LOG.debug("Data source detection results: %s", results)
+    return detected
+
+
+def _probe_source(name, cls, s, sys_cfg, distro, paths, mode, reporter):
+    myrep = events.ReportEventStack(
+        name="search-%s" % name.replace("DataSource", ""),
+        description="searching for %s data from %s" % (mode, name),
+        message="no %s data found from %s" % (mode, name),
+        parent=reporter)
+    try:
+        with myrep:
+            LOG.debug("Seeing if we can get any data from %s", cls)
+            if s is None:
+                s = cls(sys_cfg, distro, paths)
+            try:
+                with url_helper.cancelled_by(s.cancel_event):
+                    found = s.get_data()
+            finally:
+                if s.cancelled:
+                    # The search is over, nothing is waiting to hear how
+                    # this one went.
+                    myrep.reporting_enabled = False
+            if found and not s.cancelled:
+                myrep.message = "found %s data from %s" % (mode, name)
+                return s
+    except ProbeCancelled:
+        LOG.debug("Getting data from %s cancelled", cls)
+    except Exception:
+        util.logexc(LOG, "Getting data from %s failed", cls)
+    return None
+
+
+def _search_probes(ds_list, probes):
+    for cls, probe in zip(ds_list, probes):
+        s = probe()
+        if s:
+            return (s, type_utils.obj_name(cls))
+    return None
+
+
+def _race_probes(detected, sys_cfg, distro, paths, mode, reporter):
+    # All candidates are probed at once, but the results are examined in
+    # priority order so that the same datasource wins as in an ordered
+    # search; a lower priority source can not win while a higher priority
+    # one is still being probed.
+    racers = []
+    for name, cls, s in detected:
+        if s is None:
+            try:
+                s = cls(sys_cfg, distro, paths)
+            except Exception:
+                util.logexc(LOG, "Creating %s failed", cls)
+                continue
+        racers.append((name, cls, s))
+    if not racers:
+        return None
+    executor = futures.ThreadPoolExecutor(len(racers))
+    pending = []
+    for name, cls, s in racers:
+        pending.append(executor.submit(_probe_source, name, cls, s, sys_cfg,
+                                       distro, paths, mode, reporter))
+    winner = None
+    try:
+        for (_name, cls, s), fut in zip(racers, pending):
+            if fut.result():
+                winner = s
+                return (s, type_utils.obj_name(cls))
+        return None
+    finally:
+        # The losers are cancelled: those not started yet never run, the
+        # others give up at their next chance and are cleaned up once
+        # they have.
+        for (_name, _cls, s), fut in zip(racers, pending):
+            if s is winner:
+                continue
+            s.cancel()
+            if not fut.cancel():
+                fut.add_done_callback(functools.partial(_cleanup_probe, s))
+        executor.shutdown(wait=False)
+
+
+def _cleanup_probe(s, _fut):
+    try:
+        s.cleanup_probe()
+    except Exception:
+        util.logexc(LOG, "Cleaning up after probing %s failed", s)
+
+
 # Return a list of classes that have the same depends as 'depends'
 # iterate through cfg_list, loading "DataSource*" modules
 # and calling their "get_datasource_list".
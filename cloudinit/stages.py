@@ -27,7 +27,13 @@ import sys
 import six
 from six.moves import cPickle as pickle
 
-from cloudinit.settings import (PER_INSTANCE, FREQUENCIES, CLOUD_CONFIG)
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+from cloudinit.settings import (PER_INSTANCE, FREQUENCIES, CLOUD_CONFIG,
+                                CLOUD_CONFIG_CACHE)
 
 from cloudinit import handlers
 
@@ -47,12 +53,16 @@ from cloudinit import net
 from cloudinit.reporting import events
 from cloudinit import sources
 from cloudinit import type_utils
+from cloudinit import user_data as ud
 from cloudinit import util
 
 LOG = logging.getLogger(__name__)
 
 NULL_DATA_SOURCE = None
 
+# How many config modules may run at the same time (1 runs them in order)
+DEF_MODULE_WORKERS = 1
+
 
 class Init(object):
     def __init__(self, ds_deps=None, reporter=None):
@@ -64,6 +74,8 @@ class Init(object):
         self._cfg = None
         self._paths = None
         self._distro = None
+        # The config before forget_cfg() was called
+        self._old_cfg = None
         # Changed only when a fetch occurs
         self.datasource = NULL_DATA_SOURCE
         self.ds_restored = False
@@ -85,6 +97,8 @@ class Init(object):
 
     @property
     def distro(self):
+        # (reading the config may show the distro needs recreating)
+        self.read_cfg()
         if not self._distro:
             # Try to find the right class to use
             system_config = self._extract_cfg('system')
@@ -108,7 +122,7 @@ class Init(object):
         # Ensure actually read
         self.read_cfg()
         # Nobody gets the real config
-        ocfg = copy.deepcopy(self._cfg)
+        ocfg = helpers.ConfigView(self._cfg)
         if restriction == 'restricted':
             ocfg.pop('system_info', None)
         elif restriction == 'system':
@@ -121,6 +135,7 @@ class Init(object):
 
     @property
     def paths(self):
+        self.read_cfg()
         if not self._paths:
             path_info = self._extract_cfg('paths')
             self._paths = helpers.Paths(path_info, self.datasource)
@@ -183,6 +198,25 @@ class Init(object):
         if self._cfg is None:
             self._cfg = self._read_cfg(extra_fns)
             # LOG.debug("Loaded 'init' config %s", self._cfg)
+            old_cfg = self._old_cfg
+            self._old_cfg = None
+            if (old_cfg is not None and
+                    old_cfg.get('system_info') != self._cfg.get('system_info')):
+                # What the distro and paths were made from changed
+                self._paths = None
+                self._distro = None
+
+    def forget_cfg(self):
+        """Read the config again on next use, keeping the datasource.
+
+        Used when this object is kept for another stage (in the boot
+        daemon), as the stage before may have changed the config (by
+        consuming user-data for example). The distro and paths are only
+        recreated if their part of the config changes.
+        """
+        if self._cfg is not None:
+            self._old_cfg = self._cfg
+        self._cfg = None
 
     def _read_cfg(self, extra_fns):
         no_cfg_paths = helpers.Paths({}, self.datasource)
@@ -196,12 +230,23 @@ class Init(object):
         # We try to restore from a current link and static path
         # by using the instance link, if purge_cache was called
         # the file wont exist.
-        return _pkl_load(self.paths.get_ipath_cur('obj_pkl'))
+        ds = _ds_load(self.paths.get_ipath_cur('obj_cache'), self.cfg,
+                      self.distro, self.paths)
+        if ds is None:
+            # Fall back to a datasource pickled by an older cloud-init.
+            ds = _pkl_load(self.paths.get_ipath_cur('obj_pkl'))
+        return ds
 
     def _write_to_cache(self):
         if self.datasource is NULL_DATA_SOURCE:
             return False
-        return _pkl_store(self.datasource, self.paths.get_ipath_cur("obj_pkl"))
+        if not _ds_store(self.datasource,
+                         self.paths.get_ipath_cur("obj_cache")):
+            return False
+        # A pickle left by an older cloud-init must not win over the
+        # datasource that was just cached.
+        util.del_file(self.paths.get_ipath_cur("obj_pkl"))
+        return True
 
     def _get_datasources(self):
         # Any config provided???
@@ -342,23 +387,19 @@ class Init(object):
         if raw_ud is None:
             raw_ud = b''
         util.write_file(self._get_ipath('userdata_raw'), raw_ud, 0o600)
-        # processed userdata is a Mime message, so write it as string.
-        processed_ud = self.datasource.get_userdata()
-        if processed_ud is None:
-            raw_ud = ''
-        util.write_file(self._get_ipath('userdata'), str(processed_ud), 0o600)
+        # processed userdata is a Mime message, written out as it renders
+        # (rather than first turned into one big string).
+        ud.write_processed(self.datasource.get_userdata(),
+                           self._get_ipath('userdata'), 0o600)
 
     def _store_vendordata(self):
         raw_vd = self.datasource.get_vendordata_raw()
         if raw_vd is None:
             raw_vd = b''
         util.write_file(self._get_ipath('vendordata_raw'), raw_vd, 0o600)
-        # processed vendor data is a Mime message, so write it as string.
-        processed_vd = str(self.datasource.get_vendordata())
-        if processed_vd is None:
-            processed_vd = ''
-        util.write_file(self._get_ipath('vendordata'), str(processed_vd),
-                        0o600)
+        # processed vendor data is a Mime message, written like userdata.
+        ud.write_processed(self.datasource.get_vendordata(),
+                           self._get_ipath('vendordata'), 0o600)
 
     def _default_handlers(self, opts=None):
         if opts is None:
@@ -632,7 +673,7 @@ class Modules(object):
             self._cached_cfg = merger.cfg
             # LOG.debug("Loading 'module' config %s", self._cached_cfg)
         # Only give out a copy so that others can't modify this...
-        return copy.deepcopy(self._cached_cfg)
+        return helpers.ConfigView(self._cached_cfg)
 
     def _read_modules(self, name):
         module_list = []
@@ -693,6 +734,12 @@ class Modules(object):
                           " has an unknown frequency %s"), raw_name, freq)
                 # Reset it so when ran it will get set to a known value
                 freq = None
+            # The modules shipped with cloud-init are looked up in their
+            # index, which avoids importing them until they are ran.
+            mod = config.indexed_module(mod_name)
+            if mod is not None:
+                mostly_mods.append([mod, raw_name, freq, run_args])
+                continue
             mod_locs, looked_locs = importer.find_module(
                 mod_name, ['', type_utils.obj_name(config)], ['handle'])
             if not mod_locs:
@@ -703,50 +750,121 @@ class Modules(object):
             mostly_mods.append([mod, raw_name, freq, run_args])
         return mostly_mods
 
+    def _get_module_workers(self):
+        workers = DEF_MODULE_WORKERS
+        try:
+            workers = max(1, int(self.cfg.get('module_workers', workers)))
+        except (TypeError, ValueError):
+            util.logexc(LOG, "Failed to get module workers, using %s",
+                        workers)
+        return workers
+
+    def _run_module(self, cc, mod, name, freq, args, ran_before=False):
+        freq = _module_frequency(mod, freq)
+        LOG.debug("Running module %s (%s) with frequency %s",
+                  name, mod, freq)
+
+        # Use the configs logger and not our own
+        # TODO(harlowja): possibly check the module
+        # for having a LOG attr and just give it back
+        # its own logger?
+        func_args = [name, self.cfg,
+                     cc, config.LOG, args]
+        # This name will affect the semaphore name created
+        run_name = "config-%s" % (name)
+
+        desc = "running %s with frequency %s" % (run_name, freq)
+        myrep = events.ReportEventStack(
+            name=run_name, description=desc, parent=self.reporter)
+
+        with myrep:
+            if ran_before:
+                LOG.debug("%s already ran (freq=%s)", run_name, freq)
+                ran = False
+            else:
+                ran, _r = cc.run(run_name, mod.handle, func_args,
+                                 freq=freq)
+            if ran:
+                myrep.message = "%s ran successfully" % run_name
+            else:
+                myrep.message = "%s previously ran" % run_name
+
+    def _try_run_module(self, cc, mod, name, freq, args, ran_before=False):
+        try:
+            self._run_module(cc, mod, name, freq, args, ran_before)
+        except Exception as e:
+            util.logexc(LOG, "Running module %s (%s) failed", name, mod)
+            return e
+        return None
+
     def _run_modules(self, mostly_mods):
         cc = self.init.cloudify()
+        # Which of them already ran (at their frequency) is looked up for
+        # all of them at once, rather than as each one comes up.
+        ran_before = cc.which_have_run(
+            [("config-%s" % name, _module_frequency(mod, freq))
+             for (mod, name, freq, _args) in mostly_mods])
+        try:
+            return self._run_modules_with(cc, mostly_mods, ran_before)
+        finally:
+            # The semaphores taken are made durable once, at the end
+            cc.sync_semaphores()
+
+    def _run_modules_with(self, cc, mostly_mods, ran_before):
         # Return which ones ran
         # and which ones failed + the exception of why it failed
         failures = []
         which_ran = []
+        workers = self._get_module_workers()
+        if workers > 1 and futures is None:
+            LOG.debug("Running modules with %s workers requested, but"
+                      " concurrent.futures is not available; running them"
+                      " one at a time", workers)
+        elif workers > 1 and len(mostly_mods) > 1:
+            return self._run_modules_concurrently(cc, mostly_mods, workers,
+                                                  ran_before)
         for (mod, name, freq, args) in mostly_mods:
-            try:
-                # Try the modules frequency, otherwise fallback to a known one
-                if not freq:
-                    freq = mod.frequency
-                if freq not in FREQUENCIES:
-                    freq = PER_INSTANCE
-                LOG.debug("Running module %s (%s) with frequency %s",
-                          name, mod, freq)
-
-                # Use the configs logger and not our own
-                # TODO(harlowja): possibly check the module
-                # for having a LOG attr and just give it back
-                # its own logger?
-                func_args = [name, self.cfg,
-                             cc, config.LOG, args]
-                # Mark it as having started running
-                which_ran.append(name)
-                # This name will affect the semaphore name created
-                run_name = "config-%s" % (name)
-
-                desc = "running %s with frequency %s" % (run_name, freq)
-                myrep = events.ReportEventStack(
-                    name=run_name, description=desc, parent=self.reporter)
-
-                with myrep:
-                    ran, _r = cc.run(run_name, mod.handle, func_args,
-                                     freq=freq)
-                    if ran:
-                        myrep.message = "%s ran successfully" % run_name
-                    else:
-                        myrep.message = "%s previously ran" % run_name
-
-            except Exception as e:
-                util.logexc(LOG, "Running module %s (%s) failed", name, mod)
+            # Mark it as having started running
+            which_ran.append(name)
+            e = self._try_run_module(cc, mod, name, freq, args,
+                                     "config-%s" % name in ran_before)
+            if e is not None:
                 failures.append((name, e))
         return (which_ran, failures)
 
+    def _run_modules_concurrently(self, cc, mostly_mods, workers,
+                                  ran_before):
+        # Modules still start in the order they are listed in, but one no
+        # longer has to wait for those before it to finish unless it shares
+        # a resource with them (see _module_dependencies).
+        depends_on = _module_dependencies(mostly_mods)
+        failed = {}
+        done = set()
+        pending = list(range(len(mostly_mods)))
+        running = {}
+        with futures.ThreadPoolExecutor(workers) as executor:
+            while pending or running:
+                for i in list(pending):
+                    if not depends_on[i].issubset(done):
+                        continue
+                    pending.remove(i)
+                    (mod, name, freq, args) = mostly_mods[i]
+                    fut = executor.submit(self._try_run_module, cc,
+                                          mod, name, freq, args,
+                                          "config-%s" % name in ran_before)
+                    running[fut] = i
+                (finished, _not_done) = futures.wait(
+                    list(running), return_when=futures.FIRST_COMPLETED)
+                for fut in finished:
+                    i = running.pop(fut)
+                    done.add(i)
+                    if fut.result() is not None:
+                        failed[i] = fut.result()
+        # Report back in the order the modules were listed in
+        which_ran = [name for (_mod, name, _freq, _args) in mostly_mods]
+        failures = [(mostly_mods[i][1], failed[i]) for i in sorted(failed)]
+        return (which_ran, failures)
+
     def run_single(self, mod_name, args=None, freq=None):
         # Form the users module 'specs'
         mod_to_be = {
@@ -791,13 +909,42 @@ class Modules(object):
         return self._run_modules(mostly_mods)
 
 
+def _module_frequency(mod, freq):
+    # Try the modules frequency, otherwise fallback to a known one
+    if not freq:
+        freq = mod.frequency
+    if freq not in FREQUENCIES:
+        freq = PER_INSTANCE
+    return freq
+
+
+def _module_dependencies(mostly_mods):
+    # Each module depends on every module listed before it that it shares
+    # a resource with (modules that did not declare their resources share
+    # all of them) or that is the same module (so it is not ran twice at
+    # once, which its semaphore can not prevent).
+    depends_on = []
+    for (i, (mod, _name, _freq, _args)) in enumerate(mostly_mods):
+        mine = mod.resources
+        needs = set()
+        for (j, (other, _n, _f, _a)) in enumerate(mostly_mods[:i]):
+            theirs = other.resources
+            if (mine is None or theirs is None or mod is other or
+                    set(mine) & set(theirs)):
+                needs.add(j)
+        depends_on.append(needs)
+    return depends_on
+
+
 def fetch_base_config():
     base_cfgs = []
     default_cfg = util.get_builtin_cfg()
 
     # Anything in your conf.d location??
     # or the 'default' cloud.cfg location???
-    base_cfgs.append(util.read_conf_with_confd(CLOUD_CONFIG))
+    # (re-parsed only if it changed since an earlier stage cached it)
+    base_cfgs.append(util.read_conf_with_confd(CLOUD_CONFIG,
+                                               cache_file=CLOUD_CONFIG_CACHE))
 
     # Kernel/cmdline parameters override system config
     kern_contents = util.read_cc_from_cmdline()
@@ -811,20 +958,40 @@ def fetch_base_config():
     return util.mergemanydict(base_cfgs)
 
 
-def _pkl_store(obj, fname):
+def _ds_store(ds, fname):
     try:
-        pk_contents = pickle.dumps(obj)
+        contents = sources.dump_cache(ds)
     except Exception:
-        util.logexc(LOG, "Failed pickling datasource %s", obj)
+        util.logexc(LOG, "Failed serializing datasource %s", ds)
         return False
     try:
-        util.write_file(fname, pk_contents, omode="wb", mode=0o400)
+        util.write_file(fname, contents, mode=0o400)
     except Exception:
-        util.logexc(LOG, "Failed pickling datasource to %s", fname)
+        util.logexc(LOG, "Failed writing datasource cache to %s", fname)
         return False
     return True
 
 
+def _ds_load(fname, sys_cfg, distro, paths):
+    contents = None
+    try:
+        contents = util.load_file(fname, decode=False)
+    except Exception as e:
+        if os.path.isfile(fname):
+            LOG.warn("failed loading datasource cache in %s: %s", fname, e)
+
+    # This is allowed so just return nothing successfully loaded...
+    if not contents:
+        return None
+    try:
+        return sources.load_cache(contents, sys_cfg, distro, paths)
+    except sources.CacheError as e:
+        LOG.warn("Ignoring datasource cache in %s: %s", fname, e)
+    except Exception:
+        util.logexc(LOG, "Failed loading datasource cache from %s", fname)
+    return None
+
+
 def _pkl_load(fname):
     pickle_contents = None
     try:
@@ -21,20 +21,9 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import hashlib
 import re
-
-try:
-    from Cheetah.Template import Template as CTemplate
-    CHEETAH_AVAILABLE = True
-except (ImportError, AttributeError):
-    CHEETAH_AVAILABLE = False
-
-try:
-    import jinja2
-    from jinja2 import Template as JTemplate
-    JINJA_AVAILABLE = True
-except (ImportError, AttributeError):
-    JINJA_AVAILABLE = False
+import threading
 
 from cloudinit import log as logging
 from cloudinit import type_utils as tu
@@ -44,6 +33,217 @@ LOG = logging.getLogger(__name__)
 TYPE_MATCHER = re.compile(r"##\s*template:(.*)", re.I)
 BASIC_MATCHER = re.compile(r'\$\{([A-Za-z0-9_.]+)\}|\$([A-Za-z0-9_.]+)')
 
+# Compiled templates are kept (keyed by renderer and a hash of their
+# content) so that rendering the same text again skips parsing it.
+CACHE_SIZE = 64
+BYTECODE_CACHE_DIR = "jinja-cache"
+
+# Cheetah and jinja are only probed for (and imported) the first time a
+# template that could use them is rendered; None means not probed yet.
+CHEETAH_AVAILABLE = None
+JINJA_AVAILABLE = None
+CTemplate = None
+JTemplate = None
+jinja2 = None
+
+_CACHE = collections.OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+# The jinja environment (and the directory its compiled bytecode is
+# kept in) is made on first use, see configure_bytecode_cache.
+_JINJA_ENV = None
+_JINJA_SOURCES = {}
+_BYTECODE_DIR = None
+
+
+def _cheetah_available():
+    global CHEETAH_AVAILABLE, CTemplate
+    if CHEETAH_AVAILABLE is None:
+        try:
+            from Cheetah.Template import Template as CTemplate
+            CHEETAH_AVAILABLE = True
+        except (ImportError, AttributeError):
+            CHEETAH_AVAILABLE = False
+    return CHEETAH_AVAILABLE
+
+
+def _jinja_available():
+    global JINJA_AVAILABLE, JTemplate, jinja2
+    if JINJA_AVAILABLE is None:
+        try:
+            import jinja2
+            from jinja2 import Template as JTemplate
+            JINJA_AVAILABLE = True
+        except (ImportError, AttributeError):
+            JINJA_AVAILABLE = False
+    return JINJA_AVAILABLE
+
+
+def _lookup(params, path):
+    selected_params = params
+    for key in path[:-1]:
+        if not isinstance(selected_params, dict):
+            raise TypeError("Can not traverse into"
+                            " non-dictionary '%s' of type %s while"
+                            " looking for subkey '%s'"
+                            % (selected_params,
+                               tu.obj_name(selected_params),
+                               key))
+        selected_params = selected_params[key]
+    key = path[-1]
+    if not isinstance(selected_params, dict):
+        raise TypeError("Can not extract key '%s' from non-dictionary"
+                        " '%s' of type %s"
+                        % (key, selected_params,
+                           tu.obj_name(selected_params)))
+    return str(selected_params[key])
+
+
+class BasicTemplate(object):
+    """A basic template split up into its literal text and the (dotted)
+    key paths in between, so rendering it is a series of lookups."""
+
+    def __init__(self, content):
+        self.literals = []
+        self.paths = []
+        pos = 0
+        for match in BASIC_MATCHER.finditer(content):
+            # Only 1 of the 2 groups will actually have a valid entry.
+            name = match.group(1)
+            if name is None:
+                name = match.group(2)
+            self.literals.append(content[pos:match.start()])
+            self.paths.append(tuple(name.split(".")))
+            pos = match.end()
+        self.literals.append(content[pos:])
+
+    def render(self, params):
+        pieces = [self.literals[0]]
+        for (path, literal) in zip(self.paths, self.literals[1:]):
+            pieces.append(_lookup(params, path))
+            pieces.append(literal)
+        return "".join(pieces)
+
+
+class _JinjaTemplate(object):
+    def __init__(self, template, content):
+        self.template = template
+        # keep_trailing_newline is in jinja2 2.7+, not 2.6
+        self.add = "\n" if content.endswith("\n") else ""
+
+    def render(self, params):
+        return self.template.render(**params) + self.add
+
+
+class _CheetahTemplate(object):
+    def __init__(self, content):
+        self.klass = CTemplate.compile(source=content)
+
+    def render(self, params):
+        return self.klass(searchList=[params]).respond()
+
+
+def _make_bytecode_cache(path):
+    class SafeBytecodeCache(jinja2.FileSystemBytecodeCache):
+        # Bytecode that can not be read or written is just compiled
+        # again, it is not worth failing the render over.
+        def load_bytecode(self, bucket):
+            try:
+                super(SafeBytecodeCache, self).load_bytecode(bucket)
+            except Exception:
+                LOG.debug("Failed loading jinja bytecode from %s", path,
+                          exc_info=True)
+                bucket.reset()
+
+        def dump_bytecode(self, bucket):
+            try:
+                super(SafeBytecodeCache, self).dump_bytecode(bucket)
+            except (IOError, OSError):
+                LOG.debug("Failed writing jinja bytecode to %s", path,
+                          exc_info=True)
+
+    return SafeBytecodeCache(path, pattern='%s.cache')
+
+
+def _jinja_source(name):
+    return (_JINJA_SOURCES[name], None, lambda: True)
+
+
+def _jinja_env():
+    global _JINJA_ENV
+    if _JINJA_ENV is None:
+        bytecode_cache = None
+        if _BYTECODE_DIR:
+            bytecode_cache = _make_bytecode_cache(_BYTECODE_DIR)
+        # Compiled templates are kept in _CACHE, so the environment
+        # does not need to keep its own copies.
+        _JINJA_ENV = jinja2.Environment(
+            loader=jinja2.FunctionLoader(_jinja_source),
+            bytecode_cache=bytecode_cache, cache_size=0,
+            undefined=jinja2.StrictUndefined, trim_blocks=True)
+    return _JINJA_ENV
+
+
+def configure_bytecode_cache(path):
+    """Keep compiled jinja templates (as bytecode) in the directory path,
+    so later stages and boots need not compile them again.
+
+    A path of None stops using the bytecode cache.
+    """
+    global _BYTECODE_DIR, _JINJA_ENV
+    if path:
+        try:
+            util.ensure_dir(path, mode=0o700)
+        except (IOError, OSError):
+            util.logexc(LOG, "Failed to create jinja bytecode cache %s",
+                        path)
+            path = None
+    with _CACHE_LOCK:
+        if path == _BYTECODE_DIR:
+            return
+        _BYTECODE_DIR = path
+        _JINJA_ENV = None
+        for key in [key for key in _CACHE if key[0] == 'jinja']:
+            del _CACHE[key]
+
+
+def _compile(template_type, content):
+    if template_type == 'jinja':
+        env = _jinja_env()
+        name = _content_hash(content)
+        _JINJA_SOURCES[name] = content
+        try:
+            return _JinjaTemplate(env.get_template(name), content)
+        finally:
+            _JINJA_SOURCES.pop(name, None)
+    elif template_type == 'cheetah':
+        return _CheetahTemplate(content)
+    return BasicTemplate(content)
+
+
+def _content_hash(content):
+    return hashlib.sha256(util.encode_text(content)).hexdigest()
+
+
+def compiled_template(template_type, content):
+    """The compiled template of the given type for content, compiled
+    only if it has not been (recently) before."""
+    key = (template_type, _content_hash(content))
+    with _CACHE_LOCK:
+        try:
+            tpl = _CACHE.pop(key)
+        except KeyError:
+            tpl = _compile(template_type, content)
+        _CACHE[key] = tpl
+        while len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+    return tpl
+
+
+def clear_cache():
+    with _CACHE_LOCK:
+        _CACHE.clear()
+
 
 def basic_render(content, params):
     """This does simple replacement of bash variable like templates.
@@ -52,48 +252,16 @@ def basic_render(content, params):
     ${a.b} or $a.b which will look for a key 'b' in the dictionary rooted
     by key 'a'.
     """
-
-    def replacer(match):
-        # Only 1 of the 2 groups will actually have a valid entry.
-        name = match.group(1)
-        if name is None:
-            name = match.group(2)
-        if name is None:
-            raise RuntimeError("Match encountered but no valid group present")
-        path = collections.deque(name.split("."))
-        selected_params = params
-        while len(path) > 1:
-            key = path.popleft()
-            if not isinstance(selected_params, dict):
-                raise TypeError("Can not traverse into"
-                                " non-dictionary '%s' of type %s while"
-                                " looking for subkey '%s'"
-                                % (selected_params,
-                                   tu.obj_name(selected_params),
-                                   key))
-            selected_params = selected_params[key]
-        key = path.popleft()
-        if not isinstance(selected_params, dict):
-            raise TypeError("Can not extract key '%s' from non-dictionary"
-                            " '%s' of type %s"
-                            % (key, selected_params,
-                               tu.obj_name(selected_params)))
-        return str(selected_params[key])
-
-    return BASIC_MATCHER.sub(replacer, content)
+    return compiled_template('basic', content).render(params)
 
 
 def detect_template(text):
 
     def cheetah_render(content, params):
-        return CTemplate(content, searchList=[params]).respond()
+        return compiled_template('cheetah', content).render(params)
 
     def jinja_render(content, params):
-        # keep_trailing_newline is in jinja2 2.7+, not 2.6
-        add = "\n" if content.endswith("\n") else ""
-        return JTemplate(content,
-                         undefined=jinja2.StrictUndefined,
-                         trim_blocks=True).render(**params) + add
+        return compiled_template('jinja', content).render(params)
 
     if text.find("\n") != -1:
         ident, rest = text.split("\n", 1)
@@ -102,7 +270,7 @@ def detect_template(text):
         rest = ''
     type_match = TYPE_MATCHER.match(ident)
     if not type_match:
-        if not CHEETAH_AVAILABLE:
+        if not _cheetah_available():
             LOG.warn("Cheetah not available as the default renderer for"
                      " unknown template, reverting to the basic renderer.")
             return ('basic', basic_render, text)
@@ -113,17 +281,17 @@ def detect_template(text):
         if template_type not in ('jinja', 'cheetah', 'basic'):
             raise ValueError("Unknown template rendering type '%s' requested"
                              % template_type)
-        if template_type == 'jinja' and not JINJA_AVAILABLE:
+        if template_type == 'jinja' and not _jinja_available():
             LOG.warn("Jinja not available as the selected renderer for"
                      " desired template, reverting to the basic renderer.")
             return ('basic', basic_render, rest)
-        elif template_type == 'jinja' and JINJA_AVAILABLE:
+        elif template_type == 'jinja':
             return ('jinja', jinja_render, rest)
-        if template_type == 'cheetah' and not CHEETAH_AVAILABLE:
+        if template_type == 'cheetah' and not _cheetah_available():
             LOG.warn("Cheetah not available as the selected renderer for"
                      " desired template, reverting to the basic renderer.")
             return ('basic', basic_render, rest)
-        elif template_type == 'cheetah' and CHEETAH_AVAILABLE:
+        elif template_type == 'cheetah':
             return ('cheetah', cheetah_render, rest)
         # Only thing left over is the basic renderer (it is always available).
         return ('basic', basic_render, rest)
@@ -20,50 +20,178 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import calendar
+import contextlib
 import json
+import math
 import os
-import requests
+import random
 import six
+import threading
 import time
 
 from email.utils import parsedate
 from functools import partial
 
-import oauthlib.oauth1 as oauth1
-from requests import exceptions
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 from six.moves.urllib.parse import (
     urlparse, urlunparse,
     quote as urlquote)
 
+from cloudinit import importer
 from cloudinit import log as logging
 from cloudinit import version
 
+# These are only needed once a request is made (or signed), which many
+# stages never do, so they are not imported until then.
+requests = importer.lazy_import('requests')
+exceptions = importer.lazy_import('requests.exceptions')
+oauth1 = importer.lazy_import('oauthlib.oauth1')
+http_cookiejar = importer.lazy_import('six.moves.http_cookiejar')
+
 LOG = logging.getLogger(__name__)
 
 if six.PY2:
     import httplib
     NOT_FOUND = httplib.NOT_FOUND
+    SERVICE_UNAVAILABLE = httplib.SERVICE_UNAVAILABLE
 else:
     import http.client
     NOT_FOUND = http.client.NOT_FOUND
+    SERVICE_UNAVAILABLE = http.client.SERVICE_UNAVAILABLE
 
+# Status codes whose Retry-After header is honored when retrying
+RETRY_AFTER_CODES = frozenset([429, SERVICE_UNAVAILABLE])
 
-# Check if requests has ssl support (added in requests >= 0.8.8)
+
+# Check if requests has ssl support (added in requests >= 0.8.8), these are
+# filled in by _check_requests() before the first request is made.
 SSL_ENABLED = False
 CONFIG_ENABLED = False  # This was added in 0.7 (but taken out in >=1.0)
 _REQ_VER = None
-try:
-    from distutils.version import LooseVersion
-    import pkg_resources
-    _REQ = pkg_resources.get_distribution('requests')
-    _REQ_VER = LooseVersion(_REQ.version)
-    if _REQ_VER >= LooseVersion('0.8.8'):
-        SSL_ENABLED = True
-    if _REQ_VER >= LooseVersion('0.7.0') and _REQ_VER < LooseVersion('1.0.0'):
-        CONFIG_ENABLED = True
-except ImportError:
-    pass
+_REQ_CHECKED = False
+_REQ_CHECK_LOCK = threading.Lock()
+
+
+def _check_requests():
+    global SSL_ENABLED, CONFIG_ENABLED, _REQ_VER, _REQ_CHECKED
+    if _REQ_CHECKED:
+        return
+    # Requests are made from several threads at once, none of them may go
+    # ahead (without ssl verification) until the flags are known.
+    with _REQ_CHECK_LOCK:
+        if _REQ_CHECKED:
+            return
+        try:
+            from distutils.version import LooseVersion
+            import pkg_resources
+            req_dist = pkg_resources.get_distribution('requests')
+            _REQ_VER = LooseVersion(req_dist.version)
+            if _REQ_VER >= LooseVersion('0.8.8'):
+                SSL_ENABLED = True
+            if (_REQ_VER >= LooseVersion('0.7.0') and
+                    _REQ_VER < LooseVersion('1.0.0')):
+                CONFIG_ENABLED = True
+        except ImportError:
+            pass
+        _REQ_CHECKED = True
+
+
+# Sessions (and their kept-alive connections) are shared per scheme + host
+# until close_sessions() is called, which is done at the end of each stage
+# (the boot daemon keeps them for all of the stages it runs).
+DEF_SESSION_POOL_SIZE = 10
+_SESSION_POOL_SIZE = DEF_SESSION_POOL_SIZE
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def configure_sessions(pool_size=None):
+    """Set how many connections are kept alive per host.
+
+    Any existing sessions are closed so the new size applies to
+    connections made from now on.
+    """
+    global _SESSION_POOL_SIZE
+    if pool_size is None:
+        pool_size = DEF_SESSION_POOL_SIZE
+    pool_size = max(int(pool_size), 1)
+    if pool_size != _SESSION_POOL_SIZE:
+        close_sessions()
+        _SESSION_POOL_SIZE = pool_size
+
+
+def close_sessions():
+    """Close all pooled sessions (and their kept-alive connections)."""
+    with _SESSIONS_LOCK:
+        sessions = list(_SESSIONS.values())
+        _SESSIONS.clear()
+    for session in sessions:
+        try:
+            session.close()
+        except Exception:
+            LOG.debug("Failed closing url session %s", session,
+                      exc_info=True)
+
+
+# Set by cancelled_by (for the thread it is used in) to an event which,
+# once set, makes retrying requests give up instead of waiting to retry.
+_CANCEL = threading.local()
+
+
+@contextlib.contextmanager
+def cancelled_by(event):
+    """Stop retrying requests made in this thread once event is set."""
+    previous = getattr(_CANCEL, 'event', None)
+    _CANCEL.event = event
+    try:
+        yield event
+    finally:
+        _CANCEL.event = previous
+
+
+def _wait_to_retry(delay):
+    # Returns False (as soon as it is) when retrying has been cancelled
+    event = getattr(_CANCEL, 'event', None)
+    if event is None:
+        time.sleep(delay)
+        return True
+    return not event.wait(delay)
+
+
+def _retry_cancelled():
+    event = getattr(_CANCEL, 'event', None)
+    return event is not None and event.is_set()
+
+
+def _get_session(url):
+    parsed_url = urlparse(url)
+    key = (parsed_url.scheme, parsed_url.netloc)
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = requests.Session()
+            # Like one-off requests, pooled sessions never carry cookies
+            # from one request to the next.
+            session.cookies.set_policy(
+                http_cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=_SESSION_POOL_SIZE)
+            session.mount("%s://" % parsed_url.scheme, adapter)
+            _SESSIONS[key] = session
+        return session
+
+
+def _request(**req_args):
+    if CONFIG_ENABLED:
+        # Sessions in these old versions do not support adapters (and
+        # so connection pooling), make one-off requests instead.
+        return requests.request(**req_args)
+    return _get_session(req_args['url']).request(**req_args)
 
 
 def _cleanurl(url):
@@ -162,6 +290,103 @@ class UrlError(IOError):
         self.url = url
 
 
+class RetryPolicy(object):
+    """Paces the retries of url requests.
+
+    The delay before retry number ``attempt`` (counting from 0) grows
+    exponentially, ``base_delay * factor ** attempt`` capped at
+    ``max_delay``, and with ``jitter`` a random delay between 0 and that
+    value is used instead so that many instances retrying against the same
+    service do not do so in lockstep. A ``Retry-After`` header sent with a
+    429 or 503 response is honored (still capped at ``max_delay``).
+
+    A ``budget`` (if given) is the total number of retries that all the
+    requests sharing this policy may make; once it is spent failures are
+    raised (or reported) without further retries.
+    """
+
+    def __init__(self, base_delay=1, factor=2, max_delay=30, jitter=True,
+                 budget=None):
+        self.base_delay = max(float(base_delay), 0)
+        self.factor = max(float(factor), 1)
+        self.max_delay = max(float(max_delay), 0)
+        self.jitter = bool(jitter)
+        if budget is not None:
+            budget = max(int(budget), 0)
+        self.budget = budget
+        self.settings = (self.base_delay, self.factor, self.max_delay,
+                         self.jitter, budget)
+        self._lock = threading.Lock()
+
+    def allow_retry(self):
+        """Consume one retry from the budget, if there is one left."""
+        with self._lock:
+            if self.budget is None:
+                return True
+            if self.budget <= 0:
+                return False
+            self.budget -= 1
+            return True
+
+    def delay(self, attempt, exception=None):
+        """Seconds to sleep before retrying after ``attempt`` failed."""
+        retry_after = _get_retry_after(exception)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        try:
+            delay = self.base_delay * (self.factor ** attempt)
+        except OverflowError:
+            delay = self.max_delay
+        delay = min(delay, self.max_delay)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+# The policy used by readurl and wait_for_url when none is passed in, see
+# configure_retry_policy().
+_RETRY_POLICY = None
+
+
+def configure_retry_policy(policy_cfg=None):
+    """Set (or with None, clear) the default retry policy.
+
+    policy_cfg is a dictionary of RetryPolicy arguments. The policy (and
+    so its budget) lasts for the stage, configuring it again with the same
+    arguments (as is done once user-data was consumed) keeps it.
+    """
+    global _RETRY_POLICY
+    if policy_cfg is None:
+        _RETRY_POLICY = None
+        return
+    policy = RetryPolicy(**policy_cfg)
+    if _RETRY_POLICY is None or _RETRY_POLICY.settings != policy.settings:
+        _RETRY_POLICY = policy
+
+
+def _get_retry_after(exception):
+    if not isinstance(exception, UrlError):
+        return None
+    if exception.code not in RETRY_AFTER_CODES:
+        return None
+    value = exception.headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        pass
+    else:
+        # (nan and inf are floats too, but not something to sleep for)
+        if math.isnan(delay) or math.isinf(delay):
+            return None
+        return max(delay, 0)
+    parsed = parsedate(value)
+    if parsed is None:
+        return None
+    return max(calendar.timegm(parsed) - time.time(), 0)
+
+
 def _get_ssl_args(url, ssl_details):
     ssl_args = {}
     scheme = urlparse(url).scheme
@@ -184,7 +409,9 @@ def _get_ssl_args(url, ssl_details):
 
 def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
             headers=None, headers_cb=None, ssl_details=None,
-            check_status=True, allow_redirects=True, exception_cb=None):
+            check_status=True, allow_redirects=True, exception_cb=None,
+            retry_policy=None):
+    _check_requests()
     url = _cleanurl(url)
     req_args = {
         'url': url,
@@ -228,6 +455,8 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
         req_args['data'] = data
     if sec_between is None:
         sec_between = -1
+    if retry_policy is None:
+        retry_policy = _RETRY_POLICY
 
     excps = []
     # Handle retrying ourselves since the built-in support
@@ -243,7 +472,7 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
             LOG.debug("[%s/%s] open '%s' with %s configuration", i,
                       manual_tries, url, filtered_req_args)
 
-            r = requests.request(**req_args)
+            r = _request(**req_args)
             if check_status:
                 r.raise_for_status()
             LOG.debug("Read from %s (%s, %sb) after %s attempts", url,
@@ -269,10 +498,24 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
                 # if an exception callback was given it should return None
                 # a true-ish value means to break and re-raise the exception
                 break
-            if i + 1 < manual_tries and sec_between > 0:
+            if i + 1 < manual_tries and _retry_cancelled():
+                LOG.debug("Retrying cancelled, not retrying %s", url)
+                break
+            if i + 1 < manual_tries and retry_policy is not None:
+                if not retry_policy.allow_retry():
+                    LOG.debug("Retry budget exhausted, not retrying %s", url)
+                    break
+                delay = retry_policy.delay(i, excps[-1])
+                if delay > 0:
+                    LOG.debug("Please wait %.2f seconds while we wait to try"
+                              " again", delay)
+                    if not _wait_to_retry(delay):
+                        break
+            elif i + 1 < manual_tries and sec_between > 0:
                 LOG.debug("Please wait %s seconds while we wait to try again",
                           sec_between)
-                time.sleep(sec_between)
+                if not _wait_to_retry(sec_between):
+                    break
     if excps:
         raise excps[-1]
     return None  # Should throw before this...
@@ -280,7 +523,7 @@ def readurl(url, data=None, timeout=None, retries=0, sec_between=1,
 
 def wait_for_url(urls, max_wait=None, timeout=None,
                  status_cb=None, headers_cb=None, sleep_time=1,
-                 exception_cb=None):
+                 exception_cb=None, concurrent=False, retry_policy=None):
     """
     urls:      a list of urls to try
     max_wait:  roughly the maximum time to wait before giving up
@@ -293,6 +536,12 @@ def wait_for_url(urls, max_wait=None, timeout=None,
                 for request.
     exception_cb: call method with 2 arguments 'msg' (per status_cb) and
                   'exception', the exception that occurred.
+    concurrent: try all of the urls at the same time (rather than one after
+                another) and return the first one that responds, so an
+                unresponsive url does not hold up the others.
+    retry_policy: a RetryPolicy pacing the rounds of tries (defaults to the
+                  configured policy, if any, otherwise the wait grows by a
+                  second every 5 rounds).
 
     the idea of this routine is to wait for the EC2 metdata service to
     come up.  On both Eucalyptus and EC2 we have seen the case where
@@ -321,68 +570,141 @@ def wait_for_url(urls, max_wait=None, timeout=None,
         return ((max_wait <= 0 or max_wait is None) or
                 (time.time() - start_time > max_wait))
 
-    loop_n = 0
-    while True:
-        sleep_time = int(loop_n / 5) + 1
-        for url in urls:
-            now = time.time()
-            if loop_n != 0:
-                if timeup(max_wait, start_time):
+    def get_headers(url):
+        if headers_cb is not None:
+            return headers_cb(url)
+        return {}
+
+    if retry_policy is None:
+        retry_policy = _RETRY_POLICY
+
+    def report_failure(url, reason, url_exc):
+        failures.append(url_exc)
+        time_taken = int(time.time() - start_time)
+        status_msg = "Calling '%s' failed [%s/%ss]: %s" % (url,
+                                                           time_taken,
+                                                           max_wait,
+                                                           reason)
+        status_cb(status_msg)
+        if exception_cb:
+            # This can be used to alter the headers that will be sent
+            # in the future, for example this is what the MAAS datasource
+            # does.
+            exception_cb(msg=status_msg, exception=url_exc)
+
+    executor = None
+    if concurrent and len(urls) > 1:
+        if futures is None:
+            LOG.debug("Concurrent url waiting requested, but"
+                      " concurrent.futures is not available; trying"
+                      " urls one at a time")
+        else:
+            executor = futures.ThreadPoolExecutor(len(urls))
+
+    failures = []
+    try:
+        loop_n = 0
+        while True:
+            if executor is not None:
+                if loop_n != 0:
+                    if timeup(max_wait, start_time):
+                        break
+                    timeout = _shorten_timeout(timeout, max_wait, start_time)
+                pending = {}
+                for url in urls:
+                    try:
+                        fut = executor.submit(_probe_url, url,
+                                              get_headers(url), timeout)
+                    except Exception as e:
+                        report_failure(url, "unexpected error [%s]" % e, e)
+                    else:
+                        pending[fut] = url
+                for fut in futures.as_completed(pending):
+                    url = pending[fut]
+                    (reason, url_exc) = fut.result()
+                    if url_exc is None:
+                        return url
+                    report_failure(url, reason, url_exc)
+            else:
+                for url in urls:
+                    if loop_n != 0:
+                        if timeup(max_wait, start_time):
+                            break
+                        timeout = _shorten_timeout(timeout, max_wait,
+                                                   start_time)
+                    try:
+                        headers = get_headers(url)
+                    except Exception as e:
+                        report_failure(url, "unexpected error [%s]" % e, e)
+                        continue
+                    (reason, url_exc) = _probe_url(url, headers, timeout)
+                    if url_exc is None:
+                        return url
+                    report_failure(url, reason, url_exc)
+
+            if timeup(max_wait, start_time):
+                break
+            if _retry_cancelled():
+                LOG.debug("Waiting for %s cancelled", urls)
+                break
+
+            if retry_policy is not None:
+                if not retry_policy.allow_retry():
+                    LOG.debug("Retry budget exhausted, giving up on %s",
+                              urls)
                     break
-                if timeout and (now + timeout > (start_time + max_wait)):
-                    # shorten timeout to not run way over max_time
-                    timeout = int((start_time + max_wait) - now)
-
-            reason = ""
-            url_exc = None
-            try:
-                if headers_cb is not None:
-                    headers = headers_cb(url)
-                else:
-                    headers = {}
-
-                response = readurl(url, headers=headers, timeout=timeout,
-                                   check_status=False)
-                if not response.contents:
-                    reason = "empty response [%s]" % (response.code)
-                    url_exc = UrlError(ValueError(reason), code=response.code,
-                                       headers=response.headers, url=url)
-                elif not response.ok():
-                    reason = "bad status code [%s]" % (response.code)
-                    url_exc = UrlError(ValueError(reason), code=response.code,
-                                       headers=response.headers, url=url)
-                else:
-                    return url
-            except UrlError as e:
-                reason = "request error [%s]" % e
-                url_exc = e
-            except Exception as e:
-                reason = "unexpected error [%s]" % e
-                url_exc = e
-
-            time_taken = int(time.time() - start_time)
-            status_msg = "Calling '%s' failed [%s/%ss]: %s" % (url,
-                                                               time_taken,
-                                                               max_wait,
-                                                               reason)
-            status_cb(status_msg)
-            if exception_cb:
-                # This can be used to alter the headers that will be sent
-                # in the future, for example this is what the MAAS datasource
-                # does.
-                exception_cb(msg=status_msg, exception=url_exc)
-
-        if timeup(max_wait, start_time):
-            break
-
-        loop_n = loop_n + 1
-        LOG.debug("Please wait %s seconds while we wait to try again",
-                  sleep_time)
-        time.sleep(sleep_time)
+                last_exc = None
+                if failures:
+                    last_exc = failures[-1]
+                sleep_time = retry_policy.delay(loop_n, last_exc)
+            else:
+                sleep_time = int(loop_n / 5) + 1
+            loop_n = loop_n + 1
+            LOG.debug("Please wait %s seconds while we wait to try again",
+                      sleep_time)
+            if not _wait_to_retry(sleep_time):
+                LOG.debug("Waiting for %s cancelled", urls)
+                break
+    finally:
+        if executor is not None:
+            # Slower urls are left to time out in the background.
+            executor.shutdown(wait=False)
 
     return False
 
 
+def _shorten_timeout(timeout, max_wait, start_time):
+    # shorten timeout to not run way over max_time
+    now = time.time()
+    if timeout and (now + timeout > (start_time + max_wait)):
+        timeout = int((start_time + max_wait) - now)
+    return timeout
+
+
+def _probe_url(url, headers, timeout):
+    """Try a url once (as wait_for_url does).
+
+    Returns a tuple of (reason, exception) describing why the url was not
+    usable, or (None, None) when it responded with content.
+    """
+    try:
+        response = readurl(url, headers=headers, timeout=timeout,
+                           check_status=False)
+        if not response.contents:
+            reason = "empty response [%s]" % (response.code)
+            return (reason, UrlError(ValueError(reason), code=response.code,
+                                     headers=response.headers, url=url))
+        elif not response.ok():
+            reason = "bad status code [%s]" % (response.code)
+            return (reason, UrlError(ValueError(reason), code=response.code,
+                                     headers=response.headers, url=url))
+        return (None, None)
+    except UrlError as e:
+        return ("request error [%s]" % e, e)
+    except Exception as e:
+        return ("unexpected error [%s]" % e, e)
+
+
 class OauthUrlHelper(object):
     def __init__(self, consumer_key=None, token_key=None,
                  token_secret=None, consumer_secret=None,
@@ -20,8 +20,18 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import codecs
+import contextlib
+import copy
+import gzip
+import hashlib
+import io
+import json
 import os
+import uuid
 
+from email.feedparser import FeedParser
+from email.generator import Generator
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.nonmultipart import MIMENonMultipart
@@ -29,8 +39,14 @@ from email.mime.text import MIMEText
 
 import six
 
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
 from cloudinit import handlers
 from cloudinit import log as logging
+from cloudinit import url_helper
 from cloudinit import util
 
 LOG = logging.getLogger(__name__)
@@ -70,6 +86,126 @@ ATTACHMENT_FIELD = 'Number-Attachments'
 # in there payload, evey other content type can still provide a header
 EXAMINE_FOR_LAUNCH_INDEX = ["text/cloud-config"]
 
+# Parts kept on disk (instead of in the message) name their file in this
+# header, see util.fully_decoded_payload
+SPOOLED_HEADER = util.SPOOLED_PAYLOAD_HEADER
+
+# Compressed data is decompressed (and parsed) this much at a time
+CHUNK_SIZE = 64 * 1024
+
+# How much of the start of a payload is looked at to find its type
+TYPE_PEEK_SIZE = 4096
+
+# The 'userdata_limits' that apply when not configured, in bytes (zero
+# meaning no limit). max_size bounds all the parts of one user-data (after
+# decompression) together, max_part_size each part on its own and parts
+# larger than spool_size are kept on disk until they are consumed.
+DEF_LIMITS = {
+    'max_size': 0,
+    'max_part_size': 0,
+    'spool_size': 1024 * 1024,
+}
+
+
+# How many of the urls #include'd by one part are fetched at the same time
+DEF_INCLUDE_WORKERS = 4
+
+# Where (under the cloud dir's data directory) the responses to #include'd
+# http(s) urls are kept, see IncludeCache
+INCLUDE_CACHE_DIR = "include-cache"
+INCLUDE_CACHE_VERSION = 1
+
+
+class UserDataTooLarge(Exception):
+    pass
+
+
+def _content_hash(contents):
+    return hashlib.sha256(util.encode_text(contents)).hexdigest()
+
+
+class IncludeCache(object):
+    """Keeps the last response of each #include'd http(s) url.
+
+    Fetching such a url again is then a conditional request (with the
+    If-None-Match and If-Modified-Since headers made from the ETag and
+    Last-Modified it was sent with) and an unchanged one is answered from
+    here. Only responses that have such a validator (and do not forbid
+    storing them) are kept. A cached copy whose content no longer matches
+    the hash recorded for it is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _paths(self, url):
+        key = _content_hash(url)
+        return (os.path.join(self.path, "%s.json" % (key)),
+                os.path.join(self.path, key))
+
+    def _load(self, url):
+        (meta_fn, body_fn) = self._paths(url)
+        if not os.path.isfile(meta_fn):
+            return None
+        try:
+            meta = json.loads(util.load_file(meta_fn))
+            body = util.load_file(body_fn, decode=False)
+        except (IOError, OSError, ValueError) as e:
+            LOG.debug("Ignoring include cache entry for %s: %s", url, e)
+            return None
+        if (not isinstance(meta, dict) or
+                meta.get('version') != INCLUDE_CACHE_VERSION or
+                meta.get('url') != url or
+                meta.get('sha256') != _content_hash(body)):
+            LOG.debug("Ignoring stale or damaged include cache entry for %s",
+                      url)
+            return None
+        return (meta, body)
+
+    def _store(self, url, resp):
+        (meta_fn, body_fn) = self._paths(url)
+        headers = resp.headers or {}
+        meta = {
+            'version': INCLUDE_CACHE_VERSION,
+            'url': url,
+            'etag': headers.get('etag'),
+            'last-modified': headers.get('last-modified'),
+        }
+        cache_control = (headers.get('cache-control') or '').lower()
+        if ((not meta['etag'] and not meta['last-modified']) or
+                'no-store' in cache_control):
+            util.del_file(meta_fn)
+            util.del_file(body_fn)
+            return
+        meta['sha256'] = _content_hash(resp.contents)
+        util.write_file(body_fn, resp.contents, mode=0o600)
+        util.write_file(meta_fn, json.dumps(meta), mode=0o600)
+
+    def read(self, url, ssl_details=None):
+        cached = self._load(url)
+        headers = {}
+        if cached:
+            (meta, body) = cached
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last-modified'):
+                headers['If-Modified-Since'] = meta['last-modified']
+        resp = util.read_file_or_url(url, headers=headers or None,
+                                     ssl_details=ssl_details)
+        if cached and resp.code == 304:
+            LOG.debug("Included %s is unchanged, using the cached copy", url)
+            return url_helper.StringResponse(body)
+        if resp.ok():
+            try:
+                self._store(url, resp)
+            except (IOError, OSError):
+                util.logexc(LOG, "Failed caching included %s", url)
+        return resp
+
+
+def _is_http(url):
+    return url.lower().startswith(("http://", "https://"))
+
 
 def _replace_header(msg, key, value):
     del msg[key]
@@ -82,26 +218,175 @@ def _set_filename(msg, filename):
                    'attachment', filename=str(filename))
 
 
+def _size_limit(limits, name):
+    try:
+        return max(0, int(limits.get(name, DEF_LIMITS[name]) or 0))
+    except (TypeError, ValueError):
+        LOG.warn("Invalid user-data limit %s: %s, using %s", name,
+                 limits.get(name), DEF_LIMITS[name])
+        return DEF_LIMITS[name]
+
+
 class UserDataProcessor(object):
-    def __init__(self, paths):
+    def __init__(self, paths, limits=None, include_workers=None):
         self.paths = paths
         self.ssl_details = util.fetch_ssl_details(paths)
-
-    def process(self, blob):
+        try:
+            self.include_workers = max(1, int(include_workers or
+                                              DEF_INCLUDE_WORKERS))
+        except (TypeError, ValueError):
+            LOG.warn("Invalid include workers %s, using %s",
+                     include_workers, DEF_INCLUDE_WORKERS)
+            self.include_workers = DEF_INCLUDE_WORKERS
+        if not isinstance(limits, dict):
+            limits = {}
+        self.max_size = _size_limit(limits, 'max_size')
+        self.max_part_size = _size_limit(limits, 'max_part_size')
+        self.spool_size = _size_limit(limits, 'spool_size')
+        self._reset()
+
+    def _reset(self, spool_dir=None):
+        self._spool_dir = spool_dir
+        self._spooled = 0
+        self._size = 0
+
+    def process(self, blob, spool_dir=None):
+        """Turns (a list of) raw user-data into one multipart message.
+
+        When a spool_dir is given, parts larger than the spool_size limit
+        are written there (and only read back when consumed) instead of
+        being kept in the message.
+        """
+        self._reset(spool_dir)
         accumulating_msg = MIMEMultipart()
-        if isinstance(blob, list):
+        if not isinstance(blob, list):
+            blob = [blob]
+        try:
             for b in blob:
-                self._process_msg(convert_string(b), accumulating_msg)
-        else:
-            self._process_msg(convert_string(blob), accumulating_msg)
+                try:
+                    base_msg = convert_string(b, max_size=self._remaining())
+                except UserDataTooLarge as e:
+                    LOG.warn("Skipping user-data: %s", e)
+                    continue
+                self._process_msg(base_msg, accumulating_msg)
+        finally:
+            self._reset()
         return accumulating_msg
 
+    def _remaining(self):
+        if not self.max_size:
+            return 0
+        return max(1, self.max_size - self._size)
+
+    def _part_limit(self):
+        limits = [l for l in (self.max_part_size, self._remaining()) if l]
+        if not limits:
+            return 0
+        return min(limits)
+
+    def _spool_path(self):
+        if not self._spool_dir or not self.spool_size:
+            return None
+        if not self._spooled and os.path.isdir(self._spool_dir):
+            # Left over from when this was processed before
+            util.delete_dir_contents(self._spool_dir)
+        self._spooled += 1
+        spool_path = os.path.join(self._spool_dir,
+                                  "part-%03d" % (self._spooled))
+        util.trust_spooled_payload(spool_path)
+        return spool_path
+
+    def _spooled_file(self, part):
+        # Only files in this processor's own spool directory are read back
+        spool_path = util.spooled_payload(part)
+        if not spool_path or not self._spool_dir:
+            return None
+        spool_dir = os.path.join(os.path.abspath(self._spool_dir), '')
+        if not os.path.abspath(spool_path).startswith(spool_dir):
+            LOG.warn("Ignoring spooled payload %s outside of %s",
+                     spool_path, self._spool_dir)
+            return None
+        return spool_path
+
+    def _decompress(self, payload):
+        """Decompresses (and utf-8 decodes) a part's payload.
+
+        Returns a tuple of the decompressed payload and None, or (once it
+        grew larger than spool_size) of the start of the payload and the
+        file that the whole payload was written to instead.
+        """
+        # (It is only decoded to check that it is text, the bytes are what
+        # is kept.)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = []
+        size = 0
+        spool_fh = None
+        spool_path = None
+        head = ''
+        try:
+            for chunk in _gunzip_chunks(payload, self._part_limit()):
+                text = decoder.decode(chunk)
+                if len(head) < TYPE_PEEK_SIZE:
+                    head += text[0:TYPE_PEEK_SIZE - len(head)]
+                size += len(chunk)
+                chunks.append(chunk)
+                if (spool_fh is None and self.spool_size and
+                        size > self.spool_size):
+                    spool_path = self._spool_path()
+                    if spool_path:
+                        util.ensure_dir(os.path.dirname(spool_path))
+                        spool_fh = open(spool_path, 'wb')
+                        util.chmod(spool_path, 0o600)
+                if spool_fh is not None:
+                    for chunk in chunks:
+                        spool_fh.write(chunk)
+                    chunks = []
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError as e:
+            raise util.DecompressionError(six.text_type(e))
+        finally:
+            if spool_fh is not None:
+                spool_fh.close()
+        if spool_fh is not None:
+            return (head, spool_path)
+        return (util.decode_binary(b''.join(chunks)), None)
+
+    def _spool(self, part):
+        # Moves the (decoded) payload of a large part out to a file
+        payload = part.get_payload()
+        if (part.is_multipart() or SPOOLED_HEADER in part or
+                not self.spool_size or not payload or
+                len(payload) <= self.spool_size):
+            return
+        spool_path = self._spool_path()
+        if not spool_path:
+            return
+        util.write_file(spool_path, part.get_payload(decode=True), 0o600)
+        del part['Content-Transfer-Encoding']
+        part[SPOOLED_HEADER] = spool_path
+        part.set_payload('')
+
+    def _part_size(self, part):
+        spool_path = self._spooled_file(part)
+        if spool_path:
+            try:
+                return os.path.getsize(spool_path)
+            except OSError:
+                return 0
+        payload = part.get_payload()
+        if part.is_multipart() or not payload:
+            return 0
+        return len(payload)
+
     def _process_msg(self, base_msg, append_msg):
 
         def find_ctype(payload):
             return handlers.type_from_starts_with(payload)
 
         for part in base_msg.walk():
+            # Only this processor may say where a payload was spooled to,
+            # a header like that in the data given to it is not believed.
+            del part[SPOOLED_HEADER]
             if is_skippable(part):
                 continue
 
@@ -109,13 +394,14 @@ class UserDataProcessor(object):
             ctype_orig = part.get_content_type()
             payload = util.fully_decoded_payload(part)
             was_compressed = False
+            spool_path = None
 
             # When the message states it is of a gzipped content type ensure
             # that we attempt to decode said payload so that the decompressed
             # data can be examined (instead of the compressed data).
             if ctype_orig in DECOMP_TYPES:
                 try:
-                    payload = util.decomp_gzip(payload, quiet=False)
+                    (payload, spool_path) = self._decompress(payload)
                     # At this point we don't know what the content-type is
                     # since we just decompressed it.
                     ctype_orig = None
@@ -124,6 +410,9 @@ class UserDataProcessor(object):
                     LOG.warn("Failed decompressing payload from %s of length"
                              " %s due to: %s", ctype_orig, len(payload), e)
                     continue
+                except UserDataTooLarge as e:
+                    LOG.warn("Skipping payload from %s: %s", ctype_orig, e)
+                    continue
 
             # Attempt to figure out the payloads content-type
             if not ctype_orig:
@@ -140,7 +429,11 @@ class UserDataProcessor(object):
             if was_compressed:
                 maintype, subtype = ctype.split("/", 1)
                 n_part = MIMENonMultipart(maintype, subtype)
-                n_part.set_payload(payload)
+                if spool_path:
+                    n_part[SPOOLED_HEADER] = spool_path
+                    n_part.set_payload('')
+                else:
+                    n_part.set_payload(payload)
                 # Copy various headers from the old part to the new one,
                 # but don't include all the headers since some are not useful
                 # after decoding and decompression.
@@ -154,6 +447,10 @@ class UserDataProcessor(object):
             if ctype != ctype_orig:
                 _replace_header(part, CONTENT_TYPE, ctype)
 
+            if spool_path and ctype in INCLUDE_TYPES + ARCHIVE_TYPES:
+                # These are needed whole (they are rarely large)
+                payload = util.load_file(spool_path)
+
             if ctype in INCLUDE_TYPES:
                 self._do_include(payload, append_msg)
                 continue
@@ -175,7 +472,7 @@ class UserDataProcessor(object):
             try:
                 # See if it has a launch-index field
                 # that might affect the final header
-                payload = util.load_yaml(msg.get_payload(decode=True))
+                payload = util.load_yaml(util.fully_decoded_payload(msg))
                 if payload:
                     payload_idx = payload.get('launch-index')
             except Exception:
@@ -202,10 +499,62 @@ class UserDataProcessor(object):
             _set_filename(msg, PART_FN_TPL % (attached_id))
         self._attach_launch_index(msg)
 
+    def _include_cache(self):
+        if not self.paths:
+            return None
+        return IncludeCache(os.path.join(self.paths.get_cpath('data'),
+                                         INCLUDE_CACHE_DIR))
+
+    def _read_include(self, include_url):
+        cache = self._include_cache()
+        if cache is None or not _is_http(include_url):
+            return util.read_file_or_url(include_url,
+                                         ssl_details=self.ssl_details)
+        return cache.read(include_url, ssl_details=self.ssl_details)
+
+    def _fetch_include(self, include_url, include_once_on):
+        include_once_fn = None
+        if include_once_on:
+            include_once_fn = self._get_include_once_filename(include_url)
+        if include_once_on and os.path.isfile(include_once_fn):
+            return util.load_file(include_once_fn)
+        resp = self._read_include(include_url)
+        if include_once_on and resp.ok():
+            util.write_file(include_once_fn, resp.contents, mode=0o600)
+        if resp.ok():
+            return resp.contents
+        LOG.warn(("Fetching from %s resulted in"
+                  " a invalid http code of %s"),
+                 include_url, resp.code)
+        return None
+
+    def _fetch_includes(self, includes):
+        # Fetches (up to include_workers of) them at the same time, but
+        # yields what each returned in the order they were listed in.
+        workers = min(self.include_workers, len(includes))
+        if workers <= 1 or futures is None:
+            for (include_url, include_once_on) in includes:
+                yield (include_url,
+                       self._fetch_include(include_url, include_once_on))
+            return
+        with futures.ThreadPoolExecutor(workers) as executor:
+            pending = [(include_url, executor.submit(self._fetch_include,
+                                                     include_url,
+                                                     include_once_on))
+                       for (include_url, include_once_on) in includes]
+            try:
+                for (include_url, fut) in pending:
+                    yield (include_url, fut.result())
+            finally:
+                # Those not started yet are not needed after a failure
+                for (_include_url, fut) in pending:
+                    fut.cancel()
+
     def _do_include(self, content, append_msg):
         # Include a list of urls, one per line
         # also support '#include <url here>'
         # or #include-once '<url here>'
+        includes = []
         include_once_on = False
         for line in content.splitlines():
             lc_line = line.lower()
@@ -225,27 +574,16 @@ class UserDataProcessor(object):
             include_url = line.strip()
             if not include_url:
                 continue
+            includes.append((include_url, include_once_on))
 
-            include_once_fn = None
-            content = None
-            if include_once_on:
-                include_once_fn = self._get_include_once_filename(include_url)
-            if include_once_on and os.path.isfile(include_once_fn):
-                content = util.load_file(include_once_fn)
-            else:
-                resp = util.read_file_or_url(include_url,
-                                             ssl_details=self.ssl_details)
-                if include_once_on and resp.ok():
-                    util.write_file(include_once_fn, resp.contents, mode=0o600)
-                if resp.ok():
-                    content = resp.contents
-                else:
-                    LOG.warn(("Fetching from %s resulted in"
-                              " a invalid http code of %s"),
-                             include_url, resp.code)
-
+        for (include_url, content) in self._fetch_includes(includes):
             if content is not None:
-                new_msg = convert_string(content)
+                try:
+                    new_msg = convert_string(content,
+                                             max_size=self._remaining())
+                except UserDataTooLarge as e:
+                    LOG.warn("Skipping included %s: %s", include_url, e)
+                    continue
                 self._process_msg(new_msg, append_msg)
 
     def _explode_archive(self, archive, append_msg):
@@ -289,6 +627,7 @@ class UserDataProcessor(object):
                 if header.lower() in ('content', 'filename', 'type',
                                       'launch-index', 'content-disposition',
                                       ATTACHMENT_FIELD.lower(),
+                                      SPOOLED_HEADER.lower(),
                                       CONTENT_TYPE.lower()):
                     continue
                 msg.add_header(header, ent[header])
@@ -319,8 +658,21 @@ class UserDataProcessor(object):
         Modifies a header in the outer message to keep track of number of
         attachments.
         """
+        size = self._part_size(part)
+        if self.max_part_size and size > self.max_part_size:
+            LOG.warn("Skipping user-data part %s of %s bytes, larger than"
+                     " the limit of %s", part.get_filename() or '',
+                     size, self.max_part_size)
+            return
+        if self.max_size and self._size + size > self.max_size:
+            LOG.warn("Skipping user-data part %s of %s bytes, all of the"
+                     " user-data would be larger than the limit of %s",
+                     part.get_filename() or '', size, self.max_size)
+            return
+        self._size += size
         part_count = self._multi_part_count(outer_msg)
         self._process_before_attach(part, part_count + 1)
+        self._spool(part)
         outer_msg.attach(part)
         self._multi_part_count(outer_msg, part_count + 1)
 
@@ -333,20 +685,164 @@ def is_skippable(part):
     return False
 
 
-# Coverts a raw string into a mime message
-def convert_string(raw_data, headers=None):
-    if not raw_data:
-        raw_data = ''
-    if not headers:
-        headers = {}
-    data = util.decode_binary(util.decomp_gzip(raw_data))
-    if "mime-version:" in data[0:4096].lower():
-        msg = util.message_from_string(data)
+def _gunzip_chunks(data, max_size=0):
+    # Yields the decompressed data a chunk at a time (so it does not all
+    # have to be in memory at once just to be handed along).
+    buf = six.BytesIO(util.encode_text(data))
+    size = 0
+    try:
+        with contextlib.closing(gzip.GzipFile(None, "rb", 1, buf)) as gh:
+            while True:
+                chunk = gh.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise UserDataTooLarge("larger than %s bytes once"
+                                           " decompressed" % (max_size))
+                yield chunk
+    except UserDataTooLarge:
+        raise
+    except Exception as e:
+        raise util.DecompressionError(six.text_type(e))
+
+
+def _is_gzipped(data):
+    return util.encode_text(data[0:2]) == b'\x1f\x8b'
+
+
+def _decoded_chunks(raw_data, max_size=0):
+    if not _is_gzipped(raw_data):
+        if max_size and len(raw_data) > max_size:
+            raise UserDataTooLarge("%s bytes, larger than %s"
+                                   % (len(raw_data), max_size))
+        yield util.decode_binary(raw_data)
+        return
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in _gunzip_chunks(raw_data, max_size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+def _chunks_to_message(chunks, headers):
+    # Only as much as is needed to tell if it is a mime message is read
+    # up front, the rest is parsed as it is decompressed.
+    head = ''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= TYPE_PEEK_SIZE:
+            break
+    if "mime-version:" in head[0:TYPE_PEEK_SIZE].lower():
+        parser = FeedParser()
+        parser.feed(head)
+        for chunk in chunks:
+            parser.feed(chunk)
+        msg = parser.close()
         for (key, val) in headers.items():
             _replace_header(msg, key, val)
     else:
         mtype = headers.get(CONTENT_TYPE, NOT_MULTIPART_TYPE)
         maintype, subtype = mtype.split("/", 1)
         msg = MIMEBase(maintype, subtype, *headers)
-        msg.set_payload(data)
+        msg.set_payload(head + ''.join(chunks))
     return msg
+
+
+# Coverts a raw string into a mime message
+def convert_string(raw_data, headers=None, max_size=0):
+    if not raw_data:
+        raw_data = ''
+    if not headers:
+        headers = {}
+    try:
+        return _chunks_to_message(_decoded_chunks(raw_data, max_size),
+                                  headers)
+    except (util.DecompressionError, UnicodeDecodeError):
+        if not _is_gzipped(raw_data):
+            raise
+        # Not really gzipped after all, taken as it is (like it was
+        # before it was attempted).
+        return _chunks_to_message(iter([util.decode_binary(raw_data)]),
+                                  headers)
+
+
+def _generator(fh):
+    # The same one Message.as_string (and so str(msg)) uses
+    if six.PY2:
+        return Generator(fh)
+    return Generator(fh, mangle_from_=False, maxheaderlen=0)
+
+
+def _without_spooled(msg, spooled):
+    # A copy of msg in which the payload of every spooled part is replaced
+    # by a (unique) placeholder, spooled maps those to the spooled files.
+    if msg.is_multipart():
+        parts = [_without_spooled(part, spooled)
+                 for part in msg.get_payload()]
+        if all(a is b for (a, b) in zip(parts, msg.get_payload())):
+            return msg
+        msg = copy.copy(msg)
+        msg.set_payload(parts)
+        return msg
+    spool_path = util.spooled_payload(msg)
+    if not spool_path:
+        return msg
+    placeholder = "@@spooled-payload-%s@@" % (uuid.uuid4().hex)
+    spooled[placeholder] = spool_path
+    msg = copy.copy(msg)
+    del msg[SPOOLED_HEADER]
+    msg.set_payload(placeholder)
+    return msg
+
+
+def _flatten(fh, msg):
+    # Renders msg (its spooled parts with their payload read back from the
+    # spooled file, a chunk at a time) to fh, a file opened for writing
+    # (text on python 3).
+    spooled = {}
+    msg = _without_spooled(msg, spooled)
+    if not spooled:
+        _generator(fh).flatten(msg)
+        return
+    buf = six.StringIO()
+    _generator(buf).flatten(msg)
+    text = buf.getvalue()
+    while spooled:
+        (start, placeholder) = min((text.find(p), p) for p in spooled)
+        fh.write(text[0:start])
+        text = text[start + len(placeholder):]
+        with open(spooled.pop(placeholder), 'rb') as spool_fh:
+            while True:
+                chunk = spool_fh.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if six.PY3:
+                    # (written back out as the same bytes by fh)
+                    chunk = chunk.decode('utf-8', 'surrogateescape')
+                fh.write(chunk)
+    fh.write(text)
+
+
+def write_processed(msg, filename, mode=0o600):
+    """Writes out a processed message (as str(msg) would render it) without
+    building all of it up in memory first.
+
+    The payload of parts that were spooled to disk is written out too (in
+    place of the header naming their file), so the result stands on its
+    own."""
+
+    def write(fh):
+        if msg is None:
+            return
+        if six.PY2:
+            _flatten(fh, msg)
+            return
+        text_fh = io.TextIOWrapper(fh, encoding='utf-8',
+                                   errors='surrogateescape', newline='')
+        try:
+            _flatten(text_fh, msg)
+            text_fh.flush()
+        finally:
+            text_fh.detach()
+
+    util.write_file(filename, write, mode)
@@ -43,6 +43,7 @@ import string
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 from base64 import b64decode, b64encode
@@ -59,7 +60,7 @@ from cloudinit import type_utils
 from cloudinit import url_helper
 from cloudinit import version
 
-from cloudinit.settings import (CFG_BUILTIN)
+from cloudinit.settings import (CFG_BUILTIN, DMI_CACHE)
 
 
 _DNS_REDIRECT_IP = None
@@ -74,6 +75,9 @@ FN_ALLOWED = ('_-.()' + string.digits + string.ascii_letters)
 TRUE_STRINGS = ('true', '1', 'on', 'yes')
 FALSE_STRINGS = ('off', '0', 'no', 'false')
 
+# Bumped whenever the layout of the parsed config cache changes
+CONF_CACHE_VERSION = 1
+
 
 # Helper utils to see if running in a container
 CONTAINER_TESTS = (['systemd-detect-virt', '--quiet', '--container'],
@@ -82,6 +86,25 @@ CONTAINER_TESTS = (['systemd-detect-virt', '--quiet', '--container'],
 
 PROC_CMDLINE = None
 
+# Set on a mime part whose payload was moved out to the file it names.
+# Only the files the user-data processor spooled payloads out to itself
+# (see trust_spooled_payload) are ever read, as anyone providing user-data
+# can set the header too.
+SPOOLED_PAYLOAD_HEADER = 'X-Cloud-Init-Spooled-Payload'
+_SPOOLED_PAYLOADS = set()
+
+# What one 'blkid -o export' run found (see blkid_inventory), kept until
+# invalidate_blkid_inventory is called
+_BLKID_INVENTORY = None
+_BLKID_INVENTORY_LOCK = threading.Lock()
+
+# What find_modules found in each directory, with that directory's mtime
+_FIND_MODULES_CACHE = {}
+
+# Listings taken this soon after their directory changed are not kept, a
+# later change might not move its mtime along (on coarse timestamps).
+_FIND_MODULES_MIN_AGE = 2
+
 
 def decode_binary(blob, encoding='utf-8'):
     # Converts a binary type into a text type using given encoding.
@@ -115,13 +138,34 @@ def b64e(source):
     return b64encode(source).decode('utf-8')
 
 
+def trust_spooled_payload(path):
+    _SPOOLED_PAYLOADS.add(os.path.abspath(path))
+
+
+def spooled_payload(part):
+    """The file a part's payload was spooled out to (or None)."""
+    path = part.get(SPOOLED_PAYLOAD_HEADER)
+    if not path:
+        return None
+    if os.path.abspath(path) not in _SPOOLED_PAYLOADS:
+        LOG.warn("Ignoring %s header naming %s, it was not spooled there",
+                 SPOOLED_PAYLOAD_HEADER, path)
+        return None
+    return path
+
+
 def fully_decoded_payload(part):
     # In Python 3, decoding the payload will ironically hand us a bytes object.
     # 'decode' means to decode according to Content-Transfer-Encoding, not
     # according to any charset in the Content-Type.  So, if we end up with
     # bytes, first try to decode to str via CT charset, and failing that, try
     # utf-8 using surrogate escapes.
-    cte_payload = part.get_payload(decode=True)
+    spooled = spooled_payload(part)
+    if spooled:
+        # Kept on disk (already decoded) by the user-data processor
+        cte_payload = load_file(spooled, decode=False)
+    else:
+        cte_payload = part.get_payload(decode=True)
     if (six.PY3 and
             part.get_content_maintype() == 'text' and
             isinstance(cte_payload, bytes)):
@@ -159,6 +203,35 @@ DMIDECODE_TO_DMI_SYS_MAPPING = {
     'system-version': 'product_version',
 }
 
+# Where (section, field) of a 'dmidecode --type 0,1,2,3' dump is found
+# for each of the above
+DMIDECODE_DUMP_FIELDS = {
+    ('BIOS Information', 'Vendor'): 'bios-vendor',
+    ('BIOS Information', 'Version'): 'bios-version',
+    ('BIOS Information', 'Release Date'): 'bios-release-date',
+    ('System Information', 'Manufacturer'): 'system-manufacturer',
+    ('System Information', 'Product Name'): 'system-product-name',
+    ('System Information', 'Version'): 'system-version',
+    ('System Information', 'Serial Number'): 'system-serial-number',
+    ('System Information', 'UUID'): 'system-uuid',
+    ('Base Board Information', 'Manufacturer'): 'baseboard-manufacturer',
+    ('Base Board Information', 'Product Name'): 'baseboard-product-name',
+    ('Base Board Information', 'Version'): 'baseboard-version',
+    ('Base Board Information', 'Serial Number'): 'baseboard-serial-number',
+    ('Base Board Information', 'Asset Tag'): 'baseboard-asset-tag',
+    ('Chassis Information', 'Manufacturer'): 'chassis-manufacturer',
+    ('Chassis Information', 'Version'): 'chassis-version',
+    ('Chassis Information', 'Serial Number'): 'chassis-serial-number',
+    ('Chassis Information', 'Asset Tag'): 'chassis-asset-tag',
+}
+
+# The DMI values looked up so far (see read_dmi_data), by dmidecode name
+_DMI_SNAPSHOT = None
+_DMI_SNAPSHOT_LOCK = threading.Lock()
+
+# Where read_dmi_data keeps the values for later stages (None to not)
+DMI_CACHE_PATH = DMI_CACHE
+
 
 class ProcessExecutionError(IOError):
 
@@ -417,6 +490,22 @@ def extract_usergroup(ug_pair):
 
 
 def find_modules(root_dir):
+    # A directory's listing only changes when its mtime does, so it is
+    # only read again after that.
+    try:
+        mtime = os.stat(root_dir).st_mtime
+    except OSError:
+        mtime = None
+    cached = _FIND_MODULES_CACHE.get(root_dir)
+    if mtime is not None and cached and cached[0] == mtime:
+        return dict(cached[1])
+    entries = _find_modules(root_dir)
+    if mtime is not None and time.time() - mtime >= _FIND_MODULES_MIN_AGE:
+        _FIND_MODULES_CACHE[root_dir] = (mtime, dict(entries))
+    return entries
+
+
+def _find_modules(root_dir):
     entries = dict()
     for fname in glob.glob(os.path.join(root_dir, "*.py")):
         if not os.path.isfile(fname):
@@ -772,7 +861,7 @@ def fetch_ssl_details(paths=None):
 
 def read_file_or_url(url, timeout=5, retries=10,
                      headers=None, data=None, sec_between=1, ssl_details=None,
-                     headers_cb=None, exception_cb=None):
+                     headers_cb=None, exception_cb=None, retry_policy=None):
     url = url.lstrip()
     if url.startswith("/"):
         url = "file://%s" % url
@@ -798,7 +887,8 @@ def read_file_or_url(url, timeout=5, retries=10,
                                   data=data,
                                   sec_between=sec_between,
                                   ssl_details=ssl_details,
-                                  exception_cb=exception_cb)
+                                  exception_cb=exception_cb,
+                                  retry_policy=retry_policy)
 
 
 def load_yaml(blob, default=None, allowed=(dict,)):
@@ -851,7 +941,7 @@ def read_seeded(base="", ext="", timeout=5, retries=10, file_retries=0):
     return (md, ud)
 
 
-def read_conf_d(confd):
+def _get_conf_d_names(confd):
     # Get reverse sorted list (later trumps newer)
     confs = sorted(os.listdir(confd), reverse=True)
 
@@ -859,39 +949,137 @@ def read_conf_d(confd):
     confs = [f for f in confs if f.endswith(".cfg")]
 
     # Remove anything not a file
-    confs = [f for f in confs
-             if os.path.isfile(os.path.join(confd, f))]
+    return [f for f in confs
+            if os.path.isfile(os.path.join(confd, f))]
 
+
+def read_conf_d(confd):
     # Load them all so that they can be merged
     cfgs = []
-    for fn in confs:
+    for fn in _get_conf_d_names(confd):
         cfgs.append(read_conf(os.path.join(confd, fn)))
 
     return mergemanydict(cfgs)
 
 
-def read_conf_with_confd(cfgfile):
-    cfg = read_conf(cfgfile)
-
-    confd = False
+def _get_conf_d_path(cfgfile, cfg):
+    # Returns the conf.d directory that applies to the given (already
+    # parsed) config file, whether or not that directory exists.
     if "conf_d" in cfg:
         confd = cfg['conf_d']
-        if confd:
-            if not isinstance(confd, six.string_types):
-                raise TypeError(("Config file %s contains 'conf_d' "
-                                 "with non-string type %s") %
-                                (cfgfile, type_utils.obj_name(confd)))
-            else:
-                confd = str(confd).strip()
-    elif os.path.isdir("%s.d" % cfgfile):
-        confd = "%s.d" % cfgfile
+        if not confd:
+            return None
+        if not isinstance(confd, six.string_types):
+            raise TypeError(("Config file %s contains 'conf_d' "
+                             "with non-string type %s") %
+                            (cfgfile, type_utils.obj_name(confd)))
+        return str(confd).strip() or None
+    return "%s.d" % cfgfile
 
-    if not confd or not os.path.isdir(confd):
-        return cfg
 
-    # Conf.d settings override input configuration
-    confd_cfg = read_conf_d(confd)
-    return mergemanydict([confd_cfg, cfg])
+def _get_conf_signature(fname):
+    # The signature of a file that does not exist is None, so that a file
+    # showing up later also invalidates anything built without it.
+    try:
+        contents = load_file(fname, decode=False)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        mtime = os.stat(fname).st_mtime
+    except OSError:
+        mtime = None
+    return [mtime, len(contents), hashlib.sha256(contents).hexdigest()]
+
+
+def _load_conf_cache(cache_file, cfgfile):
+    try:
+        cached = load_json(load_file(cache_file, quiet=True) or "{}")
+    except (IOError, ValueError, TypeError) as e:
+        LOG.debug("Ignoring unusable config cache %s: %s", cache_file, e)
+        return None
+    if (cached.get('version') != CONF_CACHE_VERSION or
+            cached.get('path') != cfgfile):
+        return None
+    try:
+        for (fname, signature) in cached['files'].items():
+            if _get_conf_signature(fname) != signature:
+                return None
+        confd = cached['confd']
+        if confd and os.path.isdir(confd):
+            names = _get_conf_d_names(confd)
+        else:
+            names = None
+        if names != cached['confd_names']:
+            return None
+        return cached['config']
+    except (KeyError, IOError, OSError, AttributeError) as e:
+        LOG.debug("Ignoring unusable config cache %s: %s", cache_file, e)
+        return None
+
+
+def _store_conf_cache(cache_file, cached):
+    # Only cache what json can hand back unchanged (yaml may produce
+    # timestamps, non-string keys and other things json can't represent).
+    try:
+        blob = json.dumps(cached, sort_keys=True)
+        if json.loads(blob)['config'] != cached['config']:
+            raise TypeError("config does not survive a json round trip")
+    except (TypeError, ValueError) as e:
+        LOG.debug("Not caching config from %s: %s", cached['path'], e)
+        return False
+    try:
+        # The merged config may include secrets from files that are only
+        # readable by root, so the cache must be as well.
+        write_file(cache_file, blob, mode=0o600)
+    except (IOError, OSError):
+        logexc(LOG, "Failed writing config cache %s", cache_file)
+        return False
+    return True
+
+
+def read_conf_with_confd(cfgfile, cache_file=None):
+    # When a cache file is given (and its directory exists) the merged
+    # result is reused for as long as none of the files (or the conf.d
+    # listing) it was built from have changed.
+    if cache_file:
+        cached_cfg = _load_conf_cache(cache_file, cfgfile)
+        if cached_cfg is not None:
+            LOG.debug("Using cached config for %s from %s",
+                      cfgfile, cache_file)
+            return cached_cfg
+        cached = {
+            'version': CONF_CACHE_VERSION,
+            'path': cfgfile,
+            'files': {},
+        }
+        # Signatures are taken before each file is parsed, so a file
+        # changing underneath us can only cause a spurious cache miss.
+        cached['files'][cfgfile] = _get_conf_signature(cfgfile)
+
+    cfg = read_conf(cfgfile)
+    confd = _get_conf_d_path(cfgfile, cfg)
+    if not confd or not os.path.isdir(confd):
+        confd_names = None
+    else:
+        confd_names = _get_conf_d_names(confd)
+        if cache_file:
+            for fn in confd_names:
+                path = os.path.join(confd, fn)
+                cached['files'][path] = _get_conf_signature(path)
+        # Conf.d settings override input configuration
+        confd_cfg = read_conf_d(confd)
+        cfg = mergemanydict([confd_cfg, cfg])
+
+    if cache_file and os.path.isdir(os.path.dirname(cache_file)):
+        cached.update({
+            'confd': confd,
+            'confd_names': confd_names,
+            'config': cfg,
+        })
+        _store_conf_cache(cache_file, cached)
+    return cfg
 
 
 def read_cc_from_cmdline(cmdline=None):
@@ -1120,6 +1308,12 @@ def find_devs_with(criteria=None, oformat='device',
       LABEL=<label>
       UUID=<uuid>
     """
+    if oformat == 'device' and not tag and not no_cache:
+        # The common case (which devices have some tag value) can be
+        # answered without running blkid again.
+        devs = _find_devs_in_inventory(criteria, path)
+        if devs is not None:
+            return devs
     blk_id_cmd = ['blkid']
     options = []
     if criteria:
@@ -1153,9 +1347,91 @@ def find_devs_with(criteria=None, oformat='device',
         line = line.strip()
         if line:
             entries.append(line)
+    if path and entries:
+        # Probing a device by path can make blkid (newly) know of it
+        invalidate_blkid_inventory()
     return entries
 
 
+def _unescape_blkid_value(value):
+    # Values are shell escaped ('\ ' for a space) in the export format
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def _parse_blkid_export(out):
+    devices = []
+    dev = {}
+    for line in out.splitlines():
+        line = line.strip()
+        if not line:
+            dev = {}
+            continue
+        if '=' not in line:
+            continue
+        (key, value) = line.split('=', 1)
+        if key == 'DEVNAME':
+            dev = {}
+            devices.append(dev)
+        dev[key] = _unescape_blkid_value(value)
+    return [d for d in devices if d.get('DEVNAME')]
+
+
+def blkid_inventory(refresh=False):
+    """All the block devices (and their tags) that blkid knows of.
+
+    Returns a tuple of a list of each device's tags (including its
+    DEVNAME) in blkid's order and an index of the device names having
+    each (tag, value). blkid is only run once, until refresh is set or
+    invalidate_blkid_inventory is called (after creating partitions or
+    filesystems for example).
+    """
+    global _BLKID_INVENTORY
+    with _BLKID_INVENTORY_LOCK:
+        if _BLKID_INVENTORY is None or refresh:
+            # See man blkid for why 2 is added
+            (out, _err) = subp(['blkid', '-o', 'export'], rcs=[0, 2])
+            devices = _parse_blkid_export(out)
+            index = {}
+            for dev in devices:
+                for (key, value) in dev.items():
+                    index.setdefault((key, value), []).append(dev['DEVNAME'])
+            LOG.debug("blkid found %s block devices", len(devices))
+            _BLKID_INVENTORY = (devices, index)
+        return _BLKID_INVENTORY
+
+
+def invalidate_blkid_inventory():
+    global _BLKID_INVENTORY
+    with _BLKID_INVENTORY_LOCK:
+        _BLKID_INVENTORY = None
+
+
+def _find_devs_in_inventory(criteria, path):
+    # Returns None when the inventory can not tell (and blkid
+    # itself should be asked)
+    if criteria:
+        if '=' not in criteria:
+            return None
+        (key, value) = criteria.split('=', 1)
+        if len(value) > 1 and value[0] == value[-1] and value[0] in "\"'":
+            value = value[1:-1]
+    try:
+        (devices, index) = blkid_inventory()
+    except ProcessExecutionError as e:
+        LOG.debug("Failed taking blkid inventory: %s", e)
+        return None
+    if criteria:
+        found = list(index.get((key, value), []))
+    else:
+        found = [dev['DEVNAME'] for dev in devices]
+    if path:
+        if ('DEVNAME', path) not in index:
+            # Not (yet) probed by blkid, or known by another name
+            return None
+        found = [dev for dev in found if dev == path]
+    return found
+
+
 def peek_file(fname, max_bytes):
     LOG.debug("Peeking at %s (max_bytes=%s)", fname, max_bytes)
     with open(fname, 'rb') as ifh:
@@ -1408,7 +1684,13 @@ def ensure_dir(path, mode=None):
     if not os.path.isdir(path):
         # Make the dir and adjust the mode
         with SeLinuxGuard(os.path.dirname(path), recursive=True):
-            os.makedirs(path)
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                # Somebody else (another module running at the same
+                # time) may have just made it.
+                if e.errno != errno.EEXIST or not os.path.isdir(path):
+                    raise
         chmod(path, mode)
     else:
         # Just adjust the mode
@@ -1465,6 +1747,192 @@ def mounts():
     return mounted
 
 
+def _blkid_fstype(device):
+    try:
+        (devices, _index) = blkid_inventory()
+    except ProcessExecutionError as e:
+        LOG.debug("Failed taking blkid inventory: %s", e)
+        return None
+    for dev in devices:
+        if dev['DEVNAME'] == device:
+            return dev.get('TYPE')
+    return None
+
+
+def _mount_device(device, mountpoint, mtypes, rw=False, sync=True):
+    # Tries mounting with each type in turn, returning the one that worked
+    failure_reason = None
+    for mtype in mtypes:
+        try:
+            mountcmd = ['mount']
+            mountopts = []
+            if rw:
+                mountopts.append('rw')
+            else:
+                mountopts.append('ro')
+            if sync:
+                # This seems like the safe approach to do
+                # (ie where this is on by default)
+                mountopts.append("sync")
+            if mountopts:
+                mountcmd.extend(["-o", ",".join(mountopts)])
+            if mtype:
+                mountcmd.extend(['-t', mtype])
+            mountcmd.append(device)
+            mountcmd.append(mountpoint)
+            subp(mountcmd)
+            return mtype
+        except (IOError, OSError) as exc:
+            LOG.debug("Failed mount of '%s' as '%s': %s",
+                      device, mtype, exc)
+            failure_reason = exc
+    raise MountFailedError("Failed mounting %s to %s due to: %s" %
+                           (device, mountpoint, failure_reason))
+
+
+class MountSession(object):
+    """Read-only mounts (made by mount_cb) shared until the session ends.
+
+    Used while searching for a datasource, so that a device that several
+    datasources look at is only mounted once. Datasources may be probed
+    from several threads at once, so the users of each mount are counted
+    and it is only unmounted once nobody is using it any more.
+    """
+
+    def __init__(self):
+        # realpath(device) -> [mountpoint, type it was mounted with, users]
+        self.mounted = {}
+        self.closed = False
+        # devices mounted read-write (outside of the session) right now
+        self._exclusive = set()
+        self._cond = threading.Condition()
+
+    def _in_use(self, realdev):
+        return (realdev in self._exclusive or
+                (realdev in self.mounted and self.mounted[realdev][2]))
+
+    def mount(self, device, mtypes, sync=False):
+        """Mounts device (or shares its mount) for one more user.
+
+        Returns the mountpoint, each call must be paired with a call to
+        unuse() once the caller is done with it.
+        """
+        realdev = os.path.realpath(device)
+        with self._cond:
+            while True:
+                if realdev in self._exclusive:
+                    self._cond.wait()
+                    continue
+                entry = self.mounted.get(realdev)
+                if entry is None:
+                    break
+                (mountpoint, used, users) = entry
+                if used in mtypes or 'auto' in mtypes or '' in mtypes:
+                    entry[2] += 1
+                    return mountpoint
+                # Mounted as a type the caller did not ask for, so (as
+                # before) try the asked for types separately, once the
+                # others are done with it.
+                if users:
+                    self._cond.wait()
+                    continue
+                self._unmount(realdev)
+                break
+            mounted = mounts()
+            if realdev in mounted:
+                # Mounted by somebody else, so left alone
+                return mounted[realdev]['mountpoint']
+            mountpoint = tempfile.mkdtemp()
+            try:
+                used = _mount_device(device, mountpoint, mtypes, sync=sync)
+            except Exception:
+                del_dir(mountpoint)
+                raise
+            LOG.debug("Mounted %s at %s for this mount session",
+                      device, mountpoint)
+            self.mounted[realdev] = [mountpoint, used, 1]
+            return mountpoint
+
+    def unuse(self, device):
+        """Done with a mountpoint mount() returned for device."""
+        realdev = os.path.realpath(device)
+        with self._cond:
+            entry = self.mounted.get(realdev)
+            if entry is None:
+                # Mounted by somebody else
+                return
+            entry[2] -= 1
+            if not entry[2] and self.closed:
+                self._unmount(realdev)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self, device):
+        """Keeps device out of the session (unmounting it from there, once
+        nobody uses it) for as long as it is mounted read-write."""
+        realdev = os.path.realpath(device)
+        with self._cond:
+            while self._in_use(realdev):
+                self._cond.wait()
+            if realdev in self.mounted:
+                self._unmount(realdev)
+            self._exclusive.add(realdev)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive.discard(realdev)
+                self._cond.notify_all()
+
+    def _unmount(self, realdev):
+        (mountpoint, _used, _users) = self.mounted.pop(realdev)
+        try:
+            subp(["umount", mountpoint])
+            del_dir(mountpoint)
+        except (IOError, OSError, ProcessExecutionError):
+            logexc(LOG, "Failed unmounting %s from %s", realdev, mountpoint)
+
+    def close(self):
+        """Unmounts everything that is not in use, the rest is unmounted
+        when its last user is done with it."""
+        with self._cond:
+            self.closed = True
+            for realdev in list(self.mounted):
+                if not self._in_use(realdev):
+                    self._unmount(realdev)
+
+
+_MOUNT_SESSION = None
+
+
+@contextlib.contextmanager
+def mount_session():
+    """Shares the read-only mounts made by mount_cb until exiting.
+
+    Nested uses share the outermost session.
+    """
+    global _MOUNT_SESSION
+    if _MOUNT_SESSION is not None:
+        yield _MOUNT_SESSION
+        return
+    session = MountSession()
+    _MOUNT_SESSION = session
+    try:
+        yield session
+    finally:
+        _MOUNT_SESSION = None
+        session.close()
+
+
+def _call_mounted(callback, mountpoint, data):
+    # Be nice and ensure it ends with a slash
+    if not mountpoint.endswith("/"):
+        mountpoint += "/"
+    if data is None:
+        return callback(mountpoint)
+    return callback(mountpoint, data)
+
+
 def mount_cb(device, callback, data=None, rw=False, mtype=None, sync=True):
     """
     Mount the device, call method 'callback' passing the directory
@@ -1473,6 +1941,9 @@ def mount_cb(device, callback, data=None, rw=False, mtype=None, sync=True):
 
     mtype is a filesystem type.  it may be a list, string (a single fsname)
     or a list of fsnames.
+
+    Inside a mount_session read-only mounts are only unmounted once the
+    session ends (and are shared with other calls for the same device).
     """
 
     if isinstance(mtype, str):
@@ -1487,6 +1958,12 @@ def mount_cb(device, callback, data=None, rw=False, mtype=None, sync=True):
     if platsys == "linux":
         if mtypes is None:
             mtypes = ["auto"]
+        if len(mtypes) > 1:
+            # Rather than trying each type in turn use what blkid says
+            # the filesystem is (when that is one of them)
+            detected = _blkid_fstype(os.path.realpath(device))
+            if detected in mtypes:
+                mtypes = [detected]
     elif platsys.endswith("bsd"):
         if mtypes is None:
             mtypes = ['ufs', 'cd9660', 'vfat']
@@ -1497,53 +1974,37 @@ def mount_cb(device, callback, data=None, rw=False, mtype=None, sync=True):
         # we cannot do a smart "auto", so just call 'mount' once with no -t
         mtypes = ['']
 
+    if not rw:
+        # Nothing gets written, so there is nothing to sync
+        sync = False
+
+    session = _MOUNT_SESSION
+    if session is not None:
+        if not rw:
+            mountpoint = session.mount(device, mtypes, sync=sync)
+            try:
+                return _call_mounted(callback, mountpoint, data)
+            finally:
+                session.unuse(device)
+        # Mounted read-only won't do
+        with session.exclusive(device):
+            return _mount_cb(device, callback, data, rw, mtypes, sync)
+    return _mount_cb(device, callback, data, rw, mtypes, sync)
+
+
+def _mount_cb(device, callback, data, rw, mtypes, sync):
     mounted = mounts()
     with tempdir() as tmpd:
         umount = False
         if os.path.realpath(device) in mounted:
             mountpoint = mounted[os.path.realpath(device)]['mountpoint']
         else:
-            failure_reason = None
-            for mtype in mtypes:
-                mountpoint = None
-                try:
-                    mountcmd = ['mount']
-                    mountopts = []
-                    if rw:
-                        mountopts.append('rw')
-                    else:
-                        mountopts.append('ro')
-                    if sync:
-                        # This seems like the safe approach to do
-                        # (ie where this is on by default)
-                        mountopts.append("sync")
-                    if mountopts:
-                        mountcmd.extend(["-o", ",".join(mountopts)])
-                    if mtype:
-                        mountcmd.extend(['-t', mtype])
-                    mountcmd.append(device)
-                    mountcmd.append(tmpd)
-                    subp(mountcmd)
-                    umount = tmpd  # This forces it to be unmounted (when set)
-                    mountpoint = tmpd
-                    break
-                except (IOError, OSError) as exc:
-                    LOG.debug("Failed mount of '%s' as '%s': %s",
-                              device, mtype, exc)
-                    failure_reason = exc
-            if not mountpoint:
-                raise MountFailedError("Failed mounting %s to %s due to: %s" %
-                                       (device, tmpd, failure_reason))
-
-        # Be nice and ensure it ends with a slash
-        if not mountpoint.endswith("/"):
-            mountpoint += "/"
+            _mount_device(device, tmpd, mtypes, rw=rw, sync=sync)
+            umount = tmpd  # This forces it to be unmounted (when set)
+            mountpoint = tmpd
+
         with unmounter(umount):
-            if data is None:
-                ret = callback(mountpoint)
-            else:
-                ret = callback(mountpoint, data)
-            return ret
+            return _call_mounted(callback, mountpoint, data)
 
 
 def get_builtin_cfg():
@@ -1634,11 +2095,21 @@ def write_file(filename, content, mode=0o644, omode="wb"):
     Resotres the SELinux context if possible.
 
     @param filename: The full path of the file to write.
-    @param content: The content to write to the file.
+    @param content: The content to write to the file, or a callable that
+                    writes it (to the open file it is passed) bit by bit.
     @param mode: The filesystem mode to set on the file.
     @param omode: The open mode used when opening the file (w, wb, a, etc.)
     """
     ensure_dir(os.path.dirname(filename))
+    if callable(content):
+        LOG.debug("Writing to %s - %s: [%s] (streamed)", filename, omode,
+                  mode)
+        with SeLinuxGuard(path=filename):
+            with open(filename, omode) as fh:
+                content(fh)
+                fh.flush()
+        chmod(filename, mode)
+        return
     if 'b' in omode.lower():
         content = encode_text(content)
         write_type = 'bytes'
@@ -2151,10 +2622,8 @@ def _read_dmi_syspath(key):
         return None
     mapped_key = DMIDECODE_TO_DMI_SYS_MAPPING[key]
     dmi_key_path = "{0}/{1}".format(DMI_SYS_PATH, mapped_key)
-    LOG.debug("querying dmi data %s", dmi_key_path)
     try:
         if not os.path.exists(dmi_key_path):
-            LOG.debug("did not find %s", dmi_key_path)
             return None
 
         key_data = load_file(dmi_key_path, decode=False)
@@ -2167,9 +2636,7 @@ def _read_dmi_syspath(key):
         if key_data == b'\xff' * (len(key_data) - 1) + b'\n':
             key_data = b""
 
-        str_data = key_data.decode('utf8').strip()
-        LOG.debug("dmi data %s returned %s", dmi_key_path, str_data)
-        return str_data
+        return key_data.decode('utf8').strip()
 
     except Exception:
         logexc(LOG, "failed read of %s", dmi_key_path)
@@ -2194,6 +2661,110 @@ def _call_dmidecode(key, dmidecode_path):
         return None
 
 
+def _parse_dmidecode_dump(out):
+    values = {}
+    section = None
+    for line in out.splitlines():
+        if not line.strip():
+            section = None
+            continue
+        if not line[0].isspace():
+            if section is None and not line.startswith("Handle "):
+                section = line.strip()
+            continue
+        if ':' not in line:
+            continue
+        (field, value) = line.strip().split(':', 1)
+        key = DMIDECODE_DUMP_FIELDS.get((section, field.strip()))
+        if key and key not in values:
+            value = value.strip()
+            if value.replace(".", "") == "":
+                value = ""
+            values[key] = value
+    return values
+
+
+def _dmidecode_dump(dmidecode_path):
+    try:
+        (out, _err) = subp([dmidecode_path, "--type", "0,1,2,3"])
+    except (IOError, OSError) as e:
+        LOG.debug("failed dmidecode dump: %s", e)
+        return {}
+    return _parse_dmidecode_dump(out)
+
+
+class _DMISnapshot(object):
+    """The DMI values (by dmidecode name) that have been looked up.
+
+    A value of None means none of the sources had one for that key.
+    """
+
+    def __init__(self, values=None):
+        self.values = dict(values or {})
+        self.dmidecode_dumped = False
+        self._dmidecode_path = False
+
+    @classmethod
+    def from_sysfs(cls):
+        values = {}
+        if os.path.isdir(DMI_SYS_PATH):
+            for key in DMIDECODE_TO_DMI_SYS_MAPPING:
+                value = _read_dmi_syspath(key)
+                if value is not None:
+                    values[key] = value
+        LOG.debug("read %s dmi values from %s", len(values), DMI_SYS_PATH)
+        return cls(values)
+
+    @property
+    def dmidecode_path(self):
+        if self._dmidecode_path is False:
+            self._dmidecode_path = which('dmidecode')
+        return self._dmidecode_path
+
+    def lookup(self, key):
+        """Returns (value, whether the snapshot changed)."""
+        if key in self.values:
+            return (self.values[key], False)
+        if not self.dmidecode_path:
+            LOG.warn("did not find either path %s or dmidecode command",
+                     DMI_SYS_PATH)
+            return (None, False)
+        if not self.dmidecode_dumped and key in DMIDECODE_TO_DMI_SYS_MAPPING:
+            # One dump gets (the rest of) the mapped values at once
+            self.dmidecode_dumped = True
+            for (dkey, value) in _dmidecode_dump(self.dmidecode_path).items():
+                self.values.setdefault(dkey, value)
+            if key in self.values:
+                return (self.values[key], True)
+        self.values[key] = _call_dmidecode(key, self.dmidecode_path)
+        return (self.values[key], True)
+
+
+def _load_dmi_snapshot(cache_path):
+    if cache_path and os.path.isfile(cache_path):
+        try:
+            values = json.loads(load_file(cache_path))
+            if isinstance(values, dict):
+                LOG.debug("using dmi values cached in %s", cache_path)
+                snapshot = _DMISnapshot(values)
+                # Whatever a dump had was cached, so no need for another
+                snapshot.dmidecode_dumped = True
+                return snapshot
+        except (IOError, OSError, ValueError) as e:
+            LOG.debug("ignoring dmi cache %s: %s", cache_path, e)
+    return _DMISnapshot.from_sysfs()
+
+
+def _store_dmi_snapshot(snapshot, cache_path):
+    if not cache_path or not os.path.isdir(os.path.dirname(cache_path)):
+        return
+    try:
+        write_file(cache_path, json.dumps(snapshot.values, sort_keys=True),
+                   mode=0o600)
+    except (IOError, OSError):
+        logexc(LOG, "failed caching dmi values in %s", cache_path)
+
+
 def read_dmi_data(key):
     """
     Wrapper for reading DMI data.
@@ -2206,18 +2777,23 @@ def read_dmi_data(key):
         3) Fall-back to passing `key` to `dmidecode --string`.
 
     If all of the above fail to find a value, None will be returned.
-    """
-    syspath_value = _read_dmi_syspath(key)
-    if syspath_value is not None:
-        return syspath_value
 
-    dmidecode_path = which('dmidecode')
-    if dmidecode_path:
-        return _call_dmidecode(key, dmidecode_path)
-
-    LOG.warn("did not find either path %s or dmidecode command",
-             DMI_SYS_PATH)
-    return None
+    All of the sysfs values are read on first use and (like anything
+    dmidecode had to be asked for) served from memory after that. They
+    are also cached in DMI_CACHE_PATH (in /run/cloud-init) for later boot
+    stages.
+    """
+    global _DMI_SNAPSHOT
+    with _DMI_SNAPSHOT_LOCK:
+        if _DMI_SNAPSHOT is None:
+            _DMI_SNAPSHOT = _load_dmi_snapshot(DMI_CACHE_PATH)
+            changed = True
+        else:
+            changed = False
+        (value, looked_up) = _DMI_SNAPSHOT.lookup(key)
+        if changed or looked_up:
+            _store_dmi_snapshot(_DMI_SNAPSHOT, DMI_CACHE_PATH)
+        return value
 
 
 def message_from_string(string):
@@ -16,12 +16,15 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from distutils import version as vr
+__VERSION__ = "0.7.7"
 
 
 def version():
-    return vr.StrictVersion("0.7.7")
+    # Imported here since distutils is slow to import and most callers
+    # only want the version string.
+    from distutils import version as vr
+    return vr.StrictVersion(__VERSION__)
 
 
 def version_string():
-    return str(version())
+    return __VERSION__
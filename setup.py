@@ -26,6 +26,7 @@ import os
 import sys
 
 import setuptools
+from setuptools.command.build_py import build_py
 from setuptools.command.install import install
 
 from distutils.errors import DistutilsArgError
@@ -168,9 +169,21 @@ class InitsysInstallData(install):
         self.distribution.reinitialize_command('install_data', True)
 
 
+class BuildPyWithModuleIndex(build_py):
+    # Indexes the config modules as built, so they can be found (at each
+    # boot) without having to import them.
+    def run(self):
+        build_py.run(self)
+        if not self.dry_run:
+            tiny_p([sys.executable, 'tools/build-module-index',
+                    os.path.join(self.build_lib, 'cloudinit', 'config')])
+
+
 if in_virtualenv():
     data_files = []
-    cmdclass = {}
+    cmdclass = {
+        'build_py': BuildPyWithModuleIndex,
+    }
 else:
     data_files = [
         (ETC + '/cloud', glob('config/*.cfg')),
@@ -190,6 +203,7 @@ else:
     # Use a subclass for install that handles
     # adding on the right init system configuration files
     cmdclass = {
+        'build_py': BuildPyWithModuleIndex,
         'install': InitsysInstallData,
     }
 
@@ -19,6 +19,7 @@ except ImportError:
     from contextlib2 import ExitStack
 
 from cloudinit import helpers as ch
+from cloudinit import url_helper
 from cloudinit import util
 
 # Used for detecting different python versions
@@ -47,9 +48,9 @@ else:
 if PY26:
     # For now add these on, taken from python 2.7 + slightly adjusted.  Drop
     # all this once Python 2.6 is dropped as a minimum requirement.
-    class TestCase(unittest.TestCase):
+    class _TestCase(unittest.TestCase):
         def setUp(self):
-            super(TestCase, self).setUp()
+            super(_TestCase, self).setUp()
             self.__all_cleanups = ExitStack()
 
         def tearDown(self):
@@ -113,10 +114,22 @@ if PY26:
 
 
 else:
-    class TestCase(unittest.TestCase):
+    class _TestCase(unittest.TestCase):
         pass
 
 
+class TestCase(_TestCase):
+    def setUp(self):
+        super(TestCase, self).setUp()
+        # DMI values read by one test are not seen by the next, and are
+        # never cached on the host running the tests.
+        for (name, value) in (('_DMI_SNAPSHOT', None),
+                              ('DMI_CACHE_PATH', None)):
+            patcher = mock.patch.object(util, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
 # Makes the old path start
 # with new base instead of whatever
 # it previously had
@@ -311,9 +324,12 @@ class HttprettyTestCase(TestCase):
         self.restore_proxy = os.environ.get('http_proxy')
         if self.restore_proxy is not None:
             del os.environ['http_proxy']
+        # pooled connections must not outlive (or predate) httpretty
+        url_helper.close_sessions()
         super(HttprettyTestCase, self).setUp()
 
     def tearDown(self):
+        url_helper.close_sessions()
         if self.restore_proxy:
             os.environ['http_proxy'] = self.restore_proxy
         super(HttprettyTestCase, self).tearDown()
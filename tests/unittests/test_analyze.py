@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+
+from cloudinit import analyze
+from cloudinit import util
+from . import helpers
+
+
+def _record(name, start, duration, result='SUCCESS'):
+    return {'name': name, 'description': name, 'result': result,
+            'start': start, 'duration': duration}
+
+
+# A boot where config-apt (which had to wait for config-locale, the two
+# share a resource) was what the config stage waited for.
+BOOT = [
+    _record('init-local/search-NoCloud', 100.1, 0.5),
+    _record('init-local', 100.0, 0.8),
+    _record('init-network/check-cache', 101.0, 0.1),
+    _record('init-network/consume-user-data', 101.2, 0.4),
+    _record('init-network', 101.0, 1.0),
+    _record('modules-config/config-locale', 103.0, 0.5),
+    _record('modules-config/config-byobu', 103.1, 0.2),
+    _record('modules-config/config-apt', 103.5, 1.0, result='FAIL'),
+    _record('modules-config', 103.0, 1.6),
+]
+
+
+class TestAnalyze(helpers.TestCase):
+
+    def test_blame(self):
+        self.assertEqual(
+            ['modules-config', 'init-network', 'modules-config/config-apt'],
+            [r['name'] for r in analyze.blame(BOOT, 3)])
+        self.assertEqual(len(BOOT), len(analyze.blame(BOOT)))
+
+    def test_critical_path_skips_overlapping_events(self):
+        path = analyze.critical_path(BOOT)
+        self.assertEqual(
+            [(0, 'init-local'), (1, 'init-local/search-NoCloud'),
+             (0, 'init-network'), (1, 'init-network/check-cache'),
+             (1, 'init-network/consume-user-data'),
+             (0, 'modules-config'), (1, 'modules-config/config-locale'),
+             (1, 'modules-config/config-apt')],
+            [(depth, r['name']) for (depth, r) in path])
+
+    def test_orphaned_events_are_roots(self):
+        path = analyze.critical_path([_record('gone/child', 1.0, 1.0)])
+        self.assertEqual([(0, 'gone/child')],
+                         [(depth, r['name']) for (depth, r) in path])
+
+    def test_compare(self):
+        new = [dict(r) for r in BOOT if r['name'] != 'init-local']
+        new[-2]['duration'] = 2.0
+        new.append(_record('init-network/search-Ec2', 101.5, 0.05))
+        self.assertEqual(
+            [('modules-config/config-apt', 1.0, 2.0),
+             ('init-local', 0.8, None),
+             ('init-network/search-Ec2', None, 0.05)],
+            analyze.compare(BOOT, new, 3))
+
+    def test_total_time(self):
+        self.assertAlmostEqual(3.4, analyze.total_time(BOOT))
+
+    def test_format_critical_path(self):
+        out = analyze.format_critical_path(analyze.critical_path(BOOT))
+        self.assertIn("     1.000s   config-apt (FAIL)", out.splitlines())
+
+
+class TestLoadTimings(helpers.TestCase):
+
+    def setUp(self):
+        super(TestLoadTimings, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_bad_records_skipped(self):
+        path = os.path.join(self.tmp, 'boot-timing.json')
+        util.write_file(path, "\n".join([
+            '{"name": "a", "start": 1.0, "duration": 2.0}',
+            'not json',
+            '{"name": "b", "start": 1.0}',
+            '',
+            '{"name": "c", "start": "2", "duration": 0.5}',
+        ]))
+        records = analyze.load_timings(path)
+        self.assertEqual(['a', 'c'], [r['name'] for r in records])
+        self.assertEqual(2.0, records[1]['start'])
+
+# vi: ts=4 expandtab
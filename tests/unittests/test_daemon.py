@@ -0,0 +1,169 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from cloudinit import daemon
+from . import helpers
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+@helpers.skipIf(not daemon.is_supported(), "fd passing not supported")
+class TestBootDaemon(helpers.TestCase):
+
+    def setUp(self):
+        super(TestBootDaemon, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.socket_path = os.path.join(self.tmp, 'daemon.sock')
+        self.requests = []
+
+    def _serve(self, results, idle_timeout=5):
+        results = list(results)
+
+        def handler(argv):
+            self.requests.append(argv)
+            return results.pop(0)
+
+        sock = daemon.listen(self.socket_path)
+        thread = threading.Thread(
+            target=daemon.serve, args=(sock, handler),
+            kwargs={'idle_timeout': idle_timeout})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread
+
+    def _call(self, argv):
+        with mock.patch.object(daemon, '_std_fds', return_value=[]):
+            return daemon.call(argv, socket_path=self.socket_path)
+
+    def test_no_daemon(self):
+        self.assertIsNone(self._call(['modules']))
+        self.assertFalse(daemon.is_running(self.socket_path))
+
+    def test_stale_socket(self):
+        sock = daemon.listen(self.socket_path)
+        sock.close()
+        self.assertIsNone(self._call(['modules']))
+
+    def test_runs_stages_until_told_to_stop(self):
+        thread = self._serve([(0, True), (3, False)])
+        self.assertTrue(daemon.is_running(self.socket_path))
+        self.assertEqual(0, self._call(['init']))
+        self.assertEqual(3, self._call(['modules', '--mode=final']))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([['init'], ['modules', '--mode=final']],
+                         self.requests)
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertIsNone(self._call(['modules']))
+
+    def test_socket_only_accessible_by_owner(self):
+        self._serve([(0, False)])
+        self.assertEqual(0, os.stat(self.socket_path).st_mode & 0o077)
+        self.assertEqual(0, self._call(['init']))
+
+    def test_handler_failure_is_an_error_exit(self):
+        calls = []
+
+        def handler(argv):
+            calls.append(argv)
+            if len(calls) == 1:
+                raise RuntimeError("broken")
+            return (0, False)
+
+        sock = daemon.listen(self.socket_path)
+        thread = threading.Thread(target=daemon.serve, args=(sock, handler))
+        thread.daemon = True
+        thread.start()
+        self.assertEqual(1, self._call(['init']))
+        # and the daemon is still around for the next stage
+        self.assertEqual(0, self._call(['modules']))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_exit_codes_like_sys_exit(self):
+        results = [SystemExit(None), SystemExit("went wrong"),
+                   SystemExit(3), (None, False)]
+
+        def handler(argv):
+            result = results.pop(0)
+            if isinstance(result, SystemExit):
+                raise result
+            return result
+
+        sock = daemon.listen(self.socket_path)
+        thread = threading.Thread(target=daemon.serve, args=(sock, handler))
+        thread.daemon = True
+        thread.start()
+        self.assertEqual(0, self._call(['init']))
+        with mock.patch.object(daemon.sys, 'stderr') as m_stderr:
+            self.assertEqual(1, self._call(['init']))
+        m_stderr.write.assert_called_with("went wrong\n")
+        self.assertEqual(3, self._call(['init']))
+        self.assertEqual(0, self._call(['modules']))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_malformed_request_ignored(self):
+        self._serve([(0, False)])
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(self.socket_path)
+        client.sendall(b'["not", "a", "request"]\n')
+        self.assertEqual(b'', client.recv(10))
+        client.close()
+        self.assertEqual(0, self._call(['init']))
+        self.assertEqual([['init']], self.requests)
+
+    def test_idle_timeout(self):
+        thread = self._serve([], idle_timeout=0.1)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_output_goes_to_client(self):
+        (out_r, out_w) = os.pipe()
+        (err_r, err_w) = os.pipe()
+
+        def handler(argv):
+            os.write(1, b"to stdout\n")
+            os.write(2, b"to stderr\n")
+            return (0, False)
+
+        sock = daemon.listen(self.socket_path)
+        thread = threading.Thread(target=daemon.serve, args=(sock, handler))
+        thread.daemon = True
+        thread.start()
+        with mock.patch.object(daemon, '_std_fds',
+                               return_value=[out_w, err_w]):
+            self.assertEqual(0, daemon.call(['init'],
+                                            socket_path=self.socket_path))
+        thread.join(5)
+        os.close(out_w)
+        os.close(err_w)
+        with os.fdopen(out_r, 'rb') as fh:
+            self.assertEqual(b"to stdout\n", fh.read())
+        with os.fdopen(err_r, 'rb') as fh:
+            self.assertEqual(b"to stderr\n", fh.read())
+
+    def test_daemon_gone_mid_stage(self):
+        server = daemon.listen(self.socket_path)
+        self.addCleanup(server.close)
+
+        def accept_and_drop():
+            (conn, _addr) = server.accept()
+            conn.recv(1024)
+            conn.close()
+
+        thread = threading.Thread(target=accept_and_drop)
+        thread.start()
+        self.assertRaises(daemon.DaemonError, self._call, ['init'])
+        thread.join(5)
+
+# vi: ts=4 expandtab
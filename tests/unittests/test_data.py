@@ -5,6 +5,7 @@ import logging
 import os
 import shutil
 import tempfile
+import threading
 
 try:
     from unittest import mock
@@ -14,6 +15,7 @@ except ImportError:
 from six import BytesIO, StringIO
 
 from email import encoders
+from email import message_from_string
 from email.mime.application import MIMEApplication
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
@@ -557,3 +559,310 @@ class TestUDProcess(helpers.ResourceUsingTestCase):
         ud_proc = ud.UserDataProcessor(self.getCloudPaths())
         message = ud_proc.process(msg)
         self.assertTrue(count_messages(message) == 1)
+
+
+class TestUDLimits(helpers.ResourceUsingTestCase):
+
+    def setUp(self):
+        super(TestUDLimits, self).setUp()
+        self.spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.spool_dir)
+
+    def _payloads(self, message):
+        payloads = []
+
+        def callback(_data, filename, payload, headers):
+            payloads.append((headers['Content-Type'], payload))
+
+        handlers.walk(message, callback, None)
+        return payloads
+
+    def _big_config(self, size):
+        return "#cloud-config\nbig: '%s'\n" % ('x' * size)
+
+    def test_large_parts_spooled(self):
+        big = self._big_config(3000)
+        message = MIMEMultipart()
+        message.attach(MIMEBase('text', 'cloud-config'))
+        message.get_payload()[0].set_payload(big)
+        encoders.encode_base64(message.get_payload()[0])
+        message.attach(MIMEApplication(gzip_text(big), 'gzip'))
+        message.attach(MIMEApplication(gzip_text("#!/bin/sh\necho hi\n"),
+                                       'gzip'))
+
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths(),
+                                       limits={'spool_size': 1000})
+        processed = ud_proc.process(str(message), spool_dir=self.spool_dir)
+        parts = [p for p in processed.walk() if not ud.is_skippable(p)]
+        self.assertEqual(3, len(parts))
+        self.assertEqual(
+            [os.path.join(self.spool_dir, 'part-001'),
+             os.path.join(self.spool_dir, 'part-002'), None],
+            [p.get(ud.SPOOLED_HEADER) for p in parts])
+        self.assertEqual('', parts[0].get_payload())
+        self.assertEqual([('text/cloud-config', big),
+                          ('text/cloud-config', big),
+                          ('text/x-shellscript', "#!/bin/sh\necho hi\n")],
+                         self._payloads(processed))
+        # Processing it again starts over
+        ud_proc.process(big, spool_dir=self.spool_dir)
+        self.assertEqual(['part-001'], os.listdir(self.spool_dir))
+
+    def test_spooled_header_in_user_data_ignored(self):
+        secret = os.path.join(self.spool_dir, 'secret')
+        util.write_file(secret, "#cloud-config\nsecret: 1\n")
+        message = MIMEMultipart()
+        part = MIMEBase('text', 'cloud-config')
+        part.set_payload("#cloud-config\na: 1\n")
+        part[ud.SPOOLED_HEADER] = secret
+        message.attach(part)
+        part = MIMEApplication(gzip_text("#cloud-config\nb: 1\n"), 'gzip')
+        part[ud.SPOOLED_HEADER] = secret
+        message.attach(part)
+        archive = MIMEBase('text', 'cloud-config-archive')
+        archive.set_payload(util.yaml_dumps(
+            [{'content': "#cloud-config\nc: 1\n",
+              ud.SPOOLED_HEADER: secret}]))
+        message.attach(archive)
+
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths(),
+                                       limits={'spool_size': 1000})
+        processed = ud_proc.process(str(message), spool_dir=self.spool_dir)
+        parts = [p for p in processed.walk() if not ud.is_skippable(p)]
+        self.assertEqual([None, None, None],
+                         [p.get(ud.SPOOLED_HEADER) for p in parts])
+        self.assertEqual([('text/cloud-config', "#cloud-config\na: 1\n"),
+                          ('text/cloud-config', "#cloud-config\nb: 1\n"),
+                          ('text/cloud-config', "#cloud-config\nc: 1\n")],
+                         self._payloads(processed))
+
+    def test_untrusted_spooled_header_not_read(self):
+        secret = os.path.join(self.spool_dir, 'secret')
+        util.write_file(secret, "secret")
+        part = MIMEBase('text', 'cloud-config')
+        part.set_payload("#cloud-config\n")
+        part[ud.SPOOLED_HEADER] = secret
+        self.assertEqual("#cloud-config\n", util.fully_decoded_payload(part))
+
+    def test_spooled_launch_index(self):
+        big = "#cloud-config\nlaunch-index: 2\nbig: '%s'\n" % ('x' * 3000)
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths(),
+                                       limits={'spool_size': 1000})
+        message = MIMEMultipart()
+        message.attach(MIMEApplication(gzip_text(big), 'gzip'))
+        processed = ud_proc.process(str(message), spool_dir=self.spool_dir)
+        parts = [p for p in processed.walk() if not ud.is_skippable(p)]
+        self.assertEqual(1, len(parts))
+        self.assertIsNotNone(parts[0].get(ud.SPOOLED_HEADER))
+        self.assertEqual('2', parts[0].get('Launch-Index'))
+
+    def test_no_spooling_without_spool_dir(self):
+        big = self._big_config(3000)
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths(),
+                                       limits={'spool_size': 1000})
+        processed = ud_proc.process(gzip_text(big))
+        self.assertEqual([('text/cloud-config', big)],
+                         self._payloads(processed))
+
+    def test_part_size_limit(self):
+        message = MIMEMultipart()
+        message.attach(MIMEApplication(gzip_text(self._big_config(3000)),
+                                       'gzip'))
+        message.attach(MIMEApplication(gzip_text("#!/bin/sh\necho hi\n"),
+                                       'gzip'))
+        big = MIMEBase('text', 'x-shellscript')
+        big.set_payload("#!/bin/sh\n" + "echo x\n" * 1000)
+        message.attach(big)
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths(),
+                                       limits={'max_part_size': 1000})
+        processed = ud_proc.process(str(message))
+        self.assertEqual([('text/x-shellscript', "#!/bin/sh\necho hi\n")],
+                         self._payloads(processed))
+
+    def test_total_size_limit(self):
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths(),
+                                       limits={'max_size': 1000})
+        # A compressed blob is only decompressed up to the limit
+        processed = ud_proc.process(gzip_text(self._big_config(100000)))
+        self.assertEqual(0, count_messages(processed))
+        processed = ud_proc.process([self._big_config(600),
+                                     self._big_config(600),
+                                     "#!/bin/sh\n"])
+        self.assertEqual(
+            [('text/cloud-config', self._big_config(600)),
+             ('text/x-shellscript', "#!/bin/sh\n")],
+            self._payloads(processed))
+
+    def test_invalid_limits_use_defaults(self):
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths(),
+                                       limits={'max_size': 'lots',
+                                               'spool_size': None})
+        self.assertEqual(ud.DEF_LIMITS['max_size'], ud_proc.max_size)
+        self.assertEqual(0, ud_proc.spool_size)
+
+    def test_write_processed(self):
+        message = MIMEMultipart()
+        message.attach(MIMEApplication(gzip_text("#cloud-config\na: 1\n"),
+                                       'gzip'))
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths())
+        processed = ud_proc.process([str(message), u'#!/bin/sh\necho é\n'])
+        path = os.path.join(self.spool_dir, 'user-data.txt.i')
+        ud.write_processed(processed, path)
+        self.assertEqual(str(processed), util.load_file(path))
+        self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+        ud.write_processed(None, path)
+        self.assertEqual('', util.load_file(path))
+
+    def test_write_processed_includes_spooled_payloads(self):
+        big = self._big_config(3000)
+        message = MIMEMultipart()
+        message.attach(MIMEApplication(gzip_text(big), 'gzip'))
+        message.attach(MIMEApplication(gzip_text("#!/bin/sh\necho hi\n"),
+                                       'gzip'))
+        ud_proc = ud.UserDataProcessor(self.getCloudPaths(),
+                                       limits={'spool_size': 1000})
+        processed = ud_proc.process(str(message), spool_dir=self.spool_dir)
+        path = os.path.join(self.spool_dir, 'user-data.txt.i')
+        ud.write_processed(processed, path)
+        content = util.load_file(path)
+        self.assertNotIn(ud.SPOOLED_HEADER, content)
+        self.assertEqual(
+            [('text/cloud-config', big),
+             ('text/x-shellscript', "#!/bin/sh\necho hi\n")],
+            self._payloads(message_from_string(content)))
+        # The processed message itself is left as it was
+        self.assertEqual(
+            os.path.join(self.spool_dir, 'part-001'),
+            processed.get_payload()[0].get(ud.SPOOLED_HEADER))
+
+
+class FakeResponse(object):
+    def __init__(self, contents, code=200, headers=None):
+        self.contents = contents
+        self.code = code
+        self.headers = headers or {}
+
+    def ok(self):
+        return self.code == 200
+
+
+class TestUDIncludes(helpers.ResourceUsingTestCase):
+
+    def setUp(self):
+        super(TestUDIncludes, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.paths = c_helpers.Paths({'cloud_dir': self.tmp})
+        self.requests = []
+        self.responses = {}
+
+    def _read(self, url, headers=None, ssl_details=None):
+        self.requests.append((url, headers))
+        response = self.responses[url]
+        if callable(response):
+            response = response(headers)
+        return response
+
+    def _process(self, blob, **kwargs):
+        ud_proc = ud.UserDataProcessor(self.paths, **kwargs)
+        with mock.patch.object(util, 'read_file_or_url',
+                               side_effect=self._read):
+            return ud_proc.process(blob)
+
+    def _payloads(self, message):
+        return [util.fully_decoded_payload(p) for p in message.walk()
+                if not ud.is_skippable(p)]
+
+    @helpers.skipIf(ud.futures is None, "concurrent.futures not available")
+    def test_fetched_concurrently_in_listed_order(self):
+        second_fetched = threading.Event()
+
+        def first(_headers):
+            # Only answers once the next one was fetched
+            self.assertTrue(second_fetched.wait(5))
+            return FakeResponse(b"#!/bin/sh\necho 1\n")
+
+        def second(_headers):
+            second_fetched.set()
+            return FakeResponse(b"#!/bin/sh\necho 2\n")
+
+        self.responses = {'http://x/1': first, 'http://x/2': second,
+                          'http://x/3': FakeResponse(b"#!/bin/sh\necho 3\n")}
+        message = self._process("#include\nhttp://x/1\nhttp://x/2\n"
+                                "http://x/3\n")
+        self.assertEqual(["#!/bin/sh\necho 1\n", "#!/bin/sh\necho 2\n",
+                          "#!/bin/sh\necho 3\n"], self._payloads(message))
+
+    def test_one_worker(self):
+        self.responses = {'http://x/1': FakeResponse(b"#!/bin/sh\n1\n"),
+                          'http://x/2': FakeResponse(b"#!/bin/sh\n2\n")}
+        message = self._process("#include\nhttp://x/1\nhttp://x/2\n",
+                                include_workers=1)
+        self.assertEqual(["#!/bin/sh\n1\n", "#!/bin/sh\n2\n"],
+                         self._payloads(message))
+        self.assertEqual(['http://x/1', 'http://x/2'],
+                         [url for (url, _h) in self.requests])
+
+    def test_failed_fetch_raises(self):
+        def fail(_headers):
+            raise IOError("broken")
+
+        self.responses = {'http://x/1': fail,
+                          'http://x/2': FakeResponse(b"#!/bin/sh\n")}
+        self.assertRaises(IOError, self._process,
+                          "#include\nhttp://x/1\nhttp://x/2\n")
+
+    def test_unchanged_include_served_from_cache(self):
+        body = b"#cloud-config\na: 1\n"
+        self.responses['http://x/cfg'] = FakeResponse(
+            body, headers={'etag': '"v1"',
+                           'last-modified': 'Sat, 01 Oct 2016 00:00:00 GMT'})
+        self._process("#include http://x/cfg\n")
+        self.assertEqual([('http://x/cfg', None)], self.requests)
+
+        def revalidate(headers):
+            self.assertEqual(
+                {'If-None-Match': '"v1"',
+                 'If-Modified-Since': 'Sat, 01 Oct 2016 00:00:00 GMT'},
+                headers)
+            return FakeResponse(b'', code=304)
+
+        self.responses['http://x/cfg'] = revalidate
+        message = self._process("#include http://x/cfg\n")
+        self.assertEqual([body.decode()], self._payloads(message))
+
+    def test_damaged_cache_entry_ignored(self):
+        self.responses['http://x/cfg'] = FakeResponse(
+            b"#cloud-config\na: 1\n", headers={'etag': '"v1"'})
+        self._process("#include http://x/cfg\n")
+        cache_dir = os.path.join(self.tmp, 'data', ud.INCLUDE_CACHE_DIR)
+        for fname in os.listdir(cache_dir):
+            if not fname.endswith('.json'):
+                util.write_file(os.path.join(cache_dir, fname), b"changed")
+        self.requests = []
+        self._process("#include http://x/cfg\n")
+        self.assertEqual([('http://x/cfg', None)], self.requests)
+
+    def test_uncacheable_responses_not_kept(self):
+        self.responses = {
+            'http://x/1': FakeResponse(b"#!/bin/sh\n"),
+            'http://x/2': FakeResponse(
+                b"#!/bin/sh\n", headers={'etag': '"v1"',
+                                         'cache-control': 'no-store'}),
+        }
+        self._process("#include\nhttp://x/1\nhttp://x/2\n")
+        cache_dir = os.path.join(self.tmp, 'data', ud.INCLUDE_CACHE_DIR)
+        self.assertFalse(os.path.exists(cache_dir) and os.listdir(cache_dir))
+        self.requests = []
+        self._process("#include\nhttp://x/1\nhttp://x/2\n")
+        self.assertEqual([('http://x/1', None), ('http://x/2', None)],
+                         sorted(self.requests))
+
+    def test_file_includes_not_cached(self):
+        path = os.path.join(self.tmp, 'part')
+        util.write_file(path, "#!/bin/sh\n")
+        message = ud.UserDataProcessor(self.paths).process(
+            "#include %s\n" % path)
+        self.assertEqual(["#!/bin/sh\n"], self._payloads(message))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmp, 'data', ud.INCLUDE_CACHE_DIR)))
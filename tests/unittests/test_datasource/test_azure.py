@@ -1,4 +1,5 @@
 from cloudinit import helpers
+from cloudinit import sources
 from cloudinit.util import b64e, decode_binary, load_file
 from cloudinit.sources import DataSourceAzure
 from ..helpers import TestCase, populate_dir
@@ -361,6 +362,37 @@ class TestAzureDataSource(TestCase):
         self.assertIsInstance(cfg['disk_setup'], dict)
         self.assertIsInstance(cfg['fs_setup'], list)
 
+    def test_cancelled_probe_changes_nothing(self):
+        data = {'ovfcontent': construct_valid_ovf_env()}
+        dsrc = self._get_ds(data)
+        dsrc.cancel()
+        self.assertRaises(sources.ProbeCancelled, dsrc.get_data)
+        self.assertNotIn('agent_invoked', data)
+        self.assertFalse(os.path.exists(self.waagent_d))
+
+    def test_cache_round_trip(self):
+        # What get_data found (here the ephemeral disk) is not lost when
+        # a later stage restores the datasource from the cache.
+        data = {'ovfcontent': construct_valid_ovf_env(), 'sys_cfg': {}}
+        dsrc = self._get_ds(data)
+        self.apply_patches([
+            (DataSourceAzure, 'find_fabric_formatted_ephemeral_disk',
+             mock.MagicMock(return_value='/dev/disk/cloud/azure_resource')),
+        ])
+        self.assertTrue(dsrc.get_data())
+        with mock.patch.object(sources.LOG, 'warn') as m_warn:
+            blob = sources.dump_cache(dsrc)
+        self.assertEqual(0, m_warn.call_count)
+
+        restored = sources.load_cache(blob, {}, None, self.paths)
+        self.assertIsInstance(restored, DataSourceAzure.DataSourceAzureNet)
+        self.assertEqual('/dev/disk/cloud/azure_resource',
+                         restored.device_name_to_device('ephemeral0'))
+        self.assertEqual(dsrc.metadata, restored.metadata)
+        self.assertEqual(dsrc.get_config_obj(), restored.get_config_obj())
+        self.assertEqual(dsrc.userdata_raw, restored.userdata_raw)
+        self.assertEqual(self.instance_id, restored.get_instance_id())
+
     def test_provide_disk_aliases(self):
         # Make sure that user can affect disk aliases
         dscfg = {'disk_aliases': {'ephemeral0': '/dev/sdc'}}
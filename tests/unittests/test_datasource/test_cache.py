@@ -0,0 +1,140 @@
+import json
+import os
+import shutil
+import tempfile
+
+from six.moves import cPickle as pickle
+
+from cloudinit import helpers
+from cloudinit import sources
+from cloudinit import stages
+from cloudinit.sources import DataSourceNone
+
+from ..helpers import TestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class DataSourceCached(sources.DataSource):
+    def __init__(self, sys_cfg, distro, paths):
+        sources.DataSource.__init__(self, sys_cfg, distro, paths)
+        self.seed = None
+        self.unpicklable = object()
+
+    def get_data(self):
+        self.metadata = {'instance-id': 'i-abcd', 'keys': ['a', 'b'],
+                         'nested': {'block-device-mapping': {'ami': 'sda'}}}
+        self.userdata_raw = b'#cloud-config\nfoo: \xff\n'
+        self.vendordata_raw = None
+        self.seed = '/dev/sr0'
+        self.ds_cfg['alias'] = '/dev/sdb'
+        return True
+
+
+class TestDatasourceCache(TestCase):
+
+    def setUp(self):
+        super(TestDatasourceCache, self).setUp()
+        self.paths = helpers.Paths({})
+
+    def _dump(self):
+        ds = DataSourceCached({}, None, self.paths)
+        ds.get_data()
+        return (ds, sources.dump_cache(ds))
+
+    def test_round_trip(self):
+        (ds, blob) = self._dump()
+        sys_cfg = {'datasource': {'Cached': {'key': 'value'}}}
+        restored = sources.load_cache(blob, sys_cfg, None, self.paths)
+        self.assertIsInstance(restored, DataSourceCached)
+        self.assertEqual(ds.metadata, restored.metadata)
+        self.assertEqual(ds.userdata_raw, restored.userdata_raw)
+        self.assertIsNone(restored.vendordata_raw)
+        self.assertEqual('/dev/sr0', restored.seed)
+        self.assertEqual('i-abcd', restored.get_instance_id())
+        # rebuilt from what it is given, not what was cached
+        self.assertIs(sys_cfg, restored.sys_cfg)
+        # but what get_data did to its config is kept
+        self.assertEqual({'alias': '/dev/sdb'}, restored.ds_cfg)
+        self.assertIsNone(restored.userdata)
+
+    def test_processed_userdata_not_cached(self):
+        (ds, _blob) = self._dump()
+        ds.userdata_raw = b'#cloud-config\nfoo: bar\n'
+        self.assertIsNotNone(ds.get_userdata())
+        state = json.loads(sources.dump_cache(ds))['state']
+        self.assertNotIn('userdata', state['attributes'])
+        self.assertIn('userdata_raw', state['attributes'])
+
+    def test_unencodable_attribute_warned(self):
+        (ds, _blob) = self._dump()
+        with mock.patch.object(sources.LOG, 'warn') as m_warn:
+            state = json.loads(sources.dump_cache(ds))['state']
+        self.assertNotIn('unpicklable', state['attributes'])
+        self.assertEqual(1, m_warn.call_count)
+        self.assertIn('unpicklable', m_warn.call_args[0])
+
+    def test_checksum_mismatch_rejected(self):
+        (_ds, blob) = self._dump()
+        contents = json.loads(blob)
+        contents['state']['attributes']['seed'] = '/dev/sr1'
+        self.assertRaises(sources.CacheError, sources.load_cache,
+                          json.dumps(contents), {}, None, self.paths)
+
+    def test_unknown_version_rejected(self):
+        (_ds, blob) = self._dump()
+        contents = json.loads(blob)
+        contents['version'] = sources.CACHE_VERSION + 1
+        self.assertRaises(sources.CacheError, sources.load_cache,
+                          json.dumps(contents), {}, None, self.paths)
+
+    def test_missing_class_rejected(self):
+        (_ds, blob) = self._dump()
+        blob = blob.replace('DataSourceCached', 'DataSourceGone')
+        contents = json.loads(blob)
+        contents['checksum'] = sources._cache_checksum(contents['state'])
+        self.assertRaises(sources.CacheError, sources.load_cache,
+                          json.dumps(contents), {}, None, self.paths)
+
+    def test_garbage_rejected(self):
+        self.assertRaises(sources.CacheError, sources.load_cache,
+                          b'\x80not json', {}, None, self.paths)
+
+
+class TestStagesCache(TestCase):
+
+    def setUp(self):
+        super(TestStagesCache, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.paths = helpers.Paths({'cloud_dir': self.tmp})
+
+    def test_store_and_load(self):
+        ds = DataSourceCached({}, None, self.paths)
+        ds.get_data()
+        fname = os.path.join(self.tmp, 'obj.json')
+        self.assertTrue(stages._ds_store(ds, fname))
+        restored = stages._ds_load(fname, {}, None, self.paths)
+        self.assertEqual(ds.metadata, restored.metadata)
+
+    def test_load_missing_and_corrupt(self):
+        fname = os.path.join(self.tmp, 'obj.json')
+        self.assertIsNone(stages._ds_load(fname, {}, None, self.paths))
+        with open(fname, 'w') as fp:
+            fp.write('{"version": 1')
+        self.assertIsNone(stages._ds_load(fname, {}, None, self.paths))
+
+    def test_restore_falls_back_to_legacy_pickle(self):
+        init = stages.Init()
+        init._paths = self.paths
+        init._cfg = {}
+        init._distro = None
+        ds = DataSourceNone.DataSourceNone({}, None, self.paths)
+        os.makedirs(self.paths.instance_link)
+        with open(self.paths.get_ipath_cur('obj_pkl'), 'wb') as fp:
+            fp.write(pickle.dumps(ds))
+        restored = init._restore_from_cache()
+        self.assertIsInstance(restored, DataSourceNone.DataSourceNone)
@@ -2,6 +2,7 @@
 import copy
 
 from cloudinit.cs_utils import Cepko
+from cloudinit import sources
 from cloudinit.sources import DataSourceCloudSigma
 
 from .. import helpers as test_helpers
@@ -97,3 +98,8 @@ class DataSourceCloudSigmaTest(test_helpers.TestCase):
         self.datasource.get_data()
 
         self.assertIsNone(self.datasource.vendordata_raw)
+
+    def test_detect(self):
+        self.assertEqual(sources.DETECT_YES, self.datasource.detect())
+        self.datasource.is_running_in_cloudsigma = lambda: False
+        self.assertEqual(sources.DETECT_NO, self.datasource.detect())
@@ -16,6 +16,7 @@ except ImportError:
 
 from cloudinit import helpers
 from cloudinit import settings
+from cloudinit import sources
 from cloudinit.sources import DataSourceConfigDrive as ds
 from cloudinit.sources.helpers import openstack
 from cloudinit import util
@@ -261,6 +262,18 @@ class TestConfigDriveDataSource(TestCase):
         self.assertEqual(found['files']['/etc/foo.cfg'], CONTENT_0)
         self.assertEqual(found['files']['/etc/bar/bar.cfg'], CONTENT_1)
 
+    def test_cancelled_before_first_boot_actions(self):
+        paths = helpers.Paths({'cloud_dir': self.tmp})
+        populate_dir(os.path.join(paths.seed_dir, 'config_drive'),
+                     CFG_DRIVE_FILES_V2)
+        cfg_ds = ds.DataSourceConfigDrive(settings.CFG_BUILTIN, None, paths)
+        cfg_ds.cancel()
+        with mock.patch.object(ds, 'on_first_boot') as m_first_boot:
+            self.assertRaises(sources.ProbeCancelled, cfg_ds.get_data)
+        self.assertFalse(m_first_boot.called)
+        cfg_ds.cleanup_probe()
+        self.assertEqual({}, cfg_ds.files)
+
     def test_seed_dir_valid_extra(self):
         """Verify extra files do not affect datasource validity."""
 
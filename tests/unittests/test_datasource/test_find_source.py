@@ -0,0 +1,185 @@
+import threading
+
+from cloudinit import helpers
+from cloudinit import sources
+from cloudinit import util
+from cloudinit.reporting import events
+
+from ..helpers import TestCase
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+class DataSourceFound(sources.DataSource):
+    def get_data(self):
+        return True
+
+
+class DataSourceMissing(sources.DataSource):
+    def get_data(self):
+        return False
+
+
+class DataSourceBroken(sources.DataSource):
+    def get_data(self):
+        raise IOError("could not probe")
+
+
+class DataSourceUndetected(sources.DataSource):
+    def detect(self):
+        return sources.DETECT_NO
+
+    def get_data(self):
+        return True
+
+
+class TestFindSource(TestCase):
+
+    def _find_source(self, ds_list, sys_cfg=None):
+        if sys_cfg is None:
+            sys_cfg = {}
+        with mock.patch.object(sources, 'list_sources',
+                               return_value=ds_list):
+            return sources.find_source(sys_cfg, None, helpers.Paths({}),
+                                       [sources.DEP_FILESYSTEM], [], [],
+                                       None)
+
+    def test_first_found_is_used(self):
+        (ds, dsname) = self._find_source([DataSourceMissing,
+                                          DataSourceBroken,
+                                          DataSourceFound])
+        self.assertIsInstance(ds, DataSourceFound)
+        self.assertEqual('DataSourceFound', dsname)
+
+    def test_undetected_sources_are_skipped(self):
+        (ds, dsname) = self._find_source([DataSourceUndetected,
+                                          DataSourceFound])
+        self.assertEqual('DataSourceFound', dsname)
+
+    def test_detection_can_be_disabled(self):
+        (ds, dsname) = self._find_source([DataSourceUndetected,
+                                          DataSourceFound],
+                                         {'datasource_detect': False})
+        self.assertEqual('DataSourceUndetected', dsname)
+
+    def test_none_found_raises(self):
+        self.assertRaises(sources.DataSourceNotFoundException,
+                          self._find_source,
+                          [DataSourceMissing, DataSourceBroken])
+
+    def test_race_none_found_raises(self):
+        self.assertRaises(sources.DataSourceNotFoundException,
+                          self._find_source,
+                          [DataSourceMissing, DataSourceBroken],
+                          {'datasource_race': True})
+
+    def test_race_probes_concurrently_and_keeps_priority(self):
+        barrier = threading.Event()
+
+        class DataSourceSlowFound(sources.DataSource):
+            def get_data(self):
+                # Only completes if the lower priority sources were probed
+                # at the same time as this one.
+                return barrier.wait(5)
+
+        class DataSourceFastFound(sources.DataSource):
+            def get_data(self):
+                barrier.set()
+                return True
+
+        (ds, dsname) = self._find_source([DataSourceSlowFound,
+                                          DataSourceMissing,
+                                          DataSourceFastFound],
+                                         {'datasource_race': True})
+        self.assertEqual('DataSourceSlowFound', dsname)
+        self.assertIsInstance(ds, DataSourceSlowFound)
+
+    def test_race_skips_failed_higher_priority(self):
+        (ds, dsname) = self._find_source([DataSourceBroken,
+                                          DataSourceMissing,
+                                          DataSourceFound],
+                                         {'datasource_race': True})
+        self.assertEqual('DataSourceFound', dsname)
+
+    def test_race_losers_cancelled_and_cleaned_up(self):
+        started = threading.Event()
+        cleaned = threading.Event()
+        losers = []
+
+        class DataSourceSlowLoser(sources.DataSource):
+            def get_data(self):
+                losers.append(self)
+                started.set()
+                # Until the winner is picked and this one is cancelled
+                self.cancel_event.wait(5)
+                self.check_cancelled()
+                return True
+
+            def cleanup_probe(self):
+                cleaned.set()
+
+        class DataSourceWaitingFound(sources.DataSource):
+            def get_data(self):
+                return started.wait(5)
+
+        with mock.patch.object(events, 'report_finish_event') as m_finish:
+            (ds, dsname) = self._find_source([DataSourceWaitingFound,
+                                              DataSourceSlowLoser],
+                                             {'datasource_race': True})
+            self.assertEqual('DataSourceWaitingFound', dsname)
+            self.assertTrue(cleaned.wait(5))
+        self.assertTrue(losers[0].cancelled)
+        self.assertFalse(ds.cancelled)
+        finished = [args[0] for (args, _kw) in m_finish.call_args_list]
+        self.assertEqual(['search-WaitingFound'], finished)
+
+    def test_race_loser_keeps_shared_mount_while_reading(self):
+        reading = threading.Event()
+        done = threading.Event()
+        calls = []
+        seen = []
+
+        def _subp(cmd, rcs=None):
+            calls.append(cmd[0])
+            return ('', '')
+
+        class DataSourceMountLoser(sources.DataSource):
+            def get_data(self):
+                def _read(mp):
+                    reading.set()
+                    self.cancel_event.wait(5)
+                    # The search is over, but the mount is still usable
+                    seen.extend(calls)
+                    return mp
+                try:
+                    util.mount_cb('/dev/sr0', _read)
+                    self.check_cancelled()
+                    return True
+                finally:
+                    done.set()
+
+        class DataSourceMountFound(sources.DataSource):
+            def get_data(self):
+                util.mount_cb('/dev/sr0', lambda mp: mp)
+                return reading.wait(5)
+
+        with mock.patch.object(util, 'subp', side_effect=_subp), \
+                mock.patch.object(util, 'mounts', return_value={}):
+            (ds, dsname) = self._find_source([DataSourceMountFound,
+                                              DataSourceMountLoser],
+                                             {'datasource_race': True})
+            self.assertEqual('DataSourceMountFound', dsname)
+            self.assertTrue(done.wait(5))
+        self.assertEqual(['mount'], seen)
+        self.assertEqual(['mount', 'umount'], calls)
+
+    def test_cancelled_check(self):
+        ds = DataSourceFound({}, None, helpers.Paths({}))
+        ds.check_cancelled()
+        ds.cancel()
+        self.assertTrue(ds.cancelled)
+        self.assertRaises(sources.ProbeCancelled, ds.check_cancelled)
+        self.assertNotIn('_cancel_event', ds.get_cache_state())
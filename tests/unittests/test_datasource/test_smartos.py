@@ -37,6 +37,7 @@ import serial
 import six
 
 from cloudinit import helpers as c_helpers
+from cloudinit import sources
 from cloudinit.sources import DataSourceSmartOS
 from cloudinit.util import b64e
 
@@ -288,6 +289,24 @@ class TestSmartOSDataSource(helpers.FilesystemMockingTestCase):
         user_script_perm = oct(os.stat(legacy_script_f)[stat.ST_MODE])[-3:]
         self.assertEqual(user_script_perm, '700')
 
+    def test_cancelled_before_writing_scripts(self):
+        dsrc = self._get_ds(mockdata=MOCK_RETURNS)
+        dsrc.cancel()
+        self.assertRaises(sources.ProbeCancelled, dsrc.get_data)
+        legacy_script_f = "%s/user-script" % self.legacy_user_d
+        self.assertFalse(os.path.lexists(legacy_script_f))
+
+    def test_cleanup_probe_removes_scripts(self):
+        dsrc = self._get_ds(mockdata=MOCK_RETURNS)
+        self.assertTrue(dsrc.get_data())
+        legacy_script_f = "%s/user-script" % self.legacy_user_d
+        user_script_f = os.readlink(legacy_script_f)
+        dsrc.cleanup_probe()
+        self.assertFalse(os.path.lexists(legacy_script_f))
+        self.assertFalse(os.path.exists(user_script_f))
+        self.assertFalse(os.path.exists(
+            "%s/mdata-user-data" % self.legacy_user_d))
+
     def test_scripts_shebanged(self):
         dsrc = self._get_ds(mockdata=MOCK_RETURNS)
         ret = dsrc.get_data()
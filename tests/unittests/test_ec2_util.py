@@ -137,3 +137,48 @@ class TestEc2Util(helpers.HttprettyTestCase):
         self.assertEqual(2, len(bdm))
         self.assertEqual(bdm['ami'], 'sdb')
         self.assertEqual(bdm['ephemeral0'], 'sdc')
+
+
+class TestMetadataMaterializer(helpers.TestCase):
+    TREE = {
+        'http://md/': "hostname\ninstance-id\npublic-keys/\nplacement/",
+        'http://md/hostname': 'ec2.fake.host.name.com',
+        'http://md/instance-id': '123',
+        'http://md/public-keys/': "0=my-public-key\n1=my-other-key",
+        'http://md/public-keys/0/openssh-key': 'ssh-rsa AAAA my-public-key',
+        'http://md/public-keys/1/openssh-key': 'ssh-rsa AAAA my-other-key',
+        'http://md/placement/': "availability-zone",
+        'http://md/placement/availability-zone': 'us-east-1a',
+    }
+
+    def _materialize(self, max_workers):
+        called = []
+
+        def caller(url):
+            called.append(url)
+            return self.TREE[url]
+
+        materializer = eu.MetadataMaterializer(self.TREE['http://md/'],
+                                               'http://md/', caller,
+                                               max_workers=max_workers)
+        return (materializer.materialize(), called)
+
+    def test_concurrent_crawl_matches_serial_crawl(self):
+        (serial_md, serial_called) = self._materialize(1)
+        (concurrent_md, concurrent_called) = self._materialize(4)
+        self.assertEqual(serial_md, concurrent_md)
+        self.assertEqual(sorted(serial_called), sorted(concurrent_called))
+        self.assertEqual('us-east-1a',
+                         concurrent_md['placement']['availability-zone'])
+        self.assertEqual(2, len(concurrent_md['public-keys']))
+
+    def test_concurrent_crawl_raises_fetch_errors(self):
+        def caller(url):
+            if url.endswith('instance-id'):
+                raise uh.UrlError(IOError("boom"), url=url)
+            return 'value'
+
+        materializer = eu.MetadataMaterializer("hostname\ninstance-id",
+                                               'http://md/', caller,
+                                               max_workers=4)
+        self.assertRaises(uh.UrlError, materializer.materialize)
@@ -1,10 +1,19 @@
 """Tests of the built-in user data handlers."""
 
+import copy
+import json
 import os
+import shutil
+import tempfile
+
+import six
 
 from . import helpers as test_helpers
 
+from cloudinit import helpers
 from cloudinit import sources
+from cloudinit import util
+from cloudinit.settings import PER_ALWAYS, PER_INSTANCE, PER_ONCE
 
 
 class MyDataSource(sources.DataSource):
@@ -31,3 +40,168 @@ class TestPaths(test_helpers.ResourceUsingTestCase):
         mypaths = self.getCloudPaths(myds)
 
         self.assertEqual(None, mypaths.get_ipath())
+
+
+class TestConfigView(test_helpers.TestCase):
+    def setUp(self):
+        super(TestConfigView, self).setUp()
+        self.source = {
+            'write_files': [{'path': '/etc/blah', 'content': 'x' * 1024}],
+            'packages': ['a', 'b'],
+            'system_info': {'distro': 'ubuntu'},
+            'timezone': 'UTC',
+        }
+        self.orig = copy.deepcopy(self.source)
+
+    def test_nested_changes_do_not_leak(self):
+        view = helpers.ConfigView(self.source)
+        view['packages'].append('c')
+        view.get('write_files')[0]['path'] = '/etc/other'
+        for (_k, v) in view.items():
+            if isinstance(v, dict):
+                v['distro'] = 'rhel'
+        view.setdefault('packages', []).append('d')
+        self.assertEqual(['a', 'b', 'c', 'd'], view['packages'])
+        self.assertEqual(self.orig, self.source)
+
+    def test_top_level_changes_do_not_leak(self):
+        view = helpers.ConfigView(self.source)
+        view.pop('system_info')
+        view['timezone'] = 'EST'
+        view.update({'new': 'key'})
+        del view['packages']
+        self.assertNotIn('system_info', view)
+        self.assertEqual('EST', view['timezone'])
+        self.assertEqual(self.orig, self.source)
+
+    @test_helpers.skipIf(six.PY2, "python 2 copies everything up front")
+    def test_only_accessed_values_are_copied(self):
+        view = helpers.ConfigView(self.source)
+        self.assertEqual('UTC', view.get('timezone'))
+        self.assertIs(self.source['write_files'],
+                      dict.__getitem__(view, 'write_files'))
+        self.assertIsNot(self.source['packages'], view['packages'])
+
+    def test_copies_and_dumps_like_a_dict(self):
+        view = helpers.ConfigView(self.source)
+        self.assertEqual(self.source, view)
+        self.assertEqual(self.source, dict(view))
+        self.assertEqual(self.source, copy.deepcopy(view))
+        self.assertEqual(self.source, util.load_yaml(util.yaml_dumps(view)))
+        dict(view)['packages'].append('c')
+        updated = {}
+        updated.update(view)
+        updated['system_info']['distro'] = 'rhel'
+        self.assertEqual(self.orig, self.source)
+
+
+class TestIndexedSemaphores(test_helpers.TestCase):
+    def setUp(self):
+        super(TestIndexedSemaphores, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.sem_path = os.path.join(self.tmp, 'sem')
+
+    def _markers(self):
+        index = os.path.join(self.sem_path, helpers.SEM_INDEX_NAME)
+        return sorted(json.loads(util.load_file(index))['markers'])
+
+    def test_lock_marks_as_run(self):
+        sems = helpers.IndexedSemaphores(self.sem_path)
+        self.assertFalse(sems.has_run('config-foo', PER_INSTANCE))
+        with sems.lock('config-foo', PER_INSTANCE) as lk:
+            self.assertTrue(lk)
+        with sems.lock('config-bar', PER_ONCE) as lk:
+            self.assertTrue(lk)
+        with sems.lock('config-bar', PER_ONCE) as lk:
+            self.assertIsNone(lk)
+        self.assertTrue(sems.has_run('config-foo', PER_INSTANCE))
+        self.assertFalse(sems.has_run('config-foo', PER_ALWAYS))
+        self.assertEqual(['config_bar.once', 'config_foo'], self._markers())
+        # and nothing else was written
+        self.assertEqual([helpers.SEM_INDEX_NAME],
+                         os.listdir(self.sem_path))
+        sems.sync()
+
+    def test_which_have_run(self):
+        sems = helpers.IndexedSemaphores(self.sem_path)
+        with sems.lock('config-a', PER_INSTANCE):
+            pass
+        self.assertEqual(
+            set(['config-a']),
+            sems.which_have_run([('config-a', PER_INSTANCE),
+                                 ('config-a', PER_ALWAYS),
+                                 ('config-b', PER_INSTANCE)]))
+
+    def test_changes_by_others_kept(self):
+        first = helpers.IndexedSemaphores(self.sem_path)
+        second = helpers.IndexedSemaphores(self.sem_path)
+        self.assertFalse(first.has_run('config-b', PER_INSTANCE))
+        with first.lock('config-a', PER_INSTANCE):
+            pass
+        with second.lock('config-b', PER_INSTANCE):
+            pass
+        with first.lock('config-c', PER_INSTANCE):
+            pass
+        self.assertTrue(first.has_run('config-b', PER_INSTANCE))
+        self.assertEqual(['config_a', 'config_b', 'config_c'],
+                         self._markers())
+
+    def test_clear_on_fail(self):
+        sems = helpers.IndexedSemaphores(self.sem_path)
+        try:
+            with sems.lock('config-a', PER_INSTANCE, clear_on_fail=True):
+                raise RuntimeError("failed")
+        except RuntimeError:
+            pass
+        self.assertFalse(sems.has_run('config-a', PER_INSTANCE))
+        self.assertEqual([], self._markers())
+
+    def test_file_semaphores_migrated(self):
+        files = helpers.FileSemaphores(self.sem_path)
+        with files.lock('config-a', PER_INSTANCE):
+            pass
+        with files.lock('config-b', PER_ONCE):
+            pass
+        sems = helpers.IndexedSemaphores(self.sem_path)
+        self.assertTrue(sems.has_run('config-a', PER_INSTANCE))
+        self.assertTrue(sems.has_run('config-b', PER_ONCE))
+        self.assertTrue(sems.clear('config-a', PER_INSTANCE))
+        self.assertFalse(files.has_run('config-a', PER_INSTANCE))
+        self.assertFalse(sems.has_run('config-a', PER_INSTANCE))
+        self.assertEqual(['config_b.once'], self._markers())
+
+    def test_bad_index_rebuilt(self):
+        util.write_file(os.path.join(self.sem_path, 'config_a'), '1: 2\n')
+        util.write_file(os.path.join(self.sem_path, helpers.SEM_INDEX_NAME),
+                        '{not json')
+        sems = helpers.IndexedSemaphores(self.sem_path)
+        self.assertTrue(sems.has_run('config-a', PER_INSTANCE))
+
+    def test_canonicalize(self):
+        util.write_file(os.path.join(self.sem_path, helpers.SEM_INDEX_NAME),
+                        json.dumps({'version': helpers.SEM_INDEX_VERSION,
+                                    'markers': {'config-a.once': {},
+                                                'config_b': {}}}))
+        sems = helpers.IndexedSemaphores(self.sem_path)
+        self.assertEqual(1, sems.canonicalize())
+        self.assertEqual(['config_a.once', 'config_b'], self._markers())
+
+
+class TestRunners(test_helpers.ResourceUsingTestCase):
+    def test_semaphore_backend_from_paths(self):
+        paths = self.getCloudPaths()
+        self.assertIs(helpers.FileSemaphores,
+                      helpers.Runners(paths).sem_cls)
+        paths.cfgs['semaphore_backend'] = 'index'
+        runners = helpers.Runners(paths)
+        self.assertIs(helpers.IndexedSemaphores, runners.sem_cls)
+        (ran, result) = runners.run('config-a', lambda: 1, [], PER_ONCE)
+        self.assertEqual((True, 1), (ran, result))
+        self.assertEqual(
+            set(['config-a']),
+            runners.which_have_run([('config-a', PER_ONCE),
+                                    ('config-a', PER_ALWAYS)]))
+        self.assertEqual((False, None),
+                         runners.run('config-a', lambda: 2, [], PER_ONCE))
+        runners.sync()
@@ -0,0 +1,104 @@
+import os
+import subprocess
+import sys
+
+from cloudinit import importer
+from . import helpers as test_helpers
+
+BIN_CLOUDINIT = "bin/cloud-init"
+
+# Modules that are slow to import and only needed by some (or no) stages,
+# these must not be imported just to start cloud-init.
+DEFERRED_MODULES = frozenset([
+    'Cheetah',
+    'distutils',
+    'jinja2',
+    'jsonpatch',
+    'oauthlib',
+    'pkg_resources',
+    'prettytable',
+    'requests',
+    'serial',
+])
+
+# How many cloudinit modules each subcommand may import before it starts
+# doing anything (raise these with care, each one costs every boot).
+CLOUDINIT_MODULE_BUDGETS = {
+    'init': 40,
+    'modules': 40,
+    'single': 40,
+    'query': 40,
+}
+
+
+def _imported_modules(args):
+    # Like running 'python -X importtime' by hand, the names of all
+    # imported modules are written to stderr (most nested first).
+    cmd = [sys.executable, '-X', 'importtime', BIN_CLOUDINIT] + list(args)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    (_out, err) = proc.communicate()
+    modules = []
+    for line in err.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        name = line.rsplit('|', 1)[-1].strip()
+        if name == 'imported package':
+            continue
+        modules.append(name)
+    return (proc.returncode, modules)
+
+
+@test_helpers.skipIf(not os.path.isfile(BIN_CLOUDINIT), "no bin/cloud-init")
+@test_helpers.skipIf(sys.version_info < (3, 7), "-X importtime needs 3.7+")
+class TestStartupImports(test_helpers.TestCase):
+
+    def _check_subcommand(self, subcommand):
+        (rc, modules) = _imported_modules([subcommand, '--help'])
+        self.assertEqual(0, rc)
+        self.assertIn('cloudinit.stages', modules)
+        deferred = set(m for m in modules
+                       if m.split('.')[0] in DEFERRED_MODULES)
+        self.assertEqual(set(), deferred,
+                         "'%s' imported deferred modules" % subcommand)
+        ci_modules = [m for m in modules if m.split('.')[0] == 'cloudinit']
+        self.assertLessEqual(len(ci_modules),
+                             CLOUDINIT_MODULE_BUDGETS[subcommand],
+                             "'%s' imports %s" % (subcommand, ci_modules))
+
+    def test_init(self):
+        self._check_subcommand('init')
+
+    def test_modules(self):
+        self._check_subcommand('modules')
+
+    def test_single(self):
+        self._check_subcommand('single')
+
+    def test_query(self):
+        self._check_subcommand('query')
+
+
+class TestLazyModule(test_helpers.TestCase):
+
+    def test_not_imported_until_used(self):
+        name = 'cloudinit.tests_lazy_target_does_not_exist'
+        lazy = importer.lazy_import(name)
+        self.assertNotIn(name, sys.modules)
+        self.assertIn('lazy module', repr(lazy))
+        self.assertRaises(ImportError, getattr, lazy, 'anything')
+
+    def test_imported_module_returned_directly(self):
+        self.assertIs(os, importer.lazy_import('os'))
+
+    def test_attributes_pass_through(self):
+        lazy = importer.LazyModule('json')
+        self.assertIs(sys.modules['json'].dumps, lazy.dumps)
+        lazy.lazy_test_attr = 1
+        try:
+            self.assertEqual(1, sys.modules['json'].lazy_test_attr)
+        finally:
+            del lazy.lazy_test_attr
+        self.assertFalse(hasattr(sys.modules['json'], 'lazy_test_attr'))
+
+# vi: ts=4 expandtab
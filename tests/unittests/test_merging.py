@@ -4,6 +4,8 @@ from cloudinit.handlers import cloud_config
 from cloudinit.handlers import (CONTENT_START, CONTENT_END)
 
 from cloudinit import helpers as c_helpers
+from cloudinit import importer
+from cloudinit import mergers
 from cloudinit import util
 
 import collections
@@ -14,6 +16,11 @@ import re
 import six
 import string
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 SOURCE_PAT = "source*.*yaml"
 EXPECTED_PAT = "expected%s.yaml"
 TYPES = [dict, str, list, tuple, None]
@@ -255,3 +262,48 @@ class TestSimpleRun(helpers.ResourceUsingTestCase):
         c = _old_mergedict(a, b)
         d = util.mergemanydict([a, b])
         self.assertEqual(c, d)
+
+
+class TestMergerCaching(helpers.TestCase):
+
+    def _config_stack(self, fragments=40):
+        # Roughly what a boot merges: the builtin config, cloud.cfg, many
+        # cloud.cfg.d fragments (some with their own merge_how) and
+        # user-data.
+        stack = [util.get_builtin_cfg()]
+        for i in range(0, fragments):
+            frag = {
+                'packages': ['pkg%s' % i],
+                'system_info': {'paths': {'cloud_dir': '/var/lib/cloud'}},
+                'write_files': [{'path': '/etc/f%s' % i, 'content': 'x'}],
+                'key%s' % i: {'nested': list(range(0, 10))},
+            }
+            if i % 2:
+                frag['merge_how'] = 'dict(recurse_array)+list(append)'
+            stack.append(frag)
+        stack.append({'runcmd': ['ls'], 'merge_how': 'dict()+list(append)'})
+        return stack
+
+    def test_construct_is_reused(self):
+        parsed = mergers.string_extract_mergers('dict(replace)+list()')
+        self.assertIs(mergers.construct(parsed), mergers.construct(parsed))
+
+    def test_parsed_mergers_can_not_be_altered(self):
+        parsed = mergers.string_extract_mergers('list(append)')
+        parsed[0][1].append('prepend')
+        parsed.append(('dict', []))
+        self.assertEqual([('list', ['append'])],
+                         mergers.string_extract_mergers('list(append)'))
+
+    def test_uncachable_options_are_constructed(self):
+        merger = mergers.construct([('list', [{'append': True}])])
+        self.assertEqual([2], merger.merge([1], [2]))
+
+    def test_merging_a_config_stack_imports_mergers_once(self):
+        util.mergemanydict(self._config_stack(1))
+        with mock.patch.object(mergers.importer, 'find_module',
+                               wraps=importer.find_module) as m_find:
+            merged = util.mergemanydict(self._config_stack())
+        self.assertEqual(0, m_find.call_count)
+        self.assertIn('key39', merged)
+        self.assertEqual(['ls'], merged['runcmd'])
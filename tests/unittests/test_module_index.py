@@ -0,0 +1,169 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from cloudinit import config
+from cloudinit import importer
+from cloudinit.settings import PER_ALWAYS, PER_INSTANCE
+from cloudinit import stages
+from . import helpers
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Does not exist (so can never be imported), only the index knows of it
+FAKE_PACKAGE = 'cloudinit.tests_module_index_fake'
+
+
+class TestModuleIndex(helpers.TestCase):
+
+    def setUp(self):
+        super(TestModuleIndex, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch.dict(config._INDEXED_MODULES, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _write_module(self, name, content):
+        path = os.path.join(self.tmp, name + ".py")
+        with open(path, 'w') as fh:
+            fh.write(content)
+        return path
+
+    def _index(self):
+        modules = config.build_module_index(self.tmp)['modules']
+        for info in modules.values():
+            info['module'] = info['module'].replace(config.__name__,
+                                                    FAKE_PACKAGE)
+        return modules
+
+    def test_shipped_modules_match_their_index(self):
+        index = config.build_module_index()['modules']
+        self.assertIn('cc_apt_configure', index)
+        for (mod_name, info) in index.items():
+            mod = config.fixup_module(importer.import_module(info['module']))
+            for attr in config.INDEXED_ATTRS:
+                self.assertEqual(getattr(mod, attr), info[attr],
+                                 "%s.%s" % (mod_name, attr))
+
+    def test_scan_module(self):
+        path = self._write_module('cc_a', (
+            "from cloudinit.settings import PER_ALWAYS\n"
+            "frequency = PER_ALWAYS\n"
+            "distros = ['ubuntu']\n"
+            "resources = ['package-manager']\n"
+            "def handle(name, cfg, cloud, log, args):\n"
+            "    pass\n"))
+        self.assertEqual({'frequency': PER_ALWAYS, 'distros': ['ubuntu'],
+                          'osfamilies': [], 'resources': ['package-manager']},
+                         config.scan_module(path))
+
+    def test_scan_module_defaults(self):
+        path = self._write_module('cc_a', "def handle(*args):\n    pass\n")
+        self.assertEqual({'frequency': PER_INSTANCE, 'distros': [],
+                          'osfamilies': [], 'resources': None},
+                         config.scan_module(path))
+
+    def test_unknowable_modules_not_indexed(self):
+        unknowable = {
+            'cc_no_handle': "frequency = 'always'\n",
+            'cc_computed': ("frequency = get_frequency()\n"
+                            "def handle(*args):\n    pass\n"),
+            'cc_conditional': ("import os\n"
+                               "if os.path.exists('/x'):\n"
+                               "    distros = ['ubuntu']\n"
+                               "def handle(*args):\n    pass\n"),
+            'cc_bad_frequency': ("frequency = 'sometimes'\n"
+                                 "def handle(*args):\n    pass\n"),
+        }
+        for (name, content) in unknowable.items():
+            path = self._write_module(name, content)
+            self.assertIsNone(config.scan_module(path), name)
+        self._write_module('not_a_module', "def handle(*args):\n    pass\n")
+        self._write_module('cc_broken', "def handle(:\n")
+        self.assertEqual({}, config.build_module_index(self.tmp)['modules'])
+
+    def test_write_and_load(self):
+        self._write_module('cc_a', "def handle(*args):\n    pass\n")
+        index_file = os.path.join(self.tmp, 'index.json')
+        written = config.write_module_index(self.tmp, index_file)
+        self.assertEqual(['cc_a'], list(written['modules']))
+        self.assertEqual(written['modules'],
+                         config.load_module_index(index_file))
+
+    def test_load_missing_or_unknown_index(self):
+        index_file = os.path.join(self.tmp, 'index.json')
+        self.assertEqual({}, config.load_module_index(index_file))
+        for content in ('not json', json.dumps({'version': 0}),
+                        json.dumps([1, 2])):
+            with open(index_file, 'w') as fh:
+                fh.write(content)
+            self.assertEqual({}, config.load_module_index(index_file))
+
+    def test_indexed_module_not_imported(self):
+        self._write_module('cc_a', ("frequency = 'always'\n"
+                                    "resources = []\n"
+                                    "def handle(*args):\n    pass\n"))
+        index = self._index()
+        mod = config.indexed_module('cc_a', index=index, path=self.tmp)
+        self.assertIsInstance(mod, config.IndexedModule)
+        self.assertEqual(PER_ALWAYS, mod.frequency)
+        self.assertEqual([], mod.distros)
+        self.assertEqual([], mod.resources)
+        self.assertNotIn(FAKE_PACKAGE + '.cc_a', sys.modules)
+        # The same module every time it is asked for
+        self.assertIs(mod, config.indexed_module('cc_a', index=index,
+                                                 path=self.tmp))
+        # and only imported once it is needed
+        self.assertRaises(ImportError, getattr, mod, 'handle')
+
+    def test_out_of_date_entry_not_used(self):
+        path = self._write_module('cc_a', "def handle(*args):\n    pass\n")
+        index = self._index()
+        with open(path, 'a') as fh:
+            fh.write("frequency = 'always'\n")
+        self.assertIsNone(config.indexed_module('cc_a', index=index,
+                                                path=self.tmp))
+        self.assertIsNone(config.indexed_module('cc_other', index=index,
+                                                path=self.tmp))
+
+    def test_already_imported_module_returned(self):
+        index = config.build_module_index()['modules']
+        mod = importer.import_module('cloudinit.config.cc_debug')
+        self.assertIs(mod, config.indexed_module('cc_debug', index=index))
+
+
+class TestFixupModules(helpers.TestCase):
+
+    def setUp(self):
+        super(TestFixupModules, self).setUp()
+        patcher = mock.patch.dict(config._INDEXED_MODULES, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_indexed_modules_not_searched_for(self):
+        mod = config.IndexedModule('cloudinit.config.cc_x', {
+            'frequency': PER_ALWAYS, 'distros': [], 'osfamilies': [],
+            'resources': None})
+        mods = stages.Modules(None)
+        with mock.patch.object(config, 'indexed_module',
+                               return_value=mod):
+            with mock.patch.object(importer, 'find_module') as find:
+                mostly = mods._fixup_modules(
+                    [{'mod': 'x', 'args': ['a'], 'freq': PER_INSTANCE}])
+        self.assertEqual([[mod, 'x', PER_INSTANCE, ['a']]], mostly)
+        self.assertFalse(find.called)
+
+    def test_unindexed_modules_searched_for(self):
+        mods = stages.Modules(None)
+        with mock.patch.object(config, 'indexed_module', return_value=None):
+            mostly = mods._fixup_modules([{'mod': 'debug'}])
+        self.assertEqual(1, len(mostly))
+        self.assertEqual('cloudinit.config.cc_debug', mostly[0][0].__name__)
+
+# vi: ts=4 expandtab
@@ -0,0 +1,188 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+
+from cloudinit import netinfo
+from cloudinit import util
+from . import helpers
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+def _hex4(addr):
+    # How /proc/net/route writes addresses (host byte order)
+    return "%08X" % struct.unpack('=I', socket.inet_aton(addr))[0]
+
+
+def _hex6(addr):
+    # How /proc/net/tcp6 writes addresses (words in host byte order)
+    packed = socket.inet_pton(socket.AF_INET6, addr)
+    return "".join("%08X" % struct.unpack('=I', packed[i:i + 4])[0]
+                   for i in range(0, 16, 4))
+
+
+ROUTE_HEADER = ("Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\t"
+                "Mask\t\tMTU\tWindow\tIRTT")
+
+IF_INET6 = """\
+fe8000000000000000fc00fffe000001 02 40 20 80     eth0
+fd000000000000000000000000000002 02 40 00 80     eth0
+00000000000000000000000000000001 01 80 10 80       lo
+"""
+
+SOCKETS_HEADER = ("  sl  local_address                         remote_address"
+                  "                        st tx_queue rx_queue")
+
+IFCONFIG_OUT = """\
+eth0      Link encap:Ethernet  HWaddr 52:54:00:12:34:56
+          inet addr:10.0.0.5  Bcast:10.0.0.255  Mask:255.255.255.0
+          UP BROADCAST RUNNING MULTICAST  MTU:1500  Metric:1
+
+lo        Link encap:Local Loopback
+          inet addr:127.0.0.1  Mask:255.0.0.0
+          UP LOOPBACK RUNNING  MTU:65536  Metric:1
+"""
+
+
+class TestKernelNetInfo(helpers.TestCase):
+
+    def setUp(self):
+        super(TestKernelNetInfo, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.sys_class_net = os.path.join(self.tmp, 'sys-class-net')
+        paths = {
+            'SYS_CLASS_NET': self.sys_class_net,
+            'PROC_NET_ROUTE': os.path.join(self.tmp, 'route'),
+            'PROC_NET_IF_INET6': os.path.join(self.tmp, 'if_inet6'),
+            'PROC_NET_INET6_SOCKETS': (
+                ('tcp6', os.path.join(self.tmp, 'tcp6')),
+                ('udp6', os.path.join(self.tmp, 'udp6'))),
+        }
+        for (name, value) in paths.items():
+            patcher = mock.patch.object(netinfo, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self._add_dev('eth0', '0x1003', '52:54:00:12:34:56')
+        self._add_dev('lo', '0x9', '00:00:00:00:00:00')
+        self._add_dev('eth1', '0x1002', '52:54:00:AB:CD:EF')
+        util.write_file(os.path.join(self.tmp, 'route'), "\n".join([
+            ROUTE_HEADER,
+            "eth0\t%s\t%s\t0003\t0\t0\t100\t%s\t0\t0\t0" % (
+                _hex4('0.0.0.0'), _hex4('10.0.0.1'), _hex4('0.0.0.0')),
+            "eth0\t%s\t%s\t0001\t0\t0\t0\t%s\t0\t0\t0" % (
+                _hex4('10.0.0.0'), _hex4('0.0.0.0'), _hex4('255.255.255.0')),
+            "eth1\t%s\t%s\t0000\t0\t0\t0\t%s\t0\t0\t0" % (
+                _hex4('10.1.0.0'), _hex4('0.0.0.0'), _hex4('255.255.0.0')),
+        ]) + "\n")
+        util.write_file(os.path.join(self.tmp, 'if_inet6'), IF_INET6)
+        self.ipv4 = {
+            ('eth0', netinfo.SIOCGIFADDR): '10.0.0.5',
+            ('eth0', netinfo.SIOCGIFBRDADDR): '10.0.0.255',
+            ('eth0', netinfo.SIOCGIFNETMASK): '255.255.255.0',
+            ('lo', netinfo.SIOCGIFADDR): '127.0.0.1',
+            ('lo', netinfo.SIOCGIFBRDADDR): '0.0.0.0',
+            ('lo', netinfo.SIOCGIFNETMASK): '255.0.0.0',
+        }
+        patcher = mock.patch.object(
+            netinfo, '_ipv4_ioctl',
+            side_effect=lambda s, dev, req: self.ipv4.get((dev, req), ""))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _add_dev(self, name, flags, address):
+        util.write_file(os.path.join(self.sys_class_net, name, 'flags'),
+                        flags + "\n")
+        util.write_file(os.path.join(self.sys_class_net, name, 'address'),
+                        address + "\n")
+
+    def test_netdev_info(self):
+        with mock.patch.object(util, 'subp') as subp:
+            devs = netinfo.netdev_info()
+        self.assertFalse(subp.called)
+        self.assertEqual({
+            'eth0': {'up': True, 'hwaddr': '52:54:00:12:34:56',
+                     'addr': '10.0.0.5', 'bcast': '10.0.0.255',
+                     'mask': '255.255.255.0', 'addr6': 'fe80::fc:ff:fe00:1/64',
+                     'scope6': 'link'},
+            'lo': {'up': True, 'hwaddr': '', 'addr': '127.0.0.1',
+                   'bcast': '', 'mask': '255.0.0.0', 'addr6': '::1/128',
+                   'scope6': 'host'},
+            'eth1': {'up': False, 'hwaddr': '52:54:00:ab:cd:ef', 'addr': '',
+                     'bcast': '', 'mask': ''},
+        }, devs)
+
+    def test_netdev_info_empty(self):
+        devs = netinfo.netdev_info(empty=".")
+        self.assertEqual(".", devs['eth1']['addr'])
+        self.assertEqual(".", devs['lo']['hwaddr'])
+
+    def test_route_info(self):
+        util.write_file(os.path.join(self.tmp, 'tcp6'), "\n".join([
+            SOCKETS_HEADER,
+            "   0: %s:0016 %s:0000 0A 00000000:00000000" % (
+                _hex6('::'), _hex6('::')),
+            "   1: %s:0016 %s:9C40 01 0000000A:00000002" % (
+                _hex6('2001:db8::5'), _hex6('2001:db8::9')),
+        ]) + "\n")
+        util.write_file(os.path.join(self.tmp, 'udp6'), "\n".join([
+            SOCKETS_HEADER,
+            "   0: %s:0222 %s:0000 07 00000000:00000000" % (
+                _hex6('::'), _hex6('::')),
+        ]) + "\n")
+        with mock.patch.object(util, 'subp') as subp:
+            routes = netinfo.route_info()
+        self.assertFalse(subp.called)
+        self.assertEqual([
+            {'destination': '0.0.0.0', 'gateway': '10.0.0.1',
+             'genmask': '0.0.0.0', 'flags': 'UG', 'metric': '100',
+             'ref': '0', 'use': '0', 'iface': 'eth0'},
+            {'destination': '10.0.0.0', 'gateway': '0.0.0.0',
+             'genmask': '255.255.255.0', 'flags': 'U', 'metric': '0',
+             'ref': '0', 'use': '0', 'iface': 'eth0'},
+        ], routes['ipv4'])
+        self.assertEqual([
+            {'proto': 'tcp6', 'recv-q': '2', 'send-q': '10',
+             'local address': '2001:db8::5:22',
+             'foreign address': '2001:db8::9:40000',
+             'state': 'ESTABLISHED'},
+        ], routes['ipv6'])
+        self.assertEqual("10.0.0.1[eth0]", netinfo.getgateway())
+
+    def test_failure_falls_back_to_commands(self):
+        util.write_file(os.path.join(self.sys_class_net, 'eth0', 'flags'),
+                        "bogus\n")
+        with mock.patch.object(util, 'subp',
+                               return_value=(IFCONFIG_OUT, '')) as subp:
+            devs = netinfo.netdev_info()
+        subp.assert_called_once_with(["ifconfig", "-a"])
+        self.assertEqual('10.0.0.5', devs['eth0']['addr'])
+
+    def test_debug_info_tables(self):
+        info = netinfo.debug_info()
+        self.assertIn("ci-info: ", info)
+        self.assertIn("Net device info", info)
+        self.assertIn("Route IPv4 info", info)
+        self.assertIn("fe80::fc:ff:fe00:1/64", info)
+
+
+class TestCommandNetInfo(helpers.TestCase):
+
+    def test_commands_used_without_kernel_info(self):
+        with mock.patch.object(netinfo, '_kernel_info_available',
+                               return_value=False):
+            with mock.patch.object(util, 'subp',
+                                   return_value=(IFCONFIG_OUT, '')) as subp:
+                devs = netinfo.netdev_info(empty=".")
+        subp.assert_called_once_with(["ifconfig", "-a"])
+        self.assertEqual({'up': True, 'hwaddr': '52:54:00:12:34:56',
+                          'addr': '10.0.0.5', 'bcast': '10.0.0.255',
+                          'mask': '255.255.255.0'}, devs['eth0'])
+        self.assertEqual('.', devs['lo']['hwaddr'])
+
+# vi: ts=4 expandtab
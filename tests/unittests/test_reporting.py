@@ -3,6 +3,12 @@
 #
 # vi: ts=4 expandtab
 
+import json
+import os
+import shutil
+import tempfile
+import threading
+
 from cloudinit import reporting
 from cloudinit.reporting import events
 from cloudinit.reporting import handlers
@@ -367,3 +373,188 @@ class TestReportingEventStack(TestCase):
 class TestStatusAccess(TestCase):
     def test_invalid_status_access_raises_value_error(self):
         self.assertRaises(AttributeError, getattr, events.status, "BOGUS")
+
+
+class TestEventDurations(TestCase):
+
+    def setUp(self):
+        super(TestEventDurations, self).setUp()
+        patcher = mock.patch.dict(events._started, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('cloudinit.reporting.events.instantiated_handler_registry',
+                new_callable=_fake_registry)
+    def test_finish_event_has_duration_of_its_start(self, registry):
+        with mock.patch.object(events, '_monotonic',
+                               side_effect=[10.0, 12.5]):
+            events.report_start_event('name', 'desc')
+            events.report_finish_event('name', 'desc')
+        handler = registry.registered_items['a']
+        finish = handler.publish_event.call_args_list[-1][0][0]
+        self.assertEqual(2.5, finish.duration)
+        self.assertEqual(2.5, finish.as_dict()['duration'])
+        self.assertEqual({}, events._started)
+
+    @mock.patch('cloudinit.reporting.events.instantiated_handler_registry',
+                new_callable=_fake_registry)
+    def test_finish_without_start_has_no_duration(self, registry):
+        events.report_finish_event('never-started', 'desc')
+        handler = registry.registered_items['a']
+        finish = handler.publish_event.call_args[0][0]
+        self.assertIsNone(finish.duration)
+        self.assertNotIn('duration', finish.as_dict())
+
+
+class TestTimingHandler(TestCase):
+
+    def setUp(self):
+        super(TestTimingHandler, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'boot-timing.json')
+
+    def _finish(self, name, duration):
+        event = events.FinishReportingEvent(name, 'desc', duration=duration)
+        event.timestamp = 100.0
+        return event
+
+    def test_records_finished_events(self):
+        handler = handlers.TimingHandler(path=self.path)
+        handler.publish_event(events.ReportingEvent('start', 'a', 'desc'))
+        handler.publish_event(self._finish('a', None))
+        handler.publish_event(self._finish('a/b', 1.5))
+        handler.publish_event(self._finish('a', 2.0))
+        with open(self.path) as fh:
+            records = [json.loads(line) for line in fh]
+        self.assertEqual(
+            [{'name': 'a/b', 'description': 'desc', 'result': 'SUCCESS',
+              'start': 98.5, 'duration': 1.5},
+             {'name': 'a', 'description': 'desc', 'result': 'SUCCESS',
+              'start': 98.0, 'duration': 2.0}], records)
+
+    def test_nothing_written_without_directory(self):
+        path = os.path.join(self.tmp, 'missing', 'boot-timing.json')
+        handlers.TimingHandler(path=path).publish_event(
+            self._finish('a', 1.0))
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    def test_timing_handler_registered_by_default(self):
+        self.assertIsInstance(
+            reporting.instantiated_handler_registry.registered_items.get(
+                'timing'), handlers.TimingHandler)
+
+
+class TestWebHookHandler(TestCase):
+
+    def setUp(self):
+        super(TestWebHookHandler, self).setUp()
+        self.posted = []
+        self.posting = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        patcher = mock.patch.object(handlers.url_helper, 'readurl',
+                                    side_effect=self._readurl)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.release.set)
+
+    def _readurl(self, url, data=None, **kwargs):
+        self.posting.set()
+        self.assertTrue(self.release.wait(5))
+        data = json.loads(data)
+        if data == 'fail' or data == ['fail']:
+            raise IOError("failed")
+        self.posted.append(data)
+
+    def _handler(self, **kwargs):
+        with mock.patch.object(handlers.util, 'fetch_ssl_details',
+                               return_value=None):
+            return handlers.WebHookHandler('http://example.com/', **kwargs)
+
+    def _event(self, name):
+        event = mock.Mock()
+        event.as_dict.return_value = name
+        event.as_string.return_value = name
+        return event
+
+    def _block_sender(self, handler):
+        # Sending the first event gets stuck until released
+        self.release.clear()
+        handler.publish_event(self._event('first'))
+        self.assertTrue(self.posting.wait(5))
+
+    def test_synchronous(self):
+        handler = self._handler(asynchronous=False)
+        handler.publish_event(self._event('a'))
+        self.assertEqual(['a'], self.posted)
+        handler.publish_event(self._event('fail'))
+        self.assertEqual((1, 1), (handler.sent, handler.failed))
+        self.assertTrue(handler.flush())
+
+    def test_events_sent_in_background_until_flushed(self):
+        handler = self._handler()
+        self._block_sender(handler)
+        handler.publish_event(self._event('a'))
+        handler.publish_event(self._event('b'))
+        self.assertEqual([], self.posted)
+        self.release.set()
+        self.assertTrue(handler.flush())
+        self.assertEqual(['first', 'a', 'b'], self.posted)
+        self.assertEqual(3, handler.sent)
+
+    def test_queued_events_batched(self):
+        handler = self._handler(batch_size=2)
+        self._block_sender(handler)
+        for name in ('a', 'b', 'c'):
+            handler.publish_event(self._event(name))
+        self.release.set()
+        self.assertTrue(handler.flush())
+        self.assertEqual([['first'], ['a', 'b'], ['c']], self.posted)
+
+    def test_full_queue_drops_events(self):
+        handler = self._handler(queue_size=2)
+        self._block_sender(handler)
+        for name in ('a', 'b', 'c', 'd'):
+            handler.publish_event(self._event(name))
+        self.release.set()
+        self.assertTrue(handler.flush())
+        self.assertEqual(['first', 'a', 'b'], self.posted)
+        self.assertEqual((3, 2), (handler.sent, handler.dropped))
+
+    def test_full_queue_blocks_for_a_while(self):
+        handler = self._handler(queue_size=1, full_policy='block',
+                                block_timeout=0.01)
+        self._block_sender(handler)
+        handler.publish_event(self._event('a'))
+        handler.publish_event(self._event('b'))
+        self.assertEqual(1, handler.dropped)
+
+        # and gets its event in once there is room
+        release = threading.Timer(0.05, self.release.set)
+        release.start()
+        self.addCleanup(release.join)
+        handler.block_timeout = 5
+        handler.publish_event(self._event('c'))
+        self.assertTrue(handler.flush())
+        self.assertEqual(['first', 'a', 'c'], self.posted)
+
+    def test_flush_times_out(self):
+        handler = self._handler()
+        self._block_sender(handler)
+        self.assertFalse(handler.flush(timeout=0.01))
+
+    def test_failures_counted(self):
+        handler = self._handler()
+        handler.publish_event(self._event('fail'))
+        handler.publish_event(self._event('a'))
+        self.assertTrue(handler.flush())
+        self.assertEqual((1, 1), (handler.sent, handler.failed))
+
+    def test_flush_events_flushes_all_handlers(self):
+        registry = _fake_registry()
+        with mock.patch.object(reporting, 'instantiated_handler_registry',
+                               registry):
+            reporting.flush_events()
+        for handler in registry.registered_items.values():
+            self.assertEqual(1, handler.flush.call_count)
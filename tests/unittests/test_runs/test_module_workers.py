@@ -0,0 +1,144 @@
+import threading
+
+from .. import helpers
+
+from cloudinit.settings import PER_ALWAYS
+from cloudinit import stages
+
+
+class FakeModule(object):
+    def __init__(self, name, resources, handle):
+        self.name = name
+        self.resources = resources
+        self.frequency = PER_ALWAYS
+        self._handle = handle
+
+    def handle(self, name, cfg, cloud, log, args):
+        return self._handle(name)
+
+    def __repr__(self):
+        return "FakeModule(%s)" % (self.name)
+
+
+class FakeCloud(object):
+    def run(self, name, functor, args, freq=None, clear_on_fail=False):
+        return (True, functor(*args))
+
+    def which_have_run(self, items):
+        return set()
+
+    def sync_semaphores(self):
+        pass
+
+
+class FakeInit(object):
+    def cloudify(self):
+        return FakeCloud()
+
+
+class TestModuleWorkers(helpers.TestCase):
+
+    def setUp(self):
+        super(TestModuleWorkers, self).setUp()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def _modules(self, workers):
+        mods = stages.Modules(FakeInit())
+        mods._cached_cfg = {'module_workers': workers}
+        return mods
+
+    def _record(self, what):
+        with self.lock:
+            self.events.append(what)
+
+    def _recorder(self, wait_for=None):
+        def handle(name):
+            self._record("start %s" % name)
+            if wait_for is not None:
+                # Only finishes once another module got going
+                self.assertTrue(wait_for.wait(5))
+            self._record("end %s" % name)
+        return handle
+
+    def _mostly(self, *mods):
+        return [[m, m.name, None, []] for m in mods]
+
+    def test_sequential_by_default(self):
+        mods = self._modules(1)
+        mostly = self._mostly(
+            FakeModule('a', [], self._recorder()),
+            FakeModule('b', [], self._recorder()))
+        (which_ran, failures) = mods._run_modules(mostly)
+        self.assertEqual(['a', 'b'], which_ran)
+        self.assertEqual([], failures)
+        self.assertEqual(['start a', 'end a', 'start b', 'end b'],
+                         self.events)
+
+    def test_independent_modules_overlap(self):
+        b_started = threading.Event()
+
+        def handle_b(name):
+            self._record("start b")
+            b_started.set()
+            self._record("end b")
+
+        mods = self._modules(2)
+        mostly = self._mostly(
+            FakeModule('a', ['x'], self._recorder(wait_for=b_started)),
+            FakeModule('b', ['y'], handle_b))
+        (which_ran, failures) = mods._run_modules(mostly)
+        self.assertEqual(['a', 'b'], which_ran)
+        self.assertEqual([], failures)
+        self.assertLess(self.events.index('start b'),
+                        self.events.index('end a'))
+
+    def test_shared_resource_serializes(self):
+        mods = self._modules(4)
+        mostly = self._mostly(
+            FakeModule('a', ['package-manager'], self._recorder()),
+            FakeModule('b', ['other', 'package-manager'], self._recorder()))
+        mods._run_modules(mostly)
+        self.assertEqual(['start a', 'end a', 'start b', 'end b'],
+                         self.events)
+
+    def test_undeclared_resources_run_alone(self):
+        mods = self._modules(4)
+        mostly = self._mostly(
+            FakeModule('a', [], self._recorder()),
+            FakeModule('b', None, self._recorder()),
+            FakeModule('c', [], self._recorder()))
+        mods._run_modules(mostly)
+        self.assertEqual(['start a', 'end a', 'start b', 'end b',
+                          'start c', 'end c'], self.events)
+
+    def test_failures_reported_in_listed_order(self):
+        def fail(name):
+            raise RuntimeError(name)
+
+        mods = self._modules(3)
+        mostly = self._mostly(
+            FakeModule('a', [], fail),
+            FakeModule('b', [], self._recorder()),
+            FakeModule('c', [], fail))
+        (which_ran, failures) = mods._run_modules(mostly)
+        self.assertEqual(['a', 'b', 'c'], which_ran)
+        self.assertEqual(['a', 'c'], [name for (name, _e) in failures])
+        self.assertEqual(['start b', 'end b'], self.events)
+        self.assertEqual(
+            set(['config-a', 'config-b', 'config-c']),
+            set(mods.reporter.children.keys()))
+
+    def test_module_dependencies(self):
+        a = FakeModule('a', ['x'], None)
+        b = FakeModule('b', ['y'], None)
+        c = FakeModule('c', ['x', 'y'], None)
+        d = FakeModule('d', None, None)
+        e = FakeModule('e', [], None)
+        mostly = self._mostly(a, b, c, d, e, a)
+        self.assertEqual(
+            [set(), set(), set([0, 1]), set([0, 1, 2]), set([3]),
+             set([0, 2, 3])],
+            stages._module_dependencies(mostly))
+
+# vi: ts=4 expandtab
@@ -79,3 +79,33 @@ class TestSimpleRun(helpers.FilesystemMockingTestCase):
         self.assertIn('write-files', which_ran)
         contents = util.load_file('/etc/blah.ini')
         self.assertEqual(contents, 'blah')
+
+    def test_init_kept_for_next_stage(self):
+        new_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, new_root)
+        self.replicateTestRoot('simple_ubuntu', new_root)
+        cfg_fn = os.path.join(new_root, 'etc', 'cloud', 'cloud.cfg')
+        cfg = {'datasource_list': ['None']}
+        util.write_file(cfg_fn, util.yaml_dumps(cfg))
+        self._patchIn(new_root)
+
+        initer = stages.Init()
+        initer.read_cfg()
+        initer.initialize()
+        ds = initer.fetch()
+        distro = initer.distro
+
+        # The next stage sees the changed config, but the same datasource
+        cfg['runcmd'] = ['ls']
+        util.write_file('/etc/cloud/cloud.cfg', util.yaml_dumps(cfg))
+        initer.forget_cfg()
+        initer.read_cfg()
+        self.assertEqual(['ls'], initer.cfg['runcmd'])
+        self.assertIs(ds, initer.fetch())
+        self.assertIs(distro, initer.distro)
+
+        cfg['system_info'] = {'distro': 'debian'}
+        util.write_file('/etc/cloud/cloud.cfg', util.yaml_dumps(cfg))
+        initer.forget_cfg()
+        self.assertEqual('debian', initer.distro.name)
+        self.assertIs(ds, initer.datasource)
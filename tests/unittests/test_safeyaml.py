@@ -0,0 +1,116 @@
+import glob
+import os
+
+import yaml
+
+from cloudinit import safeyaml
+from . import helpers
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+TOP_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+
+# Documents exercising the parts of yaml where two parsers could plausibly
+# disagree about what was meant.
+CORPUS = [
+    "",
+    "#cloud-config\n",
+    "a: 1\nb: [1, 2, 3]\nc: {d: e}\n",
+    "key: !!python/unicode value\n",
+    u"unicode: \u00e9t\u00e9 \u2603\n",
+    "bools: [yes, no, on, off, true, false, y, n, ~, null]\n",
+    "nums: [0o14, 014, 0x1f, 1_000, 1.5e3, -.inf, 12:30:00]\n",
+    "dates: [2002-12-14, 2001-12-14t21:59:43.10-05:00]\n",
+    "bin: !!binary aGVsbG8gd29ybGQ=\n",
+    "set: !!set {a, b}\n",
+    "omap: !!omap [{a: 1}, {b: 2}]\n",
+    "base: &base {a: 1, b: 2}\nderived:\n  <<: *base\n  b: 3\n",
+    "literal: |\n  line one\n    indented\n  line three\nfolded: >-\n"
+    "  folded\n  text\n",
+    "quoted: ['it''s', \"tab\\there\", \"\\u263a\", 'a: b']\n",
+    "- top\n- level\n- list\n",
+    "just a string\n",
+    "write_files:\n- path: /etc/x\n  content: |\n    #!/bin/sh\n"
+    "    echo \"hi: there\" # not a comment\n  permissions: '0644'\n",
+    "runcmd:\n - [ls, -l, /]\n - 'echo \"$(date)\"'\n",
+    "key: value  # trailing comment\n# full comment\nother: 1\n",
+    "%YAML 1.1\n---\na: 1\n...\n",
+]
+
+BAD_CORPUS = [
+    "a: [1, 2\n",
+    "a: b: c\n",
+    "\ta: 1\n",
+    "a: *undefined\n",
+]
+
+
+def _corpus_files():
+    patterns = [
+        ('config', 'cloud.cfg'),
+        ('config', 'cloud.cfg.d', '*.cfg'),
+        ('doc', 'examples', 'cloud-config*.txt'),
+        ('tests', 'data', 'merge_sources', '*.yaml'),
+        ('tests', 'configs', '*.yaml'),
+    ]
+    found = []
+    for pattern in patterns:
+        found.extend(sorted(glob.glob(os.path.join(TOP_DIR, *pattern))))
+    return found
+
+
+@helpers.skipIf(safeyaml._CustomCSafeLoader is None,
+                "libyaml is not available")
+class TestLoaderParity(helpers.TestCase):
+
+    def assertSameLoad(self, blob, msg=None):
+        expected = yaml.load(blob, Loader=safeyaml._CustomSafeLoader)
+        found = yaml.load(blob, Loader=safeyaml._CustomCSafeLoader)
+        self.assertEqual(expected, found, msg)
+        self.assertEqual(type(expected), type(found), msg)
+
+    def test_corpus(self):
+        for blob in CORPUS:
+            self.assertSameLoad(blob, blob)
+
+    def test_shipped_files(self):
+        files = _corpus_files()
+        self.assertTrue(files)
+        for fn in files:
+            with open(fn, 'rb') as fh:
+                self.assertSameLoad(fh.read().decode('utf-8'), fn)
+
+    def test_bad_documents_raise_the_same(self):
+        for blob in BAD_CORPUS:
+            self.assertRaises(yaml.YAMLError, yaml.load, blob,
+                              Loader=safeyaml._CustomCSafeLoader)
+            self.assertRaises(yaml.YAMLError, safeyaml.load, blob)
+
+    def test_load_uses_libyaml(self):
+        with mock.patch.object(safeyaml.yaml, 'load',
+                               wraps=yaml.load) as m_load:
+            self.assertEqual({'a': 1}, safeyaml.load("a: 1"))
+        self.assertEqual(1, m_load.call_count)
+        self.assertIs(safeyaml._CustomCSafeLoader,
+                      m_load.call_args[1]['Loader'])
+
+    def test_python_parser_has_final_say(self):
+        with mock.patch.object(safeyaml._CustomCSafeLoader, 'get_single_node',
+                               side_effect=yaml.YAMLError("nope")):
+            self.assertEqual({'a': 1}, safeyaml.load("a: 1"))
+
+
+class TestLoad(helpers.TestCase):
+
+    def test_python_unicode_tag(self):
+        self.assertEqual({'key': 'value'},
+                         safeyaml.load("key: !!python/unicode value\n"))
+
+    def test_unsafe_tags_rejected(self):
+        self.assertRaises(yaml.YAMLError, safeyaml.load,
+                          "a: !!python/object/apply:os.system [ls]\n")
+
+# vi: ts=4 expandtab
@@ -19,10 +19,18 @@
 from __future__ import print_function
 
 from . import helpers as test_helpers
+import os
+import shutil
+import tempfile
 import textwrap
 
 from cloudinit import templater
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 try:
     import Cheetah
     HAS_CHEETAH = True
@@ -117,3 +125,95 @@ $a,$b'''
                                           {'mirror': mirror,
                                            'codename': codename})
         self.assertEqual(ex_data, out_data)
+
+
+class TestTemplateCache(test_helpers.TestCase):
+
+    def setUp(self):
+        super(TestTemplateCache, self).setUp()
+        templater.clear_cache()
+        self.addCleanup(templater.clear_cache)
+        self.addCleanup(templater.configure_bytecode_cache, None)
+
+    def test_basic_compiled_once(self):
+        with mock.patch.object(templater, 'BasicTemplate',
+                               wraps=templater.BasicTemplate) as m_tpl:
+            for hn in ('a', 'b'):
+                self.assertEqual("h=%s\n" % hn, templater.render_string(
+                    "## template:basic\nh=$hostname\n", {'hostname': hn}))
+        self.assertEqual(1, m_tpl.call_count)
+
+    def test_basic_errors(self):
+        self.assertRaises(KeyError, templater.basic_render, "$a.b",
+                          {'a': {}})
+        self.assertRaises(TypeError, templater.basic_render, "$a.b.c",
+                          {'a': {'b': 1}})
+        self.assertRaises(TypeError, templater.basic_render, "${a.b}",
+                          {'a': 'str'})
+
+    def test_basic_template_parts(self):
+        tpl = templater.BasicTemplate("x ${a.b} $c")
+        self.assertEqual(["x ", " ", ""], tpl.literals)
+        self.assertEqual([("a", "b"), ("c",)], tpl.paths)
+        self.assertEqual("x 1 2", tpl.render({'a': {'b': 1}, 'c': 2}))
+
+    def test_cache_keyed_by_content(self):
+        jinja = "## template:jinja\n{{a}}\n"
+        self.assertEqual("1\n", templater.render_string(jinja, {'a': 1}))
+        self.assertEqual("1\n\n", templater.render_string(jinja + "\n",
+                                                          {'a': 1}))
+        self.assertEqual(2, len(templater._CACHE))
+        self.assertEqual("2\n", templater.render_string(jinja, {'a': 2}))
+        self.assertEqual(2, len(templater._CACHE))
+
+    def test_cache_bounded(self):
+        with mock.patch.object(templater, 'CACHE_SIZE', 2):
+            for i in range(4):
+                templater.basic_render("%s $a" % i, {'a': 1})
+            self.assertEqual("3 1", templater.basic_render("3 $a",
+                                                           {'a': 1}))
+            self.assertEqual(2, len(templater._CACHE))
+            self.assertEqual(
+                set([('basic', templater._content_hash("%s $a" % i))
+                     for i in (2, 3)]),
+                set(templater._CACHE))
+
+    def test_jinja_still_strict(self):
+        self.assertRaises(Exception, templater.render_string,
+                          "## template:jinja\n{{missing}}", {})
+
+    def test_jinja_bytecode_cache(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        cache_dir = os.path.join(tmp, 'jinja-cache')
+        templater.configure_bytecode_cache(cache_dir)
+        self.assertEqual(0o700, os.stat(cache_dir).st_mode & 0o777)
+        blob = "## template:jinja\n{% for i in l %}{{i}},{% endfor %}"
+        self.assertEqual("1,2,", templater.render_string(blob,
+                                                         {'l': [1, 2]}))
+        self.assertEqual(1, len(os.listdir(cache_dir)))
+
+        # A new process (empty caches) loads the bytecode instead of
+        # compiling the template again.
+        templater.clear_cache()
+        templater.configure_bytecode_cache(None)
+        templater.configure_bytecode_cache(cache_dir)
+        env = templater._jinja_env()
+        with mock.patch.object(env, 'compile',
+                               side_effect=AssertionError) as m_compile:
+            self.assertEqual("3,", templater.render_string(blob,
+                                                           {'l': [3]}))
+        self.assertEqual(0, m_compile.call_count)
+
+    def test_jinja_unwritable_bytecode_cache(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        templater.configure_bytecode_cache(tmp)
+        templater._jinja_env()
+        with mock.patch.object(templater.jinja2.FileSystemBytecodeCache,
+                               'dump_bytecode', side_effect=IOError):
+            self.assertEqual("1", templater.render_string(
+                "## template:jinja\n{{a}}", {'a': 1}))
+        self.assertEqual([], os.listdir(tmp))
+
+# vi: ts=4 expandtab
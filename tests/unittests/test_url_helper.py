@@ -0,0 +1,254 @@
+import threading
+import time
+
+from . import helpers
+
+from cloudinit import url_helper
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+hp = helpers.import_httpretty()
+
+
+class TestUrlSessions(helpers.HttprettyTestCase):
+
+    def tearDown(self):
+        url_helper.configure_sessions()
+        super(TestUrlSessions, self).tearDown()
+
+    def test_sessions_are_shared_per_host(self):
+        s1 = url_helper._get_session('http://169.254.169.254/latest/')
+        s2 = url_helper._get_session('http://169.254.169.254/2009-04-04/')
+        s3 = url_helper._get_session('https://169.254.169.254/latest/')
+        s4 = url_helper._get_session('http://instance-data:8773/latest/')
+        self.assertIs(s1, s2)
+        self.assertIsNot(s1, s3)
+        self.assertIsNot(s1, s4)
+
+    def test_close_sessions_drops_pool(self):
+        s1 = url_helper._get_session('http://169.254.169.254/latest/')
+        url_helper.close_sessions()
+        s2 = url_helper._get_session('http://169.254.169.254/latest/')
+        self.assertIsNot(s1, s2)
+
+    def test_configure_sessions_resets_pool(self):
+        s1 = url_helper._get_session('http://169.254.169.254/latest/')
+        url_helper.configure_sessions(pool_size=2)
+        s2 = url_helper._get_session('http://169.254.169.254/latest/')
+        self.assertIsNot(s1, s2)
+
+    @hp.activate
+    def test_readurl_reuses_session(self):
+        url = 'http://169.254.169.254/latest/meta-data/instance-id'
+        hp.register_uri(hp.GET, url, body='i-1234', status=200)
+        self.assertEqual(b'i-1234', url_helper.readurl(url).contents)
+        session = url_helper._get_session(url)
+        self.assertEqual(b'i-1234', url_helper.readurl(url).contents)
+        self.assertIs(session, url_helper._get_session(url))
+
+    @hp.activate
+    def test_readurl_does_not_keep_cookies(self):
+        url = 'http://169.254.169.254/latest/meta-data/instance-id'
+        hp.register_uri(hp.GET, url, body='i-1234', status=200,
+                        adding_headers={'Set-Cookie': 'a=b; Path=/'})
+        url_helper.readurl(url)
+        self.assertEqual(0, len(url_helper._get_session(url).cookies))
+
+
+class TestCheckRequests(helpers.TestCase):
+
+    def test_concurrent_first_requests_keep_ssl(self):
+        # All of the threads starting on a cold module must wait for the
+        # requests version check, or their ssl settings are dropped.
+        for (name, value) in (('_REQ_CHECKED', False), ('_REQ_VER', None),
+                              ('SSL_ENABLED', False),
+                              ('CONFIG_ENABLED', False)):
+            patcher = mock.patch.object(url_helper, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        import pkg_resources
+        get_distribution = pkg_resources.get_distribution
+
+        def slow_get_distribution(name):
+            time.sleep(0.2)
+            return get_distribution(name)
+
+        ssl_details = {'ca_certs': '/etc/ssl/ca.pem'}
+        results = []
+
+        def check():
+            url_helper._check_requests()
+            results.append(url_helper._get_ssl_args(
+                'https://169.254.169.254/', ssl_details))
+
+        with mock.patch.object(pkg_resources, 'get_distribution',
+                               side_effect=slow_get_distribution):
+            threads = [threading.Thread(target=check) for _i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+        self.assertEqual([{'verify': '/etc/ssl/ca.pem'}] * 8, results)
+
+
+class TestWaitForUrl(helpers.TestCase):
+    BLACKHOLE = 'http://169.254.169.254/latest/meta-data/instance-id'
+    BAD = 'http://instance-data:8773/latest/meta-data/instance-id'
+    GOOD = 'http://10.0.0.1/latest/meta-data/instance-id'
+
+    def setUp(self):
+        super(TestWaitForUrl, self).setUp()
+        self.unblock = threading.Event()
+        self.addCleanup(self.unblock.set)
+        patcher = mock.patch.object(url_helper, 'readurl',
+                                    side_effect=self._readurl)
+        self.readurl = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _readurl(self, url, headers=None, timeout=None, check_status=True):
+        if url == self.BLACKHOLE:
+            self.unblock.wait(5)
+            raise url_helper.UrlError(IOError("timed out"), url=url)
+        if url == self.BAD:
+            return url_helper.StringResponse(b'', code=404)
+        return url_helper.StringResponse(b'i-1234')
+
+    def test_concurrent_returns_first_responsive_url(self):
+        status_cb = mock.Mock()
+        exception_cb = mock.Mock()
+        url = url_helper.wait_for_url([self.BLACKHOLE, self.BAD, self.GOOD],
+                                      max_wait=1, timeout=1,
+                                      status_cb=status_cb,
+                                      exception_cb=exception_cb,
+                                      concurrent=True)
+        self.assertEqual(self.GOOD, url)
+        self.assertFalse(self.unblock.is_set())
+        for (args, _kwargs) in status_cb.call_args_list:
+            self.assertNotIn(self.BLACKHOLE, args[0])
+
+    def test_concurrent_reports_failures_and_headers(self):
+        status_cb = mock.Mock()
+        exception_cb = mock.Mock()
+        headers_cb = mock.Mock(return_value={'X-Test': 'yes'})
+        self.unblock.set()
+        url = url_helper.wait_for_url([self.BLACKHOLE, self.BAD], max_wait=0,
+                                      timeout=1, status_cb=status_cb,
+                                      headers_cb=headers_cb,
+                                      exception_cb=exception_cb,
+                                      concurrent=True)
+        self.assertFalse(url)
+        self.assertEqual(2, status_cb.call_count)
+        self.assertEqual(2, exception_cb.call_count)
+        headers_cb.assert_has_calls([mock.call(self.BLACKHOLE),
+                                     mock.call(self.BAD)], any_order=True)
+        for (_args, kwargs) in exception_cb.call_args_list:
+            self.assertIsInstance(kwargs['exception'], url_helper.UrlError)
+        self.readurl.assert_any_call(self.BAD, headers={'X-Test': 'yes'},
+                                     timeout=1, check_status=False)
+
+    def test_cancelled_wait_gives_up(self):
+        cancel = threading.Event()
+
+        def _readurl(url, headers=None, timeout=None, check_status=True):
+            cancel.set()
+            return url_helper.StringResponse(b'', code=404)
+
+        self.readurl.side_effect = _readurl
+        with url_helper.cancelled_by(cancel):
+            with mock.patch.object(url_helper.time, 'sleep') as m_sleep:
+                self.assertFalse(url_helper.wait_for_url(
+                    [self.BAD], max_wait=60, timeout=1))
+        self.assertEqual(1, self.readurl.call_count)
+        self.assertEqual(0, m_sleep.call_count)
+
+    def test_serial_tries_urls_in_order(self):
+        status_cb = mock.Mock()
+        url = url_helper.wait_for_url([self.BAD, self.GOOD], max_wait=0,
+                                      timeout=1, status_cb=status_cb)
+        self.assertEqual(self.GOOD, url)
+        self.assertEqual(1, status_cb.call_count)
+        self.assertIn(self.BAD, status_cb.call_args[0][0])
+
+
+class TestRetryPolicy(helpers.TestCase):
+
+    def test_delay_grows_exponentially_without_jitter(self):
+        policy = url_helper.RetryPolicy(base_delay=1, factor=2, max_delay=5,
+                                        jitter=False)
+        self.assertEqual([1, 2, 4, 5, 5],
+                         [policy.delay(n) for n in range(0, 5)])
+
+    def test_delay_with_jitter_is_bounded(self):
+        policy = url_helper.RetryPolicy(base_delay=1, factor=2, max_delay=5)
+        for n in range(0, 10):
+            delay = policy.delay(n)
+            self.assertTrue(0 <= delay <= min(5, 2 ** n))
+
+    def test_retry_after_is_honored(self):
+        policy = url_helper.RetryPolicy(max_delay=30, jitter=False)
+        exc = url_helper.UrlError(IOError("busy"), code=503,
+                                  headers={'retry-after': '7'})
+        self.assertEqual(7, policy.delay(0, exc))
+        exc = url_helper.UrlError(IOError("slow down"), code=429,
+                                  headers={'retry-after': '120'})
+        self.assertEqual(30, policy.delay(0, exc))
+        exc = url_helper.UrlError(IOError("missing"), code=404,
+                                  headers={'retry-after': '7'})
+        self.assertEqual(1, policy.delay(0, exc))
+
+    def test_budget_is_shared(self):
+        policy = url_helper.RetryPolicy(budget=2)
+        self.assertEqual([True, True, False],
+                         [policy.allow_retry() for _i in range(0, 3)])
+
+    def test_configure_keeps_policy_for_same_config(self):
+        self.addCleanup(url_helper.configure_retry_policy, None)
+        url_helper.configure_retry_policy({'budget': 1})
+        policy = url_helper._RETRY_POLICY
+        self.assertTrue(policy.allow_retry())
+        # The budget is for the whole stage, what is left is kept
+        url_helper.configure_retry_policy({'budget': 1})
+        self.assertIs(policy, url_helper._RETRY_POLICY)
+        self.assertFalse(policy.allow_retry())
+        url_helper.configure_retry_policy({'budget': 2})
+        self.assertIsNot(policy, url_helper._RETRY_POLICY)
+        url_helper.configure_retry_policy(None)
+        self.assertIsNone(url_helper._RETRY_POLICY)
+
+    def test_non_finite_retry_after_ignored(self):
+        policy = url_helper.RetryPolicy(max_delay=30, jitter=False)
+        for value in ('nan', 'inf', '-inf', 'NaN'):
+            exc = url_helper.UrlError(IOError("busy"), code=503,
+                                      headers={'retry-after': value})
+            self.assertIsNone(url_helper._get_retry_after(exc))
+            self.assertEqual(1, policy.delay(0, exc))
+
+
+class TestReadurlRetries(helpers.HttprettyTestCase):
+    URL = 'http://169.254.169.254/latest/meta-data/instance-id'
+
+    @hp.activate
+    def test_policy_paces_and_limits_retries(self):
+        hp.register_uri(hp.GET, self.URL, status=503,
+                        adding_headers={'Retry-After': '2'})
+        policy = url_helper.RetryPolicy(budget=2)
+        with mock.patch.object(url_helper.time, 'sleep') as m_sleep:
+            self.assertRaises(url_helper.UrlError, url_helper.readurl,
+                              self.URL, retries=5, retry_policy=policy)
+        self.assertEqual([mock.call(2), mock.call(2)],
+                         m_sleep.call_args_list)
+
+    @hp.activate
+    def test_cancelled_retries_stop(self):
+        hp.register_uri(hp.GET, self.URL, status=503)
+        cancel = threading.Event()
+        cancel.set()
+        with url_helper.cancelled_by(cancel):
+            with mock.patch.object(url_helper.time, 'sleep') as m_sleep:
+                self.assertRaises(url_helper.UrlError, url_helper.readurl,
+                                  self.URL, retries=5)
+        self.assertEqual(1, len(hp.httpretty.latest_requests))
+        self.assertEqual(0, m_sleep.call_count)
@@ -1,10 +1,12 @@
 from __future__ import print_function
 
+import json
 import logging
 import os
 import shutil
 import stat
 import tempfile
+import threading
 
 import six
 import yaml
@@ -321,6 +323,31 @@ class TestMountinfoParsing(helpers.ResourceUsingTestCase):
         self.assertEqual(expected, util.parse_mount_info('/run/lock', lines))
 
 
+DMIDECODE_DUMP = """# dmidecode 3.0
+Getting SMBIOS data from sysfs.
+SMBIOS 2.8 present.
+
+Handle 0x0100, DMI type 1, 27 bytes
+System Information
+\tManufacturer: QEMU
+\tProduct Name: Standard PC
+\tVersion: pc-i440fx-2.5
+\tSerial Number: Not Specified
+\tUUID: 6f0bc9b8-a45f-4d08-a3c3-8a2d0e8d6ddf
+\tWake-up Type: Power Switch
+
+Handle 0x0200, DMI type 2, 15 bytes
+Base Board Information
+\tManufacturer: Canonical
+\tProduct Name: Not Specified
+
+Handle 0x0300, DMI type 3, 22 bytes
+Chassis Information
+\tManufacturer: QEMU
+\tAsset Tag: ......
+"""
+
+
 class TestReadDMIData(helpers.FilesystemMockingTestCase):
 
     def setUp(self):
@@ -395,6 +422,64 @@ class TestReadDMIData(helpers.FilesystemMockingTestCase):
         self._create_sysfs_file(sysfs_key, dmi_value)
         self.assertEqual(expected, util.read_dmi_data(dmi_key))
 
+    def test_sysfs_read_once(self):
+        self._create_sysfs_file('product_name', 'product')
+        self._create_sysfs_file('sys_vendor', 'vendor')
+        self._configure_dmidecode_return('system-product-name', 'wrong')
+        self.assertEqual('product', util.read_dmi_data('system-product-name'))
+        util.write_file('/sys/class/dmi/id/product_name', 'changed')
+        util.write_file('/sys/class/dmi/id/sys_vendor', 'changed')
+        self.assertEqual('product', util.read_dmi_data('system-product-name'))
+        self.assertEqual('vendor', util.read_dmi_data('system-manufacturer'))
+
+    def test_one_dmidecode_dump_for_mapped_keys(self):
+        calls = []
+
+        def dmidecode(cmd):
+            calls.append(cmd)
+            if cmd[1:] == ['--type', '0,1,2,3']:
+                return (DMIDECODE_DUMP, '')
+            return ('unmapped-value\n', '')
+
+        self.patched_funcs.enter_context(
+            mock.patch.object(util, 'which', lambda _: 'dmidecode'))
+        self.patched_funcs.enter_context(
+            mock.patch.object(util, 'subp', dmidecode))
+        self.assertEqual('Standard PC', util.read_dmi_data(
+            'system-product-name'))
+        self.assertEqual('QEMU', util.read_dmi_data('system-manufacturer'))
+        self.assertEqual('Canonical', util.read_dmi_data(
+            'baseboard-manufacturer'))
+        self.assertEqual('', util.read_dmi_data('chassis-asset-tag'))
+        self.assertEqual('6f0bc9b8-a45f-4d08-a3c3-8a2d0e8d6ddf',
+                         util.read_dmi_data('system-uuid'))
+        self.assertEqual('unmapped-value', util.read_dmi_data('unmapped'))
+        self.assertEqual('unmapped-value', util.read_dmi_data('unmapped'))
+        self.assertEqual(
+            [['dmidecode', '--type', '0,1,2,3'],
+             ['dmidecode', '--string', 'unmapped']], calls)
+
+    def test_not_cached_without_path(self):
+        util.ensure_dir('/run/cloud-init')
+        self._create_sysfs_file('product_name', 'product')
+        self.assertEqual('product', util.read_dmi_data('system-product-name'))
+        self.assertFalse(os.path.exists(util.DMI_CACHE))
+
+    def test_cached_for_later_stages(self):
+        cache_path = '/run/cloud-init/dmi.json'
+        self.patched_funcs.enter_context(
+            mock.patch.object(util, 'DMI_CACHE_PATH', cache_path))
+        util.ensure_dir('/run/cloud-init')
+        self._create_sysfs_file('product_name', 'product')
+        self.assertEqual('product', util.read_dmi_data('system-product-name'))
+        self.assertEqual({'system-product-name': 'product'},
+                         json.loads(util.load_file(cache_path)))
+
+        util.write_file(cache_path, '{"system-product-name": "cached"}')
+        with mock.patch.object(util, '_DMI_SNAPSHOT', None):
+            self.assertEqual('cached',
+                             util.read_dmi_data('system-product-name'))
+
 
 class TestMultiLog(helpers.FilesystemMockingTestCase):
 
@@ -486,4 +571,331 @@ class TestReadSeeded(helpers.TestCase):
         self.assertEqual(found_md, {'key1': 'val1'})
         self.assertEqual(found_ud, ud)
 
+
+class TestReadConfWithConfd(helpers.TestCase):
+    def setUp(self):
+        super(TestReadConfWithConfd, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.cfgfile = os.path.join(self.tmp, 'cloud.cfg')
+        self.cache = os.path.join(self.tmp, 'run', 'cloud.cfg.json')
+        util.ensure_dir(os.path.dirname(self.cache))
+        self._populate({
+            'cloud.cfg': 'a: 1\nb: 1\n',
+            'cloud.cfg.d/10_b.cfg': 'b: 2\n',
+            'cloud.cfg.d/20_c.cfg': 'c: 3\n',
+        })
+
+    def _populate(self, files):
+        for (name, content) in files.items():
+            util.write_file(os.path.join(self.tmp, name), content)
+
+    def _read(self):
+        return util.read_conf_with_confd(self.cfgfile, cache_file=self.cache)
+
+    def test_confd_overrides(self):
+        expected = {'a': 1, 'b': 2, 'c': 3}
+        self.assertEqual(expected, util.read_conf_with_confd(self.cfgfile))
+        self.assertEqual(expected, self._read())
+        self.assertTrue(os.path.isfile(self.cache))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.cache).st_mode))
+
+    def test_unchanged_files_not_reparsed(self):
+        first = self._read()
+        with mock.patch.object(util, 'load_yaml') as m_load_yaml:
+            self.assertEqual(first, self._read())
+        self.assertEqual(0, m_load_yaml.call_count)
+
+    def test_changed_fragment_invalidates(self):
+        self._read()
+        util.write_file(os.path.join(self.tmp, 'cloud.cfg.d', '20_c.cfg'),
+                        'c: 4\n')
+        self.assertEqual({'a': 1, 'b': 2, 'c': 4}, self._read())
+
+    def test_new_fragment_invalidates(self):
+        self._read()
+        util.write_file(os.path.join(self.tmp, 'cloud.cfg.d', '05_d.cfg'),
+                        'd: 5\n')
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3, 'd': 5}, self._read())
+
+    def test_removed_confd_invalidates(self):
+        self._read()
+        shutil.rmtree(os.path.join(self.tmp, 'cloud.cfg.d'))
+        self.assertEqual({'a': 1, 'b': 1}, self._read())
+
+    def test_changed_conf_d_key_invalidates(self):
+        self._read()
+        self._populate({
+            'cloud.cfg': 'a: 1\nconf_d: %s/other.d\n' % self.tmp,
+            'other.d/10_e.cfg': 'e: 6\n',
+        })
+        self.assertEqual({'a': 1, 'e': 6, 'conf_d': self.tmp + '/other.d'},
+                         self._read())
+
+    def test_no_cache_without_cache_dir(self):
+        shutil.rmtree(os.path.dirname(self.cache))
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, self._read())
+        self.assertFalse(os.path.exists(self.cache))
+
+    def test_corrupt_cache_ignored(self):
+        util.write_file(self.cache, '{not json')
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, self._read())
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, self._read())
+
+    def test_json_unsafe_config_not_cached(self):
+        util.write_file(self.cfgfile, 'a: 1\n2: two\n')
+        self.assertEqual({'a': 1, 2: 'two', 'b': 2, 'c': 3}, self._read())
+        self.assertFalse(os.path.exists(self.cache))
+
+
+BLKID_EXPORT = """DEVNAME=/dev/vda1
+LABEL=cloudimg-rootfs
+UUID=6f5c
+TYPE=ext4
+
+DEVNAME=/dev/sr0
+UUID=2016-01-01-00-00-00-00
+LABEL=cidata
+TYPE=iso9660
+
+DEVNAME=/dev/vdb
+LABEL=my\\ data
+TYPE=vfat
+"""
+
+
+class TestFindDevsWith(helpers.TestCase):
+
+    def setUp(self):
+        super(TestFindDevsWith, self).setUp()
+        util.invalidate_blkid_inventory()
+        self.addCleanup(util.invalidate_blkid_inventory)
+        self.calls = []
+        self.probed = {'/dev/sr1': '/dev/sr1\n'}
+        patcher = mock.patch.object(util, 'subp', side_effect=self._subp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _subp(self, cmd, rcs=None):
+        self.calls.append(cmd)
+        if cmd == ['blkid', '-o', 'export']:
+            return (BLKID_EXPORT, '')
+        return (self.probed.get(cmd[-1], ''), '')
+
+    def test_one_blkid_run_answers_all_criteria(self):
+        self.assertEqual(['/dev/sr0'], util.find_devs_with('TYPE=iso9660'))
+        self.assertEqual(['/dev/sr0'], util.find_devs_with('LABEL=cidata'))
+        self.assertEqual(['/dev/sr0'],
+                         util.find_devs_with('UUID=2016-01-01-00-00-00-00'))
+        self.assertEqual(['/dev/vdb'], util.find_devs_with('LABEL="my data"'))
+        self.assertEqual([], util.find_devs_with('LABEL=config-2'))
+        self.assertEqual(['/dev/vda1', '/dev/sr0', '/dev/vdb'],
+                         util.find_devs_with())
+        self.assertEqual(['/dev/sr0'], util.find_devs_with(path='/dev/sr0'))
+        self.assertEqual([], util.find_devs_with('TYPE=ext4', path='/dev/sr0'))
+        self.assertEqual([['blkid', '-o', 'export']], self.calls)
+
+    def test_other_queries_run_blkid(self):
+        util.find_devs_with('TYPE=vfat', oformat='export')
+        util.find_devs_with('TYPE=vfat', no_cache=True)
+        util.find_devs_with('TYPE=vfat', tag='LABEL')
+        self.assertEqual(
+            [['blkid', '-tTYPE=vfat', '-oexport'],
+             ['blkid', '-tTYPE=vfat', '-c', '/dev/null', '-odevice'],
+             ['blkid', '-tTYPE=vfat', '-sLABEL', '-odevice']], self.calls)
+
+    def test_unknown_path_probed_and_invalidates(self):
+        self.assertEqual(['/dev/sr1'], util.find_devs_with(path='/dev/sr1'))
+        self.assertEqual(['/dev/sr0'], util.find_devs_with('TYPE=iso9660'))
+        self.assertEqual(
+            [['blkid', '-o', 'export'], ['blkid', '-odevice', '/dev/sr1'],
+             ['blkid', '-o', 'export']], self.calls)
+
+    def test_invalidate(self):
+        util.find_devs_with('TYPE=vfat')
+        util.invalidate_blkid_inventory()
+        util.find_devs_with('TYPE=vfat')
+        self.assertEqual(2, len(self.calls))
+
+    def test_blkid_failure_falls_back(self):
+        def fail_export(cmd, rcs=None):
+            self.calls.append(cmd)
+            if cmd == ['blkid', '-o', 'export']:
+                raise util.ProcessExecutionError(cmd=cmd, exit_code=4)
+            return ('/dev/vdb\n', '')
+
+        util.subp.side_effect = fail_export
+        self.assertEqual(['/dev/vdb'], util.find_devs_with('TYPE=vfat'))
+        self.assertEqual(
+            [['blkid', '-o', 'export'], ['blkid', '-tTYPE=vfat', '-odevice']],
+            self.calls)
+
+
+class TestFindModules(helpers.TestCase):
+
+    def setUp(self):
+        super(TestFindModules, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        patcher = mock.patch.dict(util._FIND_MODULES_CACHE, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _touch(self, name, mtime):
+        util.write_file(os.path.join(self.tmp, name), "")
+        os.utime(self.tmp, (mtime, mtime))
+
+    def test_listing_reused_until_directory_changes(self):
+        self._touch('a.py', 1000)
+        self.assertEqual({os.path.join(self.tmp, 'a.py'): 'a'},
+                         util.find_modules(self.tmp))
+        with mock.patch.object(util, '_find_modules') as find:
+            util.find_modules(self.tmp)
+        self.assertFalse(find.called)
+        self._touch('b.py', 2000)
+        self.assertEqual(['a', 'b'],
+                         sorted(util.find_modules(self.tmp).values()))
+
+    def test_recently_changed_directory_not_cached(self):
+        self._touch('a.py', 1000)
+        os.utime(self.tmp, None)
+        util.find_modules(self.tmp)
+        self.assertNotIn(self.tmp, util._FIND_MODULES_CACHE)
+
+    def test_missing_directory(self):
+        self.assertEqual({}, util.find_modules(os.path.join(self.tmp, 'x')))
+
+
+class TestMountCb(helpers.TestCase):
+
+    def setUp(self):
+        super(TestMountCb, self).setUp()
+        util.invalidate_blkid_inventory()
+        self.addCleanup(util.invalidate_blkid_inventory)
+        self.calls = []
+        self.failing_types = set()
+        for (name, kwargs) in (('subp', {'side_effect': self._subp}),
+                               ('mounts', {'return_value': {}})):
+            patcher = mock.patch.object(util, name, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(util.platform, 'system',
+                                    return_value='Linux')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _subp(self, cmd, rcs=None):
+        self.calls.append(cmd[:-1] if cmd[0] == 'mount' else cmd[:1])
+        if cmd == ['blkid', '-o', 'export']:
+            return ('DEVNAME=/dev/sr0\nTYPE=iso9660\n', '')
+        if cmd[0] == 'mount' and cmd[-3] in self.failing_types:
+            raise util.ProcessExecutionError(cmd=cmd, exit_code=32)
+        return ('', '')
+
+    def _mounts(self):
+        return [c for c in self.calls if c[0] == 'mount']
+
+    def test_read_only_mounts_not_synced(self):
+        util.mount_cb('/dev/sr0', lambda mp: mp)
+        util.mount_cb('/dev/vdb', lambda mp: mp, rw=True)
+        self.assertEqual(
+            [['mount', '-o', 'ro', '-t', 'auto', '/dev/sr0'], ['umount'],
+             ['mount', '-o', 'rw,sync', '-t', 'auto', '/dev/vdb'],
+             ['umount']], self.calls)
+
+    def test_type_from_blkid_instead_of_trying_each(self):
+        util.mount_cb('/dev/sr0', lambda mp: mp, mtype=['vfat', 'iso9660'])
+        self.assertEqual([['mount', '-o', 'ro', '-t', 'iso9660', '/dev/sr0']],
+                         self._mounts())
+
+    def test_each_type_tried_when_blkid_does_not_know(self):
+        self.failing_types.add('vfat')
+        util.mount_cb('/dev/vdb', lambda mp: mp, mtype=['vfat', 'iso9660'])
+        self.assertEqual(
+            [['mount', '-o', 'ro', '-t', 'vfat', '/dev/vdb'],
+             ['mount', '-o', 'ro', '-t', 'iso9660', '/dev/vdb']],
+            self._mounts())
+
+    def test_session_shares_read_only_mounts(self):
+        with util.mount_session() as session:
+            first = util.mount_cb('/dev/sr0', lambda mp: mp)
+            self.assertEqual(first, util.mount_cb('/dev/sr0', lambda mp: mp))
+            with util.mount_session() as nested:
+                self.assertIs(session, nested)
+                util.mount_cb('/dev/sr0', lambda mp: mp, data=None)
+            self.assertEqual([['mount', '-o', 'ro', '-t', 'auto', '/dev/sr0']],
+                             self.calls)
+        self.assertEqual(['umount'], self.calls[-1])
+        self.assertEqual({}, session.mounted)
+
+    def test_session_mount_of_other_type_not_shared(self):
+        with util.mount_session():
+            util.mount_cb('/dev/vdb', lambda mp: mp, mtype='vfat')
+            util.mount_cb('/dev/vdb', lambda mp: mp)
+            util.mount_cb('/dev/vdb', lambda mp: mp, mtype='iso9660')
+        self.assertEqual(
+            [['mount', '-o', 'ro', '-t', 'vfat', '/dev/vdb'],
+             ['umount'],
+             ['mount', '-o', 'ro', '-t', 'iso9660', '/dev/vdb'],
+             ['umount']], self.calls)
+
+    def test_session_released_for_read_write(self):
+        with util.mount_session() as session:
+            util.mount_cb('/dev/vdb', lambda mp: mp)
+            util.mount_cb('/dev/vdb', lambda mp: mp, rw=True)
+            self.assertEqual({}, session.mounted)
+        self.assertEqual(
+            [['mount', '-o', 'ro', '-t', 'auto', '/dev/vdb'], ['umount'],
+             ['mount', '-o', 'rw,sync', '-t', 'auto', '/dev/vdb'],
+             ['umount']], self.calls)
+
+    def test_session_mount_failure(self):
+        self.failing_types.add('auto')
+        with util.mount_session() as session:
+            self.assertRaises(util.MountFailedError, util.mount_cb,
+                              '/dev/vdb', lambda mp: mp)
+            self.assertEqual({}, session.mounted)
+
+    def test_session_mount_in_use_kept_until_done(self):
+        seen = []
+
+        def reader(mp):
+            # The session ends while this is still reading
+            session.close()
+            seen.append(list(self.calls))
+            return mp
+
+        with util.mount_session() as session:
+            util.mount_cb('/dev/sr0', reader)
+        self.assertEqual([['mount', '-o', 'ro', '-t', 'auto', '/dev/sr0']],
+                         seen[0])
+        self.assertEqual(['umount'], self.calls[-1])
+        self.assertEqual({}, session.mounted)
+
+    def test_session_waits_for_readers_before_read_write(self):
+        reading = threading.Event()
+        finish = threading.Event()
+
+        def reader(mp):
+            reading.set()
+            finish.wait(5)
+            self.calls.append(['done reading'])
+            return mp
+
+        with util.mount_session():
+            thread = threading.Thread(target=util.mount_cb,
+                                      args=('/dev/vdb', reader))
+            thread.start()
+            reading.wait(5)
+            timer = threading.Timer(0.1, finish.set)
+            timer.start()
+            util.mount_cb('/dev/vdb', lambda mp: mp, rw=True)
+            thread.join()
+            timer.join()
+        self.assertEqual(
+            [['mount', '-o', 'ro', '-t', 'auto', '/dev/vdb'],
+             ['done reading'], ['umount'],
+             ['mount', '-o', 'rw,sync', '-t', 'auto', '/dev/vdb'],
+             ['umount']], self.calls)
+
 # vi: ts=4 expandtab